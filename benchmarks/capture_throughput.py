@@ -0,0 +1,119 @@
+"""End-to-end capture -> save throughput without a camera.
+
+    python -m benchmarks.capture_throughput --frames 100 --threads 4
+    python -m benchmarks.capture_throughput --source replay --replay saved_data/<session>/<serial>
+"""
+import argparse
+import pathlib
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.common import StageTimer, directory_size, sizeof_fmt
+from rs_store.container import ChunkedSessionWriter
+from rs_store.data import STREAMS
+from rs_store.pool import BufferPool
+from rs_store.sources import ReplaySource, SyntheticSource
+from rs_store.writer import POLICIES, Writer
+
+
+def make_source(args):
+    if args.source == "replay":
+        return ReplaySource(args.replay, loop=True)
+    return SyntheticSource(width=args.width, height=args.height, fps=args.fps, colour_width=args.colour_width,
+                           colour_height=args.colour_height, ir_enabled=not args.no_ir)
+
+
+def source_shapes(source):
+    # Size the pool from a first frame so replayed sessions of any resolution work
+    frames = source.get_frames()
+    return {k: (getattr(frames, k).shape, getattr(frames, k).dtype) for k in STREAMS
+            if isinstance(getattr(frames, k), np.ndarray)}
+
+
+def run(args, out):
+    source = make_source(args)
+    timer = StageTimer()
+    store = ChunkedSessionWriter(out, chunk_size=args.chunk_size) if args.storage == "chunked" else None
+
+    writer = Writer(workers=args.threads, mode=args.workers, max_bytes=args.queue_mb * 1024 * 1024,
+                    policy=args.overflow)
+
+    pool = BufferPool(source_shapes(source), size=args.pool_size, shared=args.workers == "process")
+
+    def on_done(slot, submitted):
+        # Latency from submission to the stream being on disk (queueing + encoding + writing)
+        def done(task, ok):
+            if ok:
+                timer.add(f"save_{task.stream}", time.perf_counter() - submitted)
+            slot.release()
+        return done
+
+    start = time.perf_counter()
+    for idx in range(args.frames):
+        with timer.time("get_frames"):
+            frames = source.get_frames()
+        if idx % args.save_every:
+            continue
+        with timer.time("acquire"):
+            slot = pool.acquire(timeout=None if args.overflow == "block" else 0, fallback=True)
+        with timer.time("submit"):
+            for k in STREAMS:
+                data = getattr(frames, k)
+                if data is None:
+                    continue
+                if isinstance(data, np.ndarray):
+                    data = slot.put(k, data)
+                slot.retain()
+                writer.submit(out / f"{idx:07d}_bench_{k}", data, stream=k, store=store,
+                              on_done=on_done(slot, time.perf_counter()), shared=slot.shared_ref(k))
+        slot.release()
+    writer.close()
+    pool.close()
+    if store is not None:
+        store.close()
+    elapsed = time.perf_counter() - start
+
+    total_bytes = directory_size(out)
+    timer.report(f"Source={args.source} storage={args.storage} frames={args.frames} threads={args.threads} "
+                 f"workers={args.workers} overflow={args.overflow} "
+                 f"save_every={args.save_every}")
+    print(f"Throughput: {args.frames / elapsed:.2f} frames/s, {sizeof_fmt(total_bytes / elapsed)}/s "
+          f"({sizeof_fmt(total_bytes)} in {elapsed:.2f}s)")
+    print(f"Writer: {writer.stats()}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", default="synthetic", choices=["synthetic", "replay"])
+    parser.add_argument("--replay", default=None, help="Saved session directory to replay")
+    parser.add_argument("--frames", default=50, type=int)
+    parser.add_argument("--threads", default=1, type=int)
+    parser.add_argument("--workers", default="thread", choices=["thread", "process"])
+    parser.add_argument("--queue-mb", default=512, type=float)
+    parser.add_argument("--overflow", default="block", choices=list(POLICIES))
+    parser.add_argument("--pool-size", default=4, type=int)
+    parser.add_argument("--storage", default="files", choices=["files", "chunked"])
+    parser.add_argument("--chunk-size", default=100, type=int)
+    parser.add_argument("--save-every", default=1, type=int, help="Only save every n-th frame (like --interval)")
+    parser.add_argument("--width", default=1280, type=int)
+    parser.add_argument("--height", default=720, type=int)
+    parser.add_argument("--colour-width", default=1920, type=int)
+    parser.add_argument("--colour-height", default=1080, type=int)
+    parser.add_argument("--fps", default=0, type=int, help="Source frame rate (0 runs unthrottled)")
+    parser.add_argument("--no-ir", action='store_true', default=False)
+    parser.add_argument("--out", default=None, help="Directory to write to (defaults to a temporary directory)")
+    args = parser.parse_args()
+
+    if args.out is not None:
+        out = pathlib.Path(args.out)
+        out.mkdir(parents=True, exist_ok=True)
+        run(args, out)
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            run(args, pathlib.Path(tmp))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+
+from rs_store.utils import sizeof_fmt  # noqa: F401 (re-exported)
+
+
+class StageTimer:
+    """Thread safe collection of per-stage latencies (seconds)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.samples[stage].append(seconds)
+
+    def summary(self):
+        rows = []
+        for stage, values in sorted(self.samples.items()):
+            v = np.asarray(values) * 1000
+            rows.append((stage, len(v), v.mean(), np.percentile(v, 50), np.percentile(v, 95), v.max()))
+        return rows
+
+    def report(self, title=None):
+        if title:
+            print(title)
+        print(f"{'stage':<24}{'n':>8}{'mean ms':>12}{'p50 ms':>12}{'p95 ms':>12}{'max ms':>12}")
+        for stage, n, mean, p50, p95, mx in self.summary():
+            print(f"{stage:<24}{n:>8}{mean:>12.2f}{p50:>12.2f}{p95:>12.2f}{mx:>12.2f}")
+
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(str(path)):
+        for f in files:
+            total += os.path.getsize(os.path.join(root, f))
+    return total
@@ -0,0 +1,54 @@
+"""Encode/decode time and size of the depth codecs against the default PNG path.
+
+    python -m benchmarks.depth_codec --frames 20
+    python -m benchmarks.depth_codec --source replay --replay saved_data/<session>/<serial>
+"""
+import argparse
+
+import numpy as np
+
+from benchmarks.common import StageTimer, sizeof_fmt
+from rs_store.save import COMPRESSORS, decode_img, encode_img
+from rs_store.sources import ReplaySource, SyntheticSource
+
+DEFAULT_CODECS = ["png", "png:1"] + [f"rsd-{c}" for c in COMPRESSORS] + ["rsd-zlib:6"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", default="synthetic", choices=["synthetic", "replay"])
+    parser.add_argument("--replay", default=None, help="Saved session directory to replay")
+    parser.add_argument("--stream", default="depth", choices=["depth", "aligned_depth"])
+    parser.add_argument("--frames", default=20, type=int)
+    parser.add_argument("--codecs", nargs="+", default=DEFAULT_CODECS)
+    args = parser.parse_args()
+
+    if args.source == "replay":
+        source = ReplaySource(args.replay, loop=True)
+    else:
+        source = SyntheticSource(fps=0)
+    source.require(save=[args.stream])
+    images = [getattr(source.get_frames(), args.stream) for _ in range(args.frames)]
+
+    timer = StageTimer()
+    sizes = {}
+    for codec in args.codecs:
+        sizes[codec] = []
+        for im in images:
+            with timer.time(f"{codec} encode"):
+                b = encode_img(im, codec)
+            with timer.time(f"{codec} decode"):
+                decoded = decode_img(b)
+            if not np.array_equal(decoded, im):
+                raise AssertionError(f"{codec} is not lossless")
+            sizes[codec].append(len(b))
+
+    timer.report(f"{args.stream} {images[0].shape} from {args.source}, {len(images)} frames")
+    raw = images[0].nbytes
+    print(f"\n{'codec':<16}{'bytes/frame':>14}{'ratio':>8}")
+    for codec, values in sizes.items():
+        print(f"{codec:<16}{sizeof_fmt(np.mean(values)):>14}{raw / np.mean(values):>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Captures/s and MB/s of the writer's durability policies against writing files straight to their final names.
+
+    python -m benchmarks.durability --captures 100 --threads 4
+    python -m benchmarks.durability --out /mnt/ssd/bench --policies direct none capture 10 100
+
+Run it on the disk being recorded to, fsync costs depend far more on the device than on this code.
+"""
+import argparse
+import pathlib
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.common import StageTimer, directory_size, sizeof_fmt
+from rs_store.data import RAW_STREAMS
+from rs_store.sources import SyntheticSource
+from rs_store.utils import format_capture_name, get_str_datetime
+from rs_store.writer import Writer
+
+DEFAULT_POLICIES = ["direct", "none", "capture", "10", "100"]
+
+
+def run(policy, captures, out, threads, codec):
+    timer = StageTimer()
+    writer = Writer(workers=threads, durability="none" if policy == "direct" else policy)
+    sealed = {}
+
+    def published(tasks, idx):
+        timer.add("seal -> publish", time.perf_counter() - sealed[idx])
+
+    start = time.perf_counter()
+    for idx, capture in enumerate(captures):
+        time_str = get_str_datetime()
+        key = None if policy == "direct" else idx
+        for stream, data in capture.items():
+            writer.submit(out / format_capture_name(idx, time_str, stream), data, stream=stream, capture=key,
+                          codec=codec if stream in ("depth", "aligned_depth") else None)
+        if key is not None:
+            sealed[idx] = time.perf_counter()
+            writer.seal(key, lambda tasks, idx=idx: published(tasks, idx))
+    writer.close()
+    elapsed = time.perf_counter() - start
+    return elapsed, directory_size(out), writer.syncs, timer
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--captures", default=100, type=int)
+    parser.add_argument("--threads", default=4, type=int)
+    parser.add_argument("--policies", nargs="+", default=DEFAULT_POLICIES,
+                        help="direct (no temporary names), none, capture or milliseconds between group commits")
+    parser.add_argument("--codec", default="rsd-zlib:1", help="Depth codec, cheap so writing dominates")
+    parser.add_argument("--out", default=None, help="Directory to write to (defaults to a temporary directory)")
+    args = parser.parse_args()
+
+    source = SyntheticSource(fps=0)
+    source.require(save=RAW_STREAMS)
+    unique = []
+    for _ in range(min(args.captures, 10)):
+        frames = source.get_frames()
+        unique.append({k: getattr(frames, k) for k in RAW_STREAMS if isinstance(getattr(frames, k), np.ndarray)})
+    captures = [unique[i % len(unique)] for i in range(args.captures)]
+
+    root = pathlib.Path(args.out or tempfile.mkdtemp(prefix="rs_store_durability_"))
+    print(f"{args.captures} captures of {', '.join(captures[0])} with {args.threads} threads in {root}")
+    print(f"{'policy':<10}{'captures/s':>12}{'MB/s':>10}{'syncs':>8}{'publish p50 ms':>16}{'publish p95 ms':>16}")
+    try:
+        for policy in args.policies:
+            out = root / policy
+            out.mkdir(parents=True, exist_ok=True)
+            elapsed, size, syncs, timer = run(policy, captures, out, args.threads, args.codec)
+            latency = np.asarray(timer.samples.get("seal -> publish", [np.nan])) * 1000
+            print(f"{policy:<10}{args.captures / elapsed:>12.1f}{size / elapsed / 1e6:>10.1f}{syncs:>8}"
+                  f"{np.percentile(latency, 50):>16.2f}{np.percentile(latency, 95):>16.2f}")
+            shutil.rmtree(str(out))
+        print(f"Wrote {sizeof_fmt(size)} per policy")
+    finally:
+        if args.out is None:
+            shutil.rmtree(str(root), ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
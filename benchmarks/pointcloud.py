@@ -0,0 +1,46 @@
+"""Points/s of depth deprojection with the cached ray grid against recomputing it every frame.
+
+    python -m benchmarks.pointcloud --frames 20
+"""
+import argparse
+import time
+
+from benchmarks.common import StageTimer
+from rs_store.pointcloud import _ray_grid, deproject, point_cloud
+from rs_store.sources import ReplaySource, SyntheticSource
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", default="synthetic", choices=["synthetic", "replay"])
+    parser.add_argument("--replay", default=None, help="Saved session directory to replay")
+    parser.add_argument("--frames", default=20, type=int)
+    args = parser.parse_args()
+
+    source = ReplaySource(args.replay, loop=True) if args.source == "replay" else SyntheticSource(fps=0)
+    source.require(save=["aligned_depth", "colour", "meta"])
+    frames = [source.get_frames() for _ in range(args.frames)]
+    frames = [(f.aligned_depth, f.colour, f.meta["aligned_depth_intrinsics"]) for f in frames]
+
+    timer = StageTimer()
+    points = {"cached": 0, "uncached": 0, "coloured cloud": 0}
+    start = {}
+    for name in points:
+        start[name] = time.perf_counter()
+        for depth, colour, intrinsics in frames:
+            if name == "uncached":
+                _ray_grid.cache_clear()
+            with timer.time(name):
+                if name == "coloured cloud":
+                    points[name] += len(point_cloud(depth, intrinsics, colour))
+                else:
+                    points[name] += deproject(depth, intrinsics).shape[0] * depth.shape[1]
+        start[name] = time.perf_counter() - start[name]
+
+    timer.report(f"{frames[0][0].shape} depth from {args.source}, {len(frames)} frames")
+    for name, n in points.items():
+        print(f"{name:<16}{n / start[name] / 1e6:>10.1f} Mpoints/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Time to first frame from a fresh process and time to recover a source after a reset.
+
+Each start runs in a new interpreter, like a supervisor restarting main.py, so imports are included. Recovery is a
+hardware reset for a camera and a stop/start for the synthetic source.
+
+    python -m benchmarks.startup --runs 5
+    python -m benchmarks.startup --source realsense --runs 3 --recoveries 3
+"""
+import argparse
+import json
+import pathlib
+import subprocess
+import sys
+import time
+
+from benchmarks.common import StageTimer
+
+CHILD = """
+import json, time
+start = time.perf_counter()
+from rs_store.sources import make_source
+imported = time.perf_counter()
+source = make_source({source!r}, config_path={config!r})
+opened = time.perf_counter()
+source.get_frames()
+first = time.perf_counter()
+print(json.dumps({{"import": imported - start, "open": opened - imported, "first_frame": first - opened,
+                  "interpreter_to_first": first - start}}))
+source.stop()
+"""
+
+
+def time_to_first_frame(source, config, timer):
+    launched = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", CHILD.format(source=source, config=config)],
+                            capture_output=True, text=True, check=True)
+    total = time.perf_counter() - launched
+    stages = json.loads(result.stdout.strip().splitlines()[-1])
+    for stage in ("import", "open", "first_frame"):
+        timer.add(stage, stages[stage])
+    timer.add("total to first frame", total)
+
+
+def time_to_recover(source, timer):
+    with timer.time("recover"):
+        if hasattr(source, "reset"):
+            source.stop()
+            source.reset()
+            source.start()
+        else:
+            source.stop()
+            source.start()
+        source.get_frames()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", default="synthetic", choices=["synthetic", "realsense"])
+    parser.add_argument("--config", default=str(pathlib.Path(__file__).parent.parent / "configs/default.yaml"))
+    parser.add_argument("--runs", default=5, type=int, help="Fresh processes started")
+    parser.add_argument("--recoveries", default=5, type=int, help="Resets of one source")
+    args = parser.parse_args()
+
+    timer = StageTimer()
+    for _ in range(args.runs):
+        time_to_first_frame(args.source, args.config, timer)
+
+    from rs_store.sources import make_source
+    source = make_source(args.source, config_path=args.config)
+    source.get_frames()
+    for _ in range(args.recoveries):
+        time_to_recover(source, timer)
+    source.stop()
+    timer.report(f"Start up and recovery of the {args.source} source")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,89 @@
+import argparse
+import hashlib
+import os
 import pathlib
 
 import cv2
 from raytils.ui.selection import get_selection_from_list
 
+from rs_store.catalog import CATALOG_FILE, Catalog
+from rs_store.playback import Player, catalog_refs, for_display, session_refs
+
+STREAM_KEYS = {ord('1'): "colour", ord('2'): "aligned_depth_cm", ord('3'): "depth", ord('4'): "ir_left",
+               ord('5'): "ir_right"}
+# Thumbnails are cached outside saved_data so browsing never adds to a session (or its storage budget)
+THUMBNAIL_CACHE = pathlib.Path(os.environ.get("RS_STORE_THUMBNAIL_CACHE",
+                                              pathlib.Path.home() / ".cache" / "rs_store" / "thumbnails"))
+HELP = "q: quit, space: pause, r: reverse, a/d: step back/forward, [/]: slower/faster, 1-5: colour/depth_cm/depth/ir"
+
 
 def main():
-    folders = [x for x in (pathlib.Path(__file__).parent / "saved_data").glob('*') if x.is_dir()]
-    selection = get_selection_from_list(folders)
-    images = list(x for x in selection.glob("*") if x.is_file())
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", default=str(pathlib.Path(__file__).parent / "saved_data"))
+    parser.add_argument("--stream", default="colour", choices=sorted(set(STREAM_KEYS.values())))
+    parser.add_argument("--thumbnail-width", default=960, type=int, help="Downscale frames to this width (0 for off)")
+    parser.add_argument("--thumbnail-cache", default=str(THUMBNAIL_CACHE),
+                        help="Directory thumbnails are kept in between runs (empty to keep them in memory only)")
+    parser.add_argument("--cache-mb", default=256, type=float)
+    parser.add_argument("--threads", default=4, type=int)
+    args = parser.parse_args()
+
+    root = pathlib.Path(args.root)
+    if (root / CATALOG_FILE).exists():
+        # Indexed by main.py (or python -m rs_store.catalog rebuild), no directory listing needed
+        catalog = Catalog(root)
+        selection = get_selection_from_list(catalog.sessions())
+        get_refs = lambda stream: catalog_refs(catalog, selection, stream)
+        session_path = root / selection
+    else:
+        folders = [x for x in root.glob('*') if x.is_dir()]
+        selection = get_selection_from_list(folders)
+        get_refs = lambda stream: session_refs(selection, stream)
+        session_path = pathlib.Path(selection)
 
-    criteria = lambda x: str(x).endswith("colour.png")
-    filtered_images = list(filter(criteria, images))
-    filtered_images = sorted(filtered_images, key=lambda x: x.name)
+    thumbnail_dir = None
+    if args.thumbnail_cache:
+        # One directory per session, named after it plus a hash of its path so equally named sessions do not clash
+        digest = hashlib.sha1(str(session_path.resolve()).encode()).hexdigest()[:8]
+        thumbnail_dir = pathlib.Path(args.thumbnail_cache) / f"{session_path.name}_{digest}"
+
+    def make_player(stream):
+        return Player(get_refs(stream), stream=stream, workers=args.threads, cache_mb=args.cache_mb,
+                      thumbnail_width=args.thumbnail_width or None, thumbnail_dir=thumbnail_dir)
 
     interval = 15
     minutes_per_second = 5
     rate = int(((1 / minutes_per_second) / (60 / interval)) * 1000)
     cv2.namedWindow('Realsense Capture Browser', cv2.WINDOW_FREERATIO)
+    print(HELP)
 
-    for im_path in filtered_images:
-        im = cv2.imread(str(im_path))
-        cv2.imshow('Realsense Capture Browser', im)
-        if cv2.waitKey(rate) == ord('q'):
+    player = make_player(args.stream)
+    paused = False
+    while len(player):
+        im = for_display(player.stream, player.current())
+        if im is not None:
+            cv2.imshow('Realsense Capture Browser', im)
+        key = cv2.waitKey(0 if paused else max(rate, 1)) & 0xFF
+        if key == ord('q'):
+            break
+        elif key == ord(' '):
+            paused = not paused
+        elif key == ord('r'):
+            player.reverse()
+        elif key in (ord('a'), ord('d')):
+            player.seek(player.position + (1 if key == ord('d') else -1))
+        elif key == ord('['):
+            rate = rate * 2
+        elif key == ord(']'):
+            rate = max(rate // 2, 1)
+        elif key in STREAM_KEYS and STREAM_KEYS[key] != player.stream:
+            position = player.position
+            player.close()
+            player = make_player(STREAM_KEYS[key])
+            player.seek(position)
+        elif not paused and not player.step():
             break
+    player.close()
 
 
 if __name__ == '__main__':
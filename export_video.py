@@ -0,0 +1,167 @@
+"""Export a saved session as a timelapse video.
+
+    python export_video.py saved_data/<session> --stream canvas --fps 30 --start 2021-04-01T06:00 --end 2021-04-01T18:00
+
+Frames are decoded in parallel but written in order with a bounded window so memory does not grow with the session.
+The video is written in chunks of --chunk-frames, finished chunks are recorded in progress.json next to the output so
+an interrupted export resumes from the first unfinished chunk. Chunks are joined with ffmpeg when it is installed.
+"""
+import argparse
+import hashlib
+import json
+import pathlib
+import shutil
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import cv2
+
+from rs_store.catalog import CATALOG_FILE, Catalog
+from rs_store.data import compose_canvas
+from rs_store.playback import catalog_captures, for_display, session_captures, session_serials
+from rs_store.utils import parse_str_datetime
+
+
+def in_range(time_str, start, end):
+    try:
+        t = parse_str_datetime(time_str)
+    except ValueError:
+        return True
+    return (start is None or t >= start) and (end is None or t <= end)
+
+
+def parse_time(value):
+    if value is None:
+        return None
+    return parse_str_datetime(value) if value.startswith("D") else datetime.fromisoformat(value)
+
+
+def render(loaders, stream):
+    if stream == "canvas":
+        images = {k: loaders[k]() if k in loaders else None
+                  for k in ("colour", "aligned_depth_cm", "ir_left", "ir_right")}
+        if images["colour"] is None or images["aligned_depth_cm"] is None:
+            return None
+        return compose_canvas(images["colour"], images["aligned_depth_cm"], images["ir_left"], images["ir_right"])
+    return for_display(stream, loaders[stream]()) if stream in loaders else None
+
+
+def ordered(executor, fn, items, window):
+    """executor.map with at most window results in flight"""
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def export(captures, out, stream="colour", fps=30, chunk_frames=1800, workers=4, fourcc="mp4v", size=None):
+    out = pathlib.Path(out)
+    parts_dir = out.parent / f"{out.stem}_parts"
+    parts_dir.mkdir(parents=True, exist_ok=True)
+    progress_path = parts_dir / "progress.json"
+    progress = json.loads(progress_path.read_text()) if progress_path.exists() else {}
+    # Everything that changes the encoded parts, the selected captures (start, end, every) by their keys
+    selection = hashlib.sha1("\n".join(key for key, _, _ in captures).encode()).hexdigest()
+    settings = {"stream": stream, "fps": fps, "chunk_frames": chunk_frames, "frames": len(captures), "fourcc": fourcc,
+                "size": None if size is None else list(size), "captures": selection}
+    if progress.get("settings") != settings:
+        progress = {"settings": settings, "done": []}
+    # Frames of every part are the size of the first one written, also when resuming
+    size = tuple(progress["size"]) if progress.get("size") else size
+
+    chunks = [captures[i:i + chunk_frames] for i in range(0, len(captures), chunk_frames)]
+    parts = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for n, chunk in enumerate(chunks):
+            part = parts_dir / f"part_{n:05d}{out.suffix}"
+            parts.append(part)
+            if n in progress["done"] and part.exists():
+                continue
+            video = None
+            written = 0
+            for image in ordered(executor, lambda c: render(c[2], stream), chunk, window=workers * 2):
+                if image is None:
+                    continue
+                if video is None:
+                    size = size or (image.shape[1], image.shape[0])
+                    progress["size"] = list(size)
+                    video = cv2.VideoWriter(str(part), cv2.VideoWriter_fourcc(*fourcc), fps, size)
+                if (image.shape[1], image.shape[0]) != size:
+                    image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+                video.write(image)
+                written += 1
+            if video is not None:
+                video.release()
+            progress["done"].append(n)
+            progress_path.write_text(json.dumps(progress))
+            print(f"Chunk {n + 1}/{len(chunks)}: {written} frames -> {part}")
+
+    parts = [p for p in parts if p.exists()]
+    if len(parts) == 1:
+        shutil.copyfile(str(parts[0]), str(out))
+    elif parts and shutil.which("ffmpeg"):
+        concat = parts_dir / "concat.txt"
+        concat.write_text("".join(f"file '{p.resolve()}'\n" for p in parts))
+        subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", str(concat),
+                        "-c", "copy", str(out)], check=True)
+    elif parts:
+        print(f"ffmpeg not found, the video is in {len(parts)} parts in {parts_dir}")
+        return parts_dir
+    print(f"Saved {out}")
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("session", help="Session directory (saved_data/<session> or a camera sub folder)")
+    parser.add_argument("--out", default=None, help="Video file (defaults to <session>_<stream>.mp4)")
+    parser.add_argument("--stream", default="colour", choices=["colour", "aligned_depth_cm", "depth", "ir_left",
+                                                               "canvas"])
+    parser.add_argument("--fps", default=30, type=float, help="Frame rate of the output video")
+    parser.add_argument("--every", default=1, type=int, help="Only use every n-th capture")
+    parser.add_argument("--start", default=None, help="ISO time of the first capture e.g. 2021-04-01T06:00")
+    parser.add_argument("--end", default=None, help="ISO time of the last capture")
+    parser.add_argument("--width", default=None, type=int, help="Resize frames to this width")
+    parser.add_argument("--chunk-frames", default=1800, type=int, help="Frames per resumable chunk")
+    parser.add_argument("--threads", default=4, type=int, help="Decode threads")
+    parser.add_argument("--fourcc", default="mp4v")
+    parser.add_argument("--serial", default=None, help="Camera to export from a multi-camera session (default: first)")
+    args = parser.parse_args()
+
+    session = pathlib.Path(args.session)
+    start, end = parse_time(args.start), parse_time(args.end)
+
+    # One camera per video, cameras of a session would otherwise be mixed into one
+    catalog = Catalog(session.parent) if (session.parent / CATALOG_FILE).exists() else None
+    serials = catalog.serials(session.name) if catalog is not None else session_serials(session)
+    serial = args.serial or next(iter(serials), None)
+    if catalog is not None:
+        captures = catalog_captures(catalog, session.name, start, end, serial=serial)
+    else:
+        captures = [c for c in session_captures(session, serial) if in_range(c[1], start, end)]
+    captures = captures[::args.every]
+    if not captures:
+        raise SystemExit(f"No captures of camera {serial} found in {session}" if serial else
+                         f"No captures found in {session}")
+    if len(serials) > 1:
+        print(f"Exporting camera {serial} of {', '.join(serials)}")
+
+    size = None
+    if args.width is not None:
+        first = next((image for image in (render(c[2], args.stream) for c in captures) if image is not None), None)
+        if first is None:
+            raise SystemExit(f"No capture of {session} has a {args.stream} image")
+        size = (args.width, int(round(first.shape[0] * args.width / first.shape[1])))
+    name = f"{session.resolve()}_{serial}" if len(serials) > 1 else str(session.resolve())
+    out = args.out or f"{name}_{args.stream}.mp4"
+    export(captures, out, stream=args.stream, fps=args.fps, chunk_frames=args.chunk_frames, workers=args.threads,
+           fourcc=args.fourcc, size=size)
+
+
+if __name__ == '__main__':
+    main()
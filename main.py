@@ -1,10 +1,12 @@
 import argparse
+import json
 import os
 import pathlib
 import shutil
 import time
 
-from rs_store.utils import get_str_datetime, get_new_save_path
+from rs_store.utils import format_capture_name, get_saved_data_root, get_str_datetime, get_new_save_path, \
+    parse_capture_name, sizeof_fmt
 
 try:
     import thread
@@ -13,10 +15,23 @@ except ImportError:
 
 from timeit import default_timer as timer
 
-from raytils.system import LoadBalancer
-
-from rs_store.camera import RealsenseD400Camera
-from rs_store.save import save
+import numpy as np
+
+from rs_store.catalog import Catalog
+from rs_store.config import Config
+from rs_store.container import ChunkedSessionWriter, chunk_name
+from rs_store.data import RAW_STREAMS, STREAMS
+from rs_store.filters import BACKENDS as FILTER_BACKENDS, PostProcessor
+from rs_store.gate import GATE_FILE, ChangeGate
+from rs_store.metastore import MetadataLog
+from rs_store.metrics import METRICS, serve as serve_metrics
+from rs_store.multi import MultiCamera
+from rs_store.pool import BufferPool
+from rs_store.save import file_name, parse_codec
+from rs_store.schedule import CaptureScheduler
+from rs_store.sources import SourceExhausted, make_source
+from rs_store.storage import StorageManager, session_time
+from rs_store.writer import POLICIES, Writer, clean_partial
 
 
 save_path = get_new_save_path()
@@ -31,81 +46,122 @@ def log(*args, **kwargs):
     print(*args, **kwargs)
 
 
-def health_check(url, job_meta=None):
-    try:
-        attempt = 0
-        while attempt <= 3:
-            import socket
-            import urllib.request
-            try:
-                urllib.request.urlopen(url, timeout=10)
-                return True
-            except socket.error as e:
-                print(f"Ping attempt {attempt} failed: {e}")
-            attempt += 1
-    except Exception as e:
-        print(f"Failed to send health check: {e}")
-    return False
+def on_saved(slot):
+    # Return the pooled buffer once the writer is done with it
+    def done(task, ok):
+        slot.release()
+    return done
 
 
-def get_interfaces():
-    try:
-        import netifaces
+def on_published(catalog, metadata, session, serial, storage, idx, time_str, calibration, frame_info, files):
+    # Index the capture, log its metadata and count its bytes once its files are under their final names
+    def published(tasks):
+        for task in tasks:
+            stream = parse_capture_name(task.path)[2]
+            if catalog is not None:
+                catalog.add(session, serial, idx, time_str, stream, task.result)
+            if storage is not None and task.kwargs.get("store") is None:
+                storage.record(task.result)
+        written = {task.stream for task in tasks}
+        metadata.append(idx, time_str, serial, calibration, frame_info,
+                        {k: v for k, v in files.items() if k in written})
+    return published
 
-        extra_info = {}
 
-        try:
-            import socket
-            extra_info["HOST"] = socket.gethostname()
-        except Exception as e:
-            print("Could not get hostname")
-
-        for interface in netifaces.interfaces():
-            try:
-                for link in netifaces.ifaddresses(interface)[netifaces.AF_INET]:
-                    extra_info[f"IP {interface}"] = link['addr']
-            except Exception as e:
-                print(f"Could not get interface {interface}")
-        return extra_info
-    except Exception as e:
-        print("Could not get network interfaces")
-        return {}
+def log_capture_group(path, idx, time_str, group):
+    with path.open('a') as fh:
+        fh.write(json.dumps({"idx": idx, "time": time_str, "timestamps": group.timestamps, "skew_ms": group.skew_ms,
+                             "synced": group.synced}) + "\n")
 
 
-def msteams_notification(url, title, extra_info=None, job_meta=None):
-    try:
-        import pymsteams
-        extra_info = extra_info or {}
-        extra_info.update(get_interfaces())
-        teams_message = pymsteams.connectorcard(url)
-        teams_message.title(title)
-        teams_message.text(" " + ',   \n'.join([f"{k}: {v}" for k, v in extra_info.items()]))
-        teams_message.send()
-    except Exception as e:
-        print(f"Failed to send notification: {e}")
-
-
-def sizeof_fmt(num, suffix='B'):
-    for unit in ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi']:
-        if abs(num) < 1024.0:
-            return "%3.1f%s%s" % (num, unit, suffix)
-        num /= 1024.0
-    return "%.1f%s%s" % (num, 'Yi', suffix)
+def get_codecs(config, depth_codec=None):
+    codecs = dict(config["codecs"]) if config.has_key("codecs") else {}
+    if depth_codec is not None:
+        codecs.update(depth=depth_codec, aligned_depth=depth_codec)
+    for codec in codecs.values():
+        parse_codec(codec)  # Fail on startup rather than in a writer thread
+    return codecs
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--visualise", action='store_true', default=False, help="Show the current frames")
+    parser.add_argument("--display-fps", default=15, type=float,
+                        help="Maximum rate the preview window is redrawn at, newer frames replace ones not yet shown")
     parser.add_argument("--save", action='store_true', default=False, help="Save the current frames")
+    parser.add_argument("--raw-only", action='store_true', default=False,
+                        help="Save only depth, colour, IR and calibration, rebuild aligned depth later with "
+                             "python -m rs_store.align")
     parser.add_argument("--interval", default='Inf', help="Number of seconds to wait between captures")
+    parser.add_argument("--schedule", default="clock", choices=["clock", "loop"],
+                        help="With a finite --interval, 'clock' captures at wall clock multiples of the interval and "
+                             "only drains the camera in between, 'loop' reads every frame (always used with "
+                             "--visualise)")
+    parser.add_argument("--warmup", default=0.5, type=float,
+                        help="Seconds of frames read before each scheduled capture so exposure and filters settle")
+    parser.add_argument("--schedule-offset", default=0, type=float,
+                        help="Seconds after each interval boundary scheduled captures happen at")
     parser.add_argument("--config", default=None, help="Config json file saved from realsense-viewer")
     parser.add_argument("--threads", default=1, help="Number of threads to use for writing to disk")
+    parser.add_argument("--workers", default="thread", choices=["thread", "process"],
+                        help="Write to disk from threads or from processes (arrays are passed in shared memory)")
+    parser.add_argument("--queue-mb", default=512, type=float, help="Maximum megabytes of frames waiting to be saved")
+    parser.add_argument("--pool-size", default=4, type=int,
+                        help="Pre-allocated capture buffers per camera, captures wait for one with --overflow block, "
+                             "otherwise they are copied and --queue-mb bounds memory")
+    parser.add_argument("--overflow", default="block", choices=list(POLICIES),
+                        help="What to do with new frames when the save queue is full")
     parser.add_argument("--out", default=None, help="Directory to save files in")
     parser.add_argument("--webhook", default=None, help="URL of MS Teams WebHook")
     parser.add_argument("--health", default=None, help="URL of HealthCheck.io")
+    parser.add_argument("--metrics-port", default=None, type=int,
+                        help="Serve Prometheus metrics at http://127.0.0.1:<port>/metrics")
+    parser.add_argument("--metrics-interval", default=60, type=float,
+                        help="Seconds between metric summaries written to the log (0 disables them)")
+    parser.add_argument("--heartbeat-interval", default=60, type=float,
+                        help="Send at most one health check every this many seconds")
+    parser.add_argument("--notify-interval", default=300, type=float,
+                        help="Send at most one 'Data Collected' notification every this many seconds")
+    parser.add_argument("--source", default="realsense", choices=["realsense", "synthetic", "replay"],
+                        help="Where frames come from (synthetic and replay do not need a camera)")
+    parser.add_argument("--replay", default=None, nargs="+",
+                        help="Saved session directories to read when --source replay (one per camera)")
+    parser.add_argument("--serials", default=None, nargs="+",
+                        help="Serial numbers of the cameras to capture from in this process (overrides config serial)")
+    parser.add_argument("--filter-backend", default=None, choices=list(FILTER_BACKENDS),
+                        help="Implementation of the depth filters in the config (overrides filters: backend)")
+    parser.add_argument("--sync-tolerance", default=20, type=float,
+                        help="Maximum timestamp difference in ms between cameras in one capture")
+    parser.add_argument("--storage", default="files", choices=["files", "chunked"],
+                        help="Save one file per stream per capture or append to a chunked session container")
+    parser.add_argument("--chunk-size", default=100, type=int, help="Captures per chunk file with --storage chunked")
+    parser.add_argument("--catalog", default=None,
+                        help="Directory of the catalog.sqlite indexing saved captures (defaults to the parent of --out)")
+    parser.add_argument("--storage-root", default=None,
+                        help="Directory of sessions kept within --budget-gb and thinned/compacted (defaults to "
+                             "saved_data), only session directories in it are ever removed")
+    parser.add_argument("--budget-gb", default=None, type=float,
+                        help="Keep --storage-root (saved_data by default) under this size (see README)")
+    parser.add_argument("--min-free-gb", default=None, type=float,
+                        help="Keep at least this much space free on the volume being saved to")
+    parser.add_argument("--thin-after-hours", default=None, type=float,
+                        help="Thin sessions older than this to one capture per --thin-every seconds")
+    parser.add_argument("--thin-every", default=3600, type=float, help="Seconds between captures kept when thinning")
+    parser.add_argument("--compact-after-hours", default=None, type=float,
+                        help="Pack sessions older than this into <session>.tar.gz archives")
+    parser.add_argument("--gate-threshold", default=None, type=float,
+                        help="Only save captures that changed by more than this percent since the last saved one")
+    parser.add_argument("--gate-keyframe", default=60, type=int,
+                        help="With --gate-threshold, save at least every this many captures regardless of change")
+    parser.add_argument("--gate-streams", default="colour,depth",
+                        help="Comma separated streams compared by the change gate (colour, depth)")
+    parser.add_argument("--durability", default="none",
+                        help="When captures are synced to disk before being published: none (rename only), capture "
+                             "(fsync every capture) or a number of milliseconds to sync captures in groups")
+    parser.add_argument("--depth-codec", default=None,
+                        help="Codec for depth and aligned_depth e.g. png, png:1, rsd, rsd-zstd:3 (overrides config)")
     args = parser.parse_args()
 
-    # TODO: ADD FILTERS
     if args.out is not None:
         global save_path
         global log_file
@@ -113,6 +169,7 @@ def main():
         log_file = save_path / "log.txt"
     if args.config is None:
         args.config = pathlib.Path(__file__).parent / "configs/default.yaml"
+    dispatcher = None
     if args.save:
         global save_log
         save_log = True
@@ -121,80 +178,229 @@ def main():
         idx = 0
         n_threads = int(args.threads) or 1
         assert n_threads > 0
-        load_balancer = LoadBalancer(maxsize=80, threads=n_threads, auto=n_threads > 1)
+        if args.workers == "process" and args.storage == "chunked":
+            parser.error("--storage chunked needs --workers thread")
+        try:
+            writer = Writer(workers=n_threads, mode=args.workers, max_bytes=args.queue_mb * 1024 * 1024,
+                            policy=args.overflow, durability=args.durability)
+        except ValueError as e:
+            parser.error(str(e))
+        if args.health or args.webhook:
+            # Notifications run on their own event loop thread so they never wait behind (or hold up) image writes
+            from rs_store.notify import Dispatcher
+            dispatcher = Dispatcher(health_url=args.health, webhook_url=args.webhook,
+                                    heartbeat_interval=args.heartbeat_interval, notify_interval=args.notify_interval)
     args.interval = float(args.interval)
+    config = Config(args.config)
+    codecs = get_codecs(config, args.depth_codec)
     camera = None
+    pool = None
+    catalog = None
+    storage = None
+    gate = None
+    metadata = None
+    scheduler = None
+    stores = {}
 
     save_on_space_key = args.save and args.visualise
     if save_on_space_key:
         log("Press space in the display window to save to disk.")
 
     try:
-        camera = RealsenseD400Camera(config_path=args.config, visualise=args.visualise)
+        if args.source == "replay":
+            sources = [dict(replay=r) for r in (args.replay or [None])]
+        else:
+            serials = args.serials or (config.serial if config.has_key("serial") else None)
+            serials = serials if isinstance(serials, list) else [serials]
+            sources = [dict(serial_number=None if s is None else str(s)) for s in serials]
+        multi = len(sources) > 1
+        # With several cameras each one is captured on its own thread and only the group is shown
+        camera = MultiCamera([make_source(args.source, config_path=args.config, visualise=args.visualise and not multi,
+                                          **kwargs) for kwargs in sources],
+                             tolerance_ms=args.sync_tolerance, visualise=args.visualise)
+        for source in camera.sources:
+            source.post = PostProcessor.from_config(config, backend=args.filter_backend)
+            source.display_fps = args.display_fps
+            if source.post is not None and source.post.backend == "numpy" and source.post.stage == "before_align" \
+                    and not source.aligns_filtered_depth:
+                # aligned_depth would come from unfiltered depth while depth is saved filtered
+                parser.error(f"NumPy depth filters can not run before alignment with --source {args.source}, use "
+                             f"stage: after_align or --filter-backend realsense")
+        # Streams are computed lazily, only what is saved or shown is ever aligned/colourised/converted
+        # Per frame metadata goes to the session's metadata log (rs_store.metastore) rather than a file per capture
+        saved_streams = [k for k in (RAW_STREAMS if args.raw_only else STREAMS) if k != "meta"]
+        camera.require(save=saved_streams if args.save else ())
+        if args.save:
+            pool = BufferPool.from_config(config, size=args.pool_size * len(sources), shared=args.workers == "process")
+            log(f"Allocated {pool.size} capture buffers of {sizeof_fmt(pool.slot_bytes)}")
         last_capture = timer()
+        last_metrics = timer()
+        if args.metrics_port:
+            serve_metrics(args.metrics_port)
+            log(f"Serving metrics at http://127.0.0.1:{args.metrics_port}/metrics")
 
         shutdown = False
-        if args.webhook and args.save:
-            load_balancer.add_task(msteams_notification, (args.webhook, "Connected"))
+        if dispatcher is not None:
+            dispatcher.notify("Connected", urgent=True)
 
         if args.save:
-            save_path = save_path / f"{camera.serial_number}"
-            if not save_path.exists():
-                save_path.mkdir(parents=True)
-            log("Saving images to {}".format(save_path.resolve()))
+            # Files of captures that were never published, from a crash or power cut of this or the last session. Only
+            # the camera directories written to and timestamp named sessions are swept, --out can be anywhere
+            previous = sorted((p for p in save_path.parent.iterdir() if p.is_dir() and p != save_path and
+                               session_time(p) is not None), key=session_time)[-1:]
+            removed = sum(clean_partial(p) for p in [save_path / s for s in camera.serial_numbers] + previous)
+            if removed:
+                log(f"Removed {removed} unpublished files of interrupted captures")
+            catalog = Catalog(args.catalog or save_path.parent)
+            metadata = MetadataLog(save_path)
+            camera_paths = {serial: save_path / serial for serial in camera.serial_numbers}
+            for serial, path in camera_paths.items():
+                if not path.exists():
+                    path.mkdir(parents=True)
+                log("Saving images to {}".format(path.resolve()))
+                if args.storage == "chunked":
+                    stores[serial] = ChunkedSessionWriter(path, chunk_size=args.chunk_size)
+            if any(v is not None for v in (args.budget_gb, args.min_free_gb, args.thin_after_hours,
+                                           args.compact_after_hours)):
+                gb = 1024 ** 3
+                storage = StorageManager(args.storage_root or get_saved_data_root(),
+                                         budget_bytes=args.budget_gb and args.budget_gb * gb,
+                                         min_free_bytes=args.min_free_gb and args.min_free_gb * gb,
+                                         thin_after_hours=args.thin_after_hours, thin_every=args.thin_every,
+                                         compact_after_hours=args.compact_after_hours, active=save_path,
+                                         catalog=catalog, busy=lambda: writer.qsize() > 0)
+                for store in stores.values():
+                    storage.watch(store)
+                storage.start()
+            if args.gate_threshold is not None:
+                gate = ChangeGate(threshold=args.gate_threshold, keyframe_every=args.gate_keyframe,
+                                  streams=[s.strip() for s in args.gate_streams.split(",") if s.strip()])
+
+            if args.schedule == "clock" and 0 < args.interval < float("inf"):
+                if args.visualise:
+                    log("The preview needs every frame, capturing with --schedule loop")
+                else:
+                    scheduler = CaptureScheduler(args.interval, warmup=args.warmup, offset=args.schedule_offset)
+                    log(f"Capturing every {args.interval}s on the clock, next at "
+                        f"{time.strftime('%H:%M:%S', time.localtime(scheduler.next_deadline()))}")
 
         while not shutdown:
             time_since_last_capture = timer() - last_capture
             start_capture = timer()
 
-            frames, key_code = camera.get_frames(return_key=True)
-
-            if args.save and time_since_last_capture > args.interval or (save_on_space_key and key_code == 32):
+            if scheduler is not None:
+                scheduler.wait(camera)
+            group, key_code = camera.get_frames(return_key=True)
+            if scheduler is not None:
+                scheduler.captured(group.timestamp)
+
+            save_now = args.save and (scheduler is not None or time_since_last_capture > args.interval) or \
+                (save_on_space_key and key_code == 32)
+            if save_now and gate is not None:
+                decision = gate.decide(group, force=save_on_space_key and key_code == 32)
+                gate.record(save_path / GATE_FILE, decision, idx=idx if decision.saved else None)
+                if not decision.saved:
+                    # Still counts as a capture for the interval, it just was not worth writing
+                    last_capture = timer()
+                    save_now = False
+
+            if save_now:
                 last_capture = timer()
                 time_str = get_str_datetime()
-                if not save_path.exists():
-                    save_path.mkdir(parents=True)
-                for k in ["colour", "depth", "aligned_depth", "aligned_depth_cm", "ir_left", "ir_right", "meta"]:
-                    data = getattr(frames, k)
-                    if data is None:
-                        continue
-                    load_balancer.add_task(save, (save_path / f"{idx:07d}_{time_str}_{k}", data), {})
-
-                log(f"Saving queue_size={load_balancer.qsize()}, iter={idx:07d} "
-                    f"tps={load_balancer.tasks_per_second.get_fps()}")
-                if args.health:
-                    load_balancer.add_task(health_check, (args.health,))
-                if args.webhook:
-                    extra_info = {"serial": camera.serial_number, "capture_number": idx, "time": time_str}
+                for serial, frames in group.items():
+                    path = camera_paths[serial]
+                    if not path.exists():
+                        path.mkdir(parents=True)
+                    # Each image is copied once into a pooled buffer which goes back to the pool when it is written.
+                    # Only the block policy waits for one, the others leave a full queue to the writer's policy
+                    slot = pool.acquire(timeout=None if args.overflow == "block" else 0, fallback=True)
+                    store = stores.get(serial)
+                    files = {}
+                    for k in saved_streams:
+                        data = getattr(frames, k)
+                        if data is None:
+                            continue
+                        name = format_capture_name(idx, time_str, k)
+                        files[k] = chunk_name(idx // store.chunk_size) if store is not None else \
+                            pathlib.Path(file_name(name, data, codecs.get(k))).name
+                        if isinstance(data, np.ndarray):
+                            data = slot.put(k, data)
+                        slot.retain()
+                        writer.submit(path / name, data, stream=k, store=store, codec=codecs.get(k),
+                                      on_done=on_saved(slot), shared=slot.shared_ref(k), capture=(serial, idx))
+                    slot.release()
+                    # Nothing is indexed or logged until every file of the capture is published
+                    writer.seal((serial, idx), on_published(catalog, metadata, save_path.name, serial, storage, idx,
+                                                            time_str, frames.calibration, frames.frame_info, files))
+                for source in camera.sources:
+                    if source.post is not None:
+                        source.post.log_summary()
+                if multi:
+                    log_capture_group(save_path / "captures.jsonl", idx, time_str, group)
+
+                stats = writer.stats()
+                gate_info = f" gate_skipped={gate.skipped}" if gate is not None else ""
+                if scheduler is not None:
+                    gate_info += f" late={scheduler.jitter[-1] * 1000:.1f}ms missed={scheduler.missed}"
+                log(f"Saving queue_size={stats['queue_size']}, queue_bytes={sizeof_fmt(stats['queue_bytes'])}, "
+                    f"iter={idx:07d} tps={writer.tasks_per_second():.1f} dropped={stats['dropped']} "
+                    f"{stats['dropped_by_stream'] or ''}{gate_info}")
+                if args.health and dispatcher is not None:
+                    dispatcher.heartbeat(capture_number=idx, queue_size=stats['queue_size'], dropped=stats['dropped'])
+                if args.webhook and dispatcher is not None:
+                    extra_info = {"serial": ", ".join(camera.serial_numbers), "capture_number": idx, "time": time_str}
                     try:
-                        total, used, free = shutil.disk_usage("/")
+                        # The volume being saved to, not necessarily the one "/" is on
+                        total, used, free = shutil.disk_usage(str(save_path))
                         extra_info.update({
                             "total_space": sizeof_fmt(total),
                             "used_space": sizeof_fmt(used),
                             "free_space": sizeof_fmt(free),
                         })
+                        if storage is not None:
+                            extra_info["saved_data"] = sizeof_fmt(storage.used_bytes)
                     except Exception as e:
-                        print("Could not get '/' disk space:", e)
+                        print(f"Could not get disk space of {save_path}:", e)
 
-                    load_balancer.add_task(msteams_notification, (args.webhook, "Data Collected", extra_info))
+                    dispatcher.notify("Data Collected", extra_info)
                 idx += 1
 
-            if args.interval > 0 and args.interval != float("inf"):
+            if args.metrics_interval and timer() - last_metrics > args.metrics_interval:
+                last_metrics = timer()
+                log("Metrics:\n  " + "\n  ".join(METRICS.summary()))
+
+            if scheduler is None and args.interval > 0 and args.interval != float("inf"):
                 time_to_sleep = args.interval - (timer() - start_capture)
                 if time_to_sleep > 0:
                     print("Sleeping for {} seconds".format(time_to_sleep))
                     time.sleep(time_to_sleep)
 
+    except SourceExhausted as e:
+        log(e)
     except Exception as e:
-        if args.webhook and args.save:
-            load_balancer.add_task(msteams_notification, (args.webhook, "Error"))
+        if dispatcher is not None:
+            dispatcher.notify("Error", {"error": str(e)}, urgent=True)
         print("Exception:", e)
     finally:
         try:
+            if scheduler is not None:
+                log(f"Schedule: {scheduler.stats()}")
             if camera is not None:
                 camera.stop()
             if args.save:
-                load_balancer.join()
+                writer.close()
+                if pool is not None:
+                    pool.close()
+            if dispatcher is not None:
+                dispatcher.close()
+            if storage is not None:
+                storage.close()
+            for store in stores.values():
+                store.close()
+            if metadata is not None:
+                metadata.close()
+            if catalog is not None:
+                catalog.close()
         except Exception as e:
             print("Could not cleanly exit")
             os._exit(1)
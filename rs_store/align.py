@@ -0,0 +1,259 @@
+"""Rebuild aligned_depth and aligned_depth_cm offline for sessions recorded with main.py --raw-only.
+
+    python -m rs_store.align saved_data/<session> --workers 8
+    python -m rs_store.align saved_data/<session> --compare   # check against streams recorded by the live path
+
+Aligned depth follows rs.align (align_z_to_other): every depth pixel's corners are deprojected with the depth
+intrinsics, moved into the colour camera with depth_to_colour_extrinsics, projected with the colour intrinsics and
+the covered colour pixels take the nearest depth. Colourised depth uses rs.colorizer's defaults, histogram equalised
+Jet with the same 4000 entry colour table, in the same channel order as the live colorizer output.
+
+Tolerance against the live path: aligned depth is the same computation in float32, so pixels only differ where a
+projected corner lands within float rounding of a pixel boundary, at most 1% of valid pixels with every other pixel
+equal. Colourised depth of the same aligned depth is within one colour table step (a few levels per channel). The
+colour projection ignores distortion like rs.align (D400 colour coefficients are zero). Use --compare on a session
+recorded without --raw-only to measure both.
+"""
+import argparse
+import os
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from rs_store.catalog import CATALOG_FILE, Catalog
+from rs_store.container import ChunkedSessionReader, ChunkedSessionWriter, chunk_name, is_container
+from rs_store.metastore import MetadataLog, find_metadata
+from rs_store.pointcloud import DEFAULT_DEPTH_SCALE, project, ray_grid, transform
+from rs_store.save import file_name
+from rs_store.sources import list_session, read_capture
+from rs_store.utils import format_capture_name, parse_capture_name
+from rs_store.writer import Writer
+
+DERIVED = ("aligned_depth", "aligned_depth_cm")
+# librealsense's Jet colour map control points (RGB) and table size
+JET = np.array([[0, 0, 255], [0, 255, 255], [255, 255, 0], [255, 0, 0], [50, 0, 0]], dtype=np.float64)
+COLOUR_MAP_SIZE = 4000
+
+
+def _colour_table(points=JET, size=COLOUR_MAP_SIZE):
+    positions = np.linspace(0, 1, len(points))
+    x = np.linspace(0, 1, size)
+    return np.stack([np.interp(x, positions, points[:, c]) for c in range(3)], axis=-1).astype(np.uint8)
+
+
+JET_TABLE = _colour_table()
+
+
+def colourise(depth, table=JET_TABLE):
+    """Histogram equalised colour map of a uint16 depth image, zero depth is black"""
+    hist = np.bincount(depth.ravel(), minlength=1 << 16)
+    hist[0] = 0
+    cumulative = np.cumsum(hist)
+    scale = (len(table) - 1) / max(int(cumulative[-1]), 1)
+    # A lookup per depth value rather than per pixel, then one gather for the image
+    lut = table[(cumulative * scale).astype(np.int64)]
+    lut[0] = 0
+    return lut[depth]
+
+
+def _corner_intrinsics(intrinsics, offset):
+    # Rays through pixel corners (x + offset, y + offset) come from the centre grid of shifted intrinsics
+    shifted = dict(intrinsics)
+    shifted["ppx"] = float(intrinsics["ppx"]) - offset
+    shifted["ppy"] = float(intrinsics["ppy"]) - offset
+    return shifted
+
+
+def align_depth(depth, meta):
+    """Depth (raw units) resampled onto the colour image, like rs.align(rs.stream.color)"""
+    depth_intrinsics = meta["depth_intrinsics"]
+    colour_intrinsics = meta["colour_intrinsics"]
+    extrinsics = meta["depth_to_colour_extrinsics"]
+    depth_scale = float(meta.get("depth_scale", DEFAULT_DEPTH_SCALE))
+    width, height = int(colour_intrinsics["width"]), int(colour_intrinsics["height"])
+
+    ys, xs = np.nonzero(depth)
+    values = depth[ys, xs]
+    z = (values * depth_scale).astype(np.float32)[:, None]
+    corners = []
+    for offset in (-0.5, 0.5):
+        rays = ray_grid(_corner_intrinsics(depth_intrinsics, offset))[ys, xs]
+        points = np.concatenate([rays.astype(np.float32) * z, z], axis=1)
+        pixels = project(transform(points, extrinsics), colour_intrinsics)
+        # int(v + 0.5) (truncating) as librealsense does, nan (behind the camera) becomes -1
+        corners.append(np.nan_to_num(pixels + 0.5, nan=-1).astype(np.int64))
+    (x0, y0), (x1, y1) = corners[0].T, corners[1].T
+    inside = (x0 >= 0) & (y0 >= 0) & (x1 < width) & (y1 < height) & (x1 >= x0) & (y1 >= y0)
+    x0, y0, values = x0[inside], y0[inside], values[inside]
+    spans_x, spans_y = x1[inside] - x0, y1[inside] - y0
+
+    # Nearest depth wins where rectangles overlap
+    aligned = np.full(width * height, np.iinfo(np.uint16).max, dtype=np.uint16)
+    for dy in range(int(spans_y.max(initial=-1)) + 1):
+        for dx in range(int(spans_x.max(initial=-1)) + 1):
+            covered = (spans_x >= dx) & (spans_y >= dy)
+            np.minimum.at(aligned, (y0[covered] + dy) * width + x0[covered] + dx, values[covered])
+    aligned[aligned == np.iinfo(np.uint16).max] = 0
+    return aligned.reshape(height, width)
+
+
+def derive(depth, meta):
+    aligned = align_depth(depth, meta)
+    return {"aligned_depth": aligned, "aligned_depth_cm": colourise(aligned)}
+
+
+def _job(job):
+    source, idx, time_str, compare = job
+    depth, meta = read_capture(source, idx, "depth"), read_capture(source, idx, "meta")
+    if depth is None or meta is None:
+        return None
+    derived = derive(depth, meta)
+    if compare:
+        return idx, time_str, _agreement(source, idx, derived)
+    return idx, time_str, derived  # Written by the parent process, like live captures
+
+
+def _agreement(source, idx, derived):
+    live = read_capture(source, idx, "aligned_depth")
+    if live is None:
+        return None
+    valid = (live > 0) | (derived["aligned_depth"] > 0)
+    equal = (live == derived["aligned_depth"]) & valid
+    live_cm = read_capture(source, idx, "aligned_depth_cm")
+    return {"valid": int(valid.sum()), "equal": int(equal.sum()),
+            "colour_mean_abs": None if live_cm is None else float(np.abs(
+                live_cm.astype(np.int16) - colourise(live).astype(np.int16)).mean())}
+
+
+def session_jobs(path, compare=False, overwrite=False):
+    """(source, idx, time_str, compare) for every capture of one camera directory missing derived streams"""
+    path = pathlib.Path(path)
+    jobs = []
+    if is_container(path):
+        reader = ChunkedSessionReader(path)
+        for idx in reader.indices:
+            if compare or overwrite or (idx, "aligned_depth") not in reader.records:
+                jobs.append((str(path), idx, reader.time_str(idx), compare))
+        reader.close()
+        return jobs
+    for idx, files in list_session(path).items():
+        if "depth" not in files or (not compare and not overwrite and all(s in files for s in DERIVED)):
+            continue
+        time_str = parse_capture_name(files["depth"])[1]
+        jobs.append(({k: str(p) for k, p in files.items()}, idx, time_str, compare))
+    return jobs
+
+
+def camera_directories(session):
+    session = pathlib.Path(session)
+    if is_container(session) or list_session(session):
+        return [session]
+    return sorted(p for p in session.iterdir() if p.is_dir() and not p.name.startswith("."))
+
+
+def on_published(catalog, metadata, session, serial, idx, time_str, files):
+    # Index the derived streams and add them to the capture's metadata record once they are under their final names
+    def published(tasks):
+        written = {task.stream for task in tasks}
+        if catalog is not None:
+            for task in tasks:
+                catalog.add(session, serial, idx, time_str, task.stream, task.result)
+        if metadata is not None and written:
+            metadata.append(idx, time_str, serial, files={k: v for k, v in files.items() if k in written})
+    return published
+
+
+def derive_session(session, workers=None, compare=False, overwrite=False, catalog=None, threads=4):
+    """Write aligned_depth and aligned_depth_cm for every capture of a session in parallel, returns
+    (camera, idx, agreement) per capture, agreement is only set when comparing.
+
+    Images are computed in worker processes and written by the parent through a Writer like live captures, so each
+    capture's derived files are published together, indexed in catalog (a rs_store.catalog.Catalog) if given and
+    added to the session's metadata log if it has one.
+    """
+    results = []
+    writer = None if compare else Writer(workers=threads)
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        for directory in camera_directories(session):
+            jobs = session_jobs(directory, compare, overwrite)
+            chunked = is_container(directory) and not compare
+            reader = ChunkedSessionReader(directory) if chunked else None
+            store = ChunkedSessionWriter(directory) if chunked else None
+            location = None if compare else find_metadata(directory)
+            metadata = None if location is None else MetadataLog(location)
+            try:
+                for result in executor.map(_job, jobs, chunksize=2):
+                    if result is None:
+                        continue
+                    idx, time_str, value = result
+                    if compare:
+                        results.append((directory.name, idx, value))
+                        continue
+                    codecs = {}
+                    if store is not None:
+                        # Aligned depth is stored with the same codec as the recorded depth
+                        depth_codec = reader.records[(idx, "depth")]["codec"]
+                        codecs["aligned_depth"] = None if depth_codec == "raw" else depth_codec
+                    files = {}
+                    for stream, image in value.items():
+                        name = format_capture_name(idx, time_str, stream)
+                        files[stream] = chunk_name(idx // store.chunk_size) if store is not None else \
+                            pathlib.Path(file_name(name, image, codecs.get(stream))).name
+                        writer.submit(directory / name, image, stream=stream, store=store, codec=codecs.get(stream),
+                                      capture=(str(directory), idx))
+                    writer.seal((str(directory), idx), on_published(catalog, metadata, directory.parent.name,
+                                                                    directory.name, idx, time_str, files))
+                    results.append((directory.name, idx, None))
+            finally:
+                if writer is not None:
+                    writer.join()
+                if store is not None:
+                    store.close()
+                    reader.close()
+                if metadata is not None:
+                    metadata.close()
+    if writer is not None:
+        writer.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild aligned and colourised depth for raw-only sessions")
+    parser.add_argument("session", help="Session directory (or one camera directory of it)")
+    parser.add_argument("--workers", default=None, type=int)
+    parser.add_argument("--overwrite", action="store_true", help="Rebuild captures that already have the streams")
+    parser.add_argument("--compare", action="store_true",
+                        help="Only compare against aligned streams recorded live in the session, nothing is written")
+    parser.add_argument("--catalog", default=None,
+                        help="Directory of the catalog.sqlite to index derived streams in (defaults to the parent of "
+                             "the session if it has one)")
+    args = parser.parse_args()
+    catalog = None
+    if not args.compare:
+        session = pathlib.Path(args.session).resolve()
+        # Catalogs live next to the sessions, a camera directory's session is one level up
+        root = session.parent.parent if camera_directories(session) == [session] else session.parent
+        if args.catalog or (root / CATALOG_FILE).exists():
+            catalog = Catalog(args.catalog or root)
+    try:
+        results = derive_session(args.session, args.workers, args.compare, args.overwrite, catalog=catalog)
+    finally:
+        if catalog is not None:
+            catalog.close()
+    if not args.compare:
+        print(f"Derived aligned depth for {len(results)} captures" + (f", indexed in {catalog.path}" if catalog else ""))
+        return
+    measured = [r for _, _, r in results if r is not None]
+    if not measured:
+        print("No captures with live aligned depth to compare against")
+        return
+    valid = sum(r["valid"] for r in measured)
+    equal = sum(r["equal"] for r in measured)
+    colour = [r["colour_mean_abs"] for r in measured if r["colour_mean_abs"] is not None]
+    print(f"{len(measured)} captures, aligned depth equal at {100 * equal / max(valid, 1):.2f}% of valid pixels"
+          + (f", colourised depth mean abs difference {np.mean(colour):.3f}" if colour else ""))
+
+
+if __name__ == '__main__':
+    main()
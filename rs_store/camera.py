@@ -1,51 +1,169 @@
+import hashlib
+import json
+import os
 import pathlib
+import threading
 import time
 
-import cv2
 import numpy as np
 import pyrealsense2 as rs
-from tqdm import tqdm
 
+from rs_store.align import colourise
 from rs_store.config import Config
+from rs_store.data import LazyRealsenseData, RealsenseData, join_meta, to3d  # noqa: F401 (re-exported)
+from rs_store.metrics import inc, timed
 from rs_store.save import log
+from rs_store.sources import FrameSource
 
 
 def rs2dict(obj):
     return {k: getattr(obj, k, None) for k in dir(obj) if "__" not in k and not k.startswith("_")}
 
 
-def to3d(im):
-    return np.dstack((im, im, im))
-
-
-class RealsenseData:
-    def __init__(self, colour=None, depth=None, aligned_depth=None, aligned_depth_cm=None, ir_left=None, ir_right=None,
-                 meta=None):
-        self.colour = colour
-        self.depth = depth
-        self.aligned_depth = aligned_depth
-        self.aligned_depth_cm = aligned_depth_cm
-        self.ir_left = ir_left
-        self.ir_right = ir_right
-        self.meta = meta
-
-    def __bool__(self):
-        return any([
-            self.colour is not None,
-            self.depth is not None,
-            self.aligned_depth is not None,
-            self.aligned_depth_cm is not None,
-            self.ir_left is not None,
-            self.ir_right is not None,
-            self.meta is not None,
-        ])
-
-
-class RealsenseD400Camera():
-    def __init__(self, config_path=None, visualise=False):
+class CalibrationCache:
+    """Intrinsics/extrinsics dicts keyed by stream profile, so rs2dict only runs when a profile changes"""
+
+    def __init__(self):
+        self._intrinsics = {}
+        self._extrinsics = {}
+        self._calibration = {}
+
+    def clear(self):
+        self._intrinsics.clear()
+        self._extrinsics.clear()
+        self._calibration.clear()
+
+    def intrinsics(self, profile):
+        key = profile.unique_id()
+        if key not in self._intrinsics:
+            self._intrinsics[key] = rs2dict(profile.as_video_stream_profile().intrinsics)
+        return self._intrinsics[key]
+
+    def extrinsics(self, from_profile, to_profile):
+        key = (from_profile.unique_id(), to_profile.unique_id())
+        if key not in self._extrinsics:
+            self._extrinsics[key] = rs2dict(from_profile.get_extrinsics_to(to_profile))
+        return self._extrinsics[key]
+
+    def build(self, profiles, to="colour", depth_scale=None):
+        """Calibration for named profiles (e.g. {"depth": p, "colour": p}) with extrinsics to the 'to' profile
+
+        The same dict object is returned for the same set of profiles so frames can share it.
+        """
+        key = tuple(sorted((name, p.unique_id()) for name, p in profiles.items()))
+        if key not in self._calibration:
+            calibration = {} if depth_scale is None else {"depth_scale": depth_scale}
+            for name, profile in profiles.items():
+                calibration[f"{name}_intrinsics"] = self.intrinsics(profile)
+                if name != to:
+                    calibration[f"{name}_to_{to}_extrinsics"] = self.extrinsics(profile, profiles[to])
+            self._calibration[key] = calibration
+        return self._calibration[key]
+
+
+DEVICE_CACHE = pathlib.Path(os.environ.get("RS_STORE_DEVICE_CACHE",
+                                         pathlib.Path.home() / ".cache" / "rs_store" / "devices.json"))
+DS5_PRODUCT_IDS = ["0AD1", "0AD2", "0AD3", "0AD4", "0AD5", "0AF6", "0AFE", "0AFF", "0B00", "0B01", "0B03", "0B07",
+                   "0B3A", "0B5C"]
+
+
+def _hash(text):
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+class DeviceCache:
+    """Last device used and, per serial, a hash of the advanced mode config applied to it and of the settings the
+    device reported afterwards. If both still match on the next start load_json (which restarts the sensors) is
+    skipped."""
+
+    def __init__(self, path=DEVICE_CACHE):
+        self.path = pathlib.Path(path)
+        try:
+            with self.path.open('r') as fh:
+                self._data = json.load(fh)
+        except (OSError, ValueError):
+            self._data = {}
+
+    @property
+    def last_serial(self):
+        return self._data.get("last_serial")
+
+    def get(self, serial):
+        return self._data.get("devices", {}).get(str(serial), {})
+
+    def update(self, serial, **info):
+        self._data.setdefault("devices", {}).setdefault(str(serial), {}).update(info)
+        self._data["last_serial"] = str(serial)
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(self.path.name + ".tmp")
+            with tmp.open('w') as fh:
+                json.dump(self._data, fh, indent=2)
+            os.replace(str(tmp), str(self.path))
+        except OSError as e:
+            log(f"Could not write the device cache {self.path}: {e}")
+
+
+def _serial(device):
+    return device.get_info(rs.camera_info.serial_number)
+
+
+def find_device(serial=None, product_ids=DS5_PRODUCT_IDS, ctx=None):
+    """The connected D400 device with this serial (or the first one), None if there is none"""
+    for device in (ctx or rs.context()).query_devices():
+        try:
+            if str(device.get_info(rs.camera_info.product_id)) not in product_ids:
+                continue
+            if serial is None or _serial(device) == str(serial):
+                return device
+        except RuntimeError:
+            continue  # Device went away while being queried
+    return None
+
+
+class DeviceWatcher:
+    """One librealsense context per camera with a single device change callback, so waiting for a device to
+    (re-)appear is woken by notifications instead of sleeping a fixed time, without registering a callback on a new
+    context for every wait"""
+
+    def __init__(self):
+        self.ctx = rs.context()
+        self._changes = 0
+        self._cv = threading.Condition()
+        self.ctx.set_devices_changed_callback(self._on_change)
+
+    def _on_change(self, info):
+        with self._cv:
+            self._changes += 1
+            self._cv.notify_all()
+
+    def find(self, serial=None):
+        return find_device(serial, ctx=self.ctx)
+
+    def wait(self, serial, present=True, timeout=15.0):
+        """Wait until the D400 with this serial is connected (present=True) or gone. Returns the device (or True
+        once gone), None on timeout."""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._cv:
+                seen = self._changes
+            found = self.find(serial)
+            if present and found is not None:
+                return found
+            if not present and found is None:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            # Also re-check every second in case a notification was missed
+            with self._cv:
+                self._cv.wait_for(lambda: self._changes != seen, timeout=min(remaining, 1.0))
+
+
+class RealsenseD400Camera(FrameSource):
+    def __init__(self, config_path=None, visualise=False, serial_number=None):
+        super().__init__(visualise=visualise)
         self.device = None
-        self.serial_number = None
-        self.started = False
         self.advanced_mode = None
         self.pipeline = rs.pipeline()
         self.rs_config = rs.config()
@@ -55,13 +173,18 @@ class RealsenseD400Camera():
 
         self.config = Config(config_path)
         print("Loaded config: ", self.config)
-        if self.config.has_key("serial"):
-            self.serial_number = self.config.serial
+        if serial_number is not None:
+            self.serial_number = serial_number
+        elif self.config.has_key("serial"):
+            serial = self.config.serial
+            self.serial_number = serial[0] if isinstance(serial, list) else serial
         self.profile = None
+        self.calibration = CalibrationCache()
+        self.device_cache = DeviceCache()
+        self.devices = DeviceWatcher()
         self._configure_rs()
 
         self.colorizer = rs.colorizer()
-        self.frames = RealsenseData()
 
         self.depth_sensor = self.profile.get_device().first_depth_sensor()
         self.depth_scale = self.depth_sensor.get_depth_scale()
@@ -69,17 +192,12 @@ class RealsenseD400Camera():
 
         self.align_to = rs.stream.color
         self.align = rs.align(self.align_to)
-
-        self.visualise = visualise
-        self.display = None
-        self.display = "Realsense Saver"
-        if self.visualise:
-            cv2.namedWindow(self.display, cv2.WINDOW_GUI_EXPANDED)
-            cv2.destroyAllWindows()
+        # Products can be computed on the preview thread while the capture thread reads the next frame set
+        self._processing_lock = threading.Lock()
 
     def stop(self):
         if self.started:
-            cv2.destroyAllWindows()
+            self.stop_preview()
             self.pipeline.stop()
             self.started = False
         else:
@@ -88,68 +206,90 @@ class RealsenseD400Camera():
     def start(self):
         if self.started:
             self.stop()
+        self.calibration.clear()
         self.profile = self.pipeline.start(self.rs_config)
         self.started = True
-
-    def _configure_rs(self):
-        ds5_product_ids = ["0AD1", "0AD2", "0AD3", "0AD4", "0AD5", "0AF6", "0AFE", "0AFF", "0B00", "0B01", "0B03",
-                           "0B07", "0B3A", "0B5C"]
-
-        def find_device_that_supports_advanced_mode(serial=None):
-            ctx = rs.context()
-            devices = ctx.query_devices()
-            found_devices = []
-            try:
-                for t_device in devices:
-                    if t_device.supports(rs.camera_info.product_id) and str(
-                            t_device.get_info(rs.camera_info.product_id)) in ds5_product_ids:
-                        if t_device.supports(rs.camera_info.name):
-                            if serial is not None and t_device.supports(rs.camera_info.serial_number):
-                                found_serial = t_device.get_info(rs.camera_info.serial_number)
-                                found_devices.append(found_serial)
-                                if serial != found_serial and str(serial) != found_serial:
-                                    continue
-                            log("Found device that supports advanced mode: {} ({})".format(
-                                t_device.get_info(rs.camera_info.name),
-                                t_device.get_info(rs.camera_info.serial_number),
-                            ))
-                        return t_device
-            except Exception as e:
-                log(f"Error finding camera (serial={'any' if serial is None else serial}):", e)
+        self._build_calibration()
+
+    def _build_calibration(self):
+        # Warm the cache with the streams the pipeline was started with, aligned depth is added on first use
+        self.depth_scale = self.profile.get_device().first_depth_sensor().get_depth_scale()
+        profiles = {}
+        for stream_profile in self.profile.get_streams():
+            if stream_profile.stream_type() == rs.stream.color:
+                profiles["colour"] = stream_profile
+            elif stream_profile.stream_type() == rs.stream.depth:
+                profiles["depth"] = stream_profile
+            elif stream_profile.stream_type() == rs.stream.infrared:
+                profiles["ir_left" if stream_profile.stream_index() == 1 else "ir_right"] = stream_profile
+        if "colour" in profiles:
+            self.calibration.build(profiles, depth_scale=self.depth_scale)
+
+    def _find_device(self):
+        serial = self.serial_number
+        if serial is None and self.device_cache.last_serial is not None:
+            # Try the camera used last time before scanning every device for a D400
+            device = self.devices.find(self.device_cache.last_serial)
+            if device is not None:
+                return device
+        device = self.devices.find(serial)
+        if device is None:
             error_message = "No D400 product line device that supports advanced mode was found:."
             error_message += f"\n\t- Serial={'any' if serial is None else serial}"
-            error_message += f"\n\t- Serial not in {found_devices}"
-            error_message += f"\n\n\n"
             raise Exception(error_message)
+        return device
+
+    def _enable_advanced_mode(self):
+        self.advanced_mode = rs.rs400_advanced_mode(self.device)
+        while not self.advanced_mode.is_enabled():
+            log("Trying to enable advanced mode")
+            self.advanced_mode.toggle_advanced_mode(True)
+            # The device disconnects and re-connects, and the device object becomes invalid
+            self.devices.wait(self.serial_number, present=False, timeout=5)
+            self.device = self.devices.wait(self.serial_number, present=True, timeout=15) or self._find_device()
+            self.advanced_mode = rs.rs400_advanced_mode(self.device)
+        log("Advanced mode is enabled")
+
+    def _load_advanced_config(self):
+        cached = self.device_cache.get(self.serial_number)
+        config_hash = _hash(self.config.rs_str)
+        if cached.get("config_hash") == config_hash and \
+                cached.get("device_hash") == _hash(self.advanced_mode.serialize_json()):
+            log("Advanced mode config already applied to", self.serial_number)
+            return
+        self.advanced_mode.load_json(self.config.rs_str)
+        self.device_cache.update(self.serial_number, config_hash=config_hash,
+                                 device_hash=_hash(self.advanced_mode.serialize_json()),
+                                 name=self.device.get_info(rs.camera_info.name),
+                                 product_id=self.device.get_info(rs.camera_info.product_id))
+
+    def reset(self, timeout=15.0):
+        """Hardware reset the device and return once it has re-connected (or timeout seconds passed)"""
+        self.calibration.clear()
+        self.device.hardware_reset()
+        self.devices.wait(self.serial_number, present=False, timeout=5)
+        device = self.devices.wait(self.serial_number, present=True, timeout=timeout)
+        if device is not None:
+            self.device = device
+        return device is not None
 
+    def _configure_rs(self):
         attempts = 0
         while attempts < 3:
             try:
-                self.device = find_device_that_supports_advanced_mode(self.serial_number)
+                self.device = self._find_device()
                 if self.serial_number is None:
                     print("Serial Number not Set! Setting automatically from the first device")
-                    self.serial_number = self.device.get_info(rs.camera_info.serial_number)
-                self.advanced_mode = rs.rs400_advanced_mode(self.device)
-                log("Advanced mode is", "enabled" if self.advanced_mode.is_enabled() else "disabled")
-
-                # Loop until we successfully enable advanced mode
-                while not self.advanced_mode.is_enabled():
-                    log("Trying to enable advanced mode")
-                    self.advanced_mode.toggle_advanced_mode(True)
-                    # At this point the device will disconnect and re-connect.
-                    for _ in tqdm(range(5), desc="Sleeping while camera reconnects"):
-                        time.sleep(1)
-                    # The 'dev' object will become invalid and we need to initialize it again
-                    self.device = find_device_that_supports_advanced_mode()
-                    self.advanced_mode = rs.rs400_advanced_mode(self.device)
-                    log("Advanced mode is", "enabled" if self.advanced_mode.is_enabled() else "disabled")
-
-                self.advanced_mode.load_json(self.config.rs_str)
+                    self.serial_number = _serial(self.device)
+                log("Found device that supports advanced mode: {} ({})".format(
+                    self.device.get_info(rs.camera_info.name), self.serial_number))
+                self._enable_advanced_mode()
+                self._load_advanced_config()
                 width, height = int(self.config["stream-width"]), int(self.config["stream-height"])
                 fps = int(self.config["stream-fps"])
                 color_width, colour_height, colour_fps = self.config.rgb_width, self.config.rgb_height, self.config.rgb_fps
 
-                self.rs_config.enable_device(self.device.get_info(rs.camera_info.serial_number))
+                self.rs_config.enable_device(self.serial_number)
                 log("Enabling colour: {}x{}@{} - {}".format(color_width, colour_height, colour_fps,
                                                             str(rs.format.bgr8)))
                 self.rs_config.enable_stream(rs.stream.color, color_width, colour_height, rs.format.bgr8, colour_fps)
@@ -166,73 +306,114 @@ class RealsenseD400Camera():
                 print(f"Could not configure camera! {self.serial_number}:", e)
                 attempts += 1
                 if self.device is not None:
-                    self.device.hardware_reset()
-                    for _ in tqdm(range(5), desc=f"Resetting device f{self.serial_number} and waiting five seconds"):
-                        time.sleep(1)
+                    log(f"Resetting device {self.serial_number} and waiting for it to re-connect")
+                    self.reset()
                 else:
                     print("Could not find a camera!")
-                    time.sleep(1)
+                    if self.serial_number is None or not self.devices.wait(self.serial_number, timeout=5):
+                        time.sleep(1)
         raise Exception("Could not configure a camera.")
 
-    def warmup(self, n=100):
-        for _ in range(n):
-            self.get_frames()
+    def drain(self):
+        n = 0
+        while self.pipeline.poll_for_frames():
+            n += 1
+        return n
 
-    def get_frames(self, return_key=False):
+    def read(self):
         while True:
-            key_code = None
-            frames = self.pipeline.wait_for_frames()
-            aligned_frames = self.align.process(frames)
+            with timed("rs_store_capture_seconds", stage="wait", serial=self.serial_number):
+                frames = self.pipeline.wait_for_frames()
+            if self.post is not None and self.post.backend == "realsense" and self.post.stage == "before_align":
+                frames = self.post.process(frames).as_frameset()
 
             ir_left = frames.get_infrared_frame(1)
             ir_right = frames.get_infrared_frame(2)
             depth = frames.get_depth_frame()
-            aligned_depth = aligned_frames.get_depth_frame()
-            colour = aligned_frames.get_color_frame()
+            colour = frames.get_color_frame()
 
-            if any([not x for x in [ir_left, ir_right, depth, aligned_depth, colour]]):
+            required = [depth, colour] + ([ir_left, ir_right] if self.config.ir_enabled else [])
+            if any([not x for x in required]):
                 log("Invalid frames skipping this frame set")
+                inc("rs_store_invalid_framesets_total", serial=self.serial_number)
                 continue
 
-            # Render
-            ir_left_image = None
-            ir_right_image = None
+            return LazyRealsenseData(self._producers(frames, ir_left, ir_right, depth, colour), self.products)
+
+    def _producers(self, frames, ir_left, ir_right, depth, colour):
+        # Only the raw frames are fetched above, alignment, colourisation, conversion and metadata run on first read
+        serial = self.serial_number
+
+        def stage(name, fn):
+            def timed_fn(f):
+                with timed("rs_store_capture_seconds", stage=name, serial=serial):
+                    return fn(f)
+            return timed_fn
+
+        def aligned_depth_frame(f):
+            with self._processing_lock, timed("rs_store_capture_seconds", stage="align", serial=serial):
+                aligned_depth = self.align.process(frames).get_depth_frame()
+            if not aligned_depth:
+                log("Invalid aligned depth frame")
+                return None
+            if self.post is not None and self.post.backend == "realsense" and self.post.stage == "after_align":
+                with self._processing_lock:
+                    aligned_depth = self.post.process(aligned_depth).as_depth_frame()
+            return aligned_depth
+
+        def aligned_depth_cm(f):
+            if self.post is not None and self.post.backend == "numpy" and self.post.stage == "after_align":
+                # aligned_depth is filtered as an array (PostProcessor.attach), colourise that rather than the rs frame
+                filtered = f.compute("aligned_depth")
+                if filtered is None:
+                    return None
+                with timed("rs_store_capture_seconds", stage="colourise", serial=serial):
+                    return colourise(filtered)
+            aligned_depth = f.compute("aligned_depth_frame")
+            if aligned_depth is None:
+                return None
+            with self._processing_lock, timed("rs_store_capture_seconds", stage="colourise", serial=serial):
+                return np.asanyarray(self.colorizer.colorize(aligned_depth).get_data())
+
+        def aligned_depth_image(f):
+            aligned_depth = f.compute("aligned_depth_frame")
+            if aligned_depth is None:
+                return None
+            with timed("rs_store_capture_seconds", stage="convert", serial=serial):
+                return np.asanyarray(aligned_depth.get_data())
+
+        def calibration(f):
+            profiles = {"depth": depth.profile, "colour": colour.profile}
+            aligned = {"aligned_depth", "aligned_depth_cm"} & f._products
+            aligned_depth = f.compute("aligned_depth_frame") if aligned else None
+            if aligned_depth is not None:
+                profiles["aligned_depth"] = aligned_depth.profile
             if self.config.ir_enabled:
-                ir_left_image = np.asanyarray(ir_left.get_data())
-                ir_right_image = np.asanyarray(ir_right.get_data())
-            depth_image = np.asanyarray(depth.get_data())
-            aligned_depth_image = np.asanyarray(aligned_depth.get_data())
-            aligned_depth_cm_image = np.asanyarray(self.colorizer.colorize(aligned_depth).get_data())
-            color_image = np.asanyarray(colour.get_data())
-
-            image_info = {
-                "ir_left_intrinsics": rs2dict(ir_left.profile.as_video_stream_profile().intrinsics),
-                "ir_right_intrinsics": rs2dict(ir_right.profile.as_video_stream_profile().intrinsics),
-                "depth_intrinsics": rs2dict(depth.profile.as_video_stream_profile().intrinsics),
-                "aligned_depth_intrinsics": rs2dict(aligned_depth.profile.as_video_stream_profile().intrinsics),
-                "colour_intrinsics": rs2dict(colour.profile.as_video_stream_profile().intrinsics),
-                "ir_left_to_colour_extrinsics": rs2dict(ir_left.profile.get_extrinsics_to(colour.profile)),
-                "ir_right_to_colour_extrinsics": rs2dict(ir_right.profile.get_extrinsics_to(colour.profile)),
-                "depth_to_colour_extrinsics": rs2dict(depth.profile.get_extrinsics_to(colour.profile)),
-                "aligned_depth_to_colour_extrinsics": rs2dict(aligned_depth.profile.get_extrinsics_to(colour.profile)),
+                profiles["ir_left"] = ir_left.profile
+                profiles["ir_right"] = ir_right.profile
+            with timed("rs_store_capture_seconds", stage="metadata", serial=serial):
+                return self.calibration.build(profiles, depth_scale=self.depth_scale)
+
+        def frame_info(f):
+            return {
+                "timestamp": frames.get_timestamp(),
+                "frame_number": frames.get_frame_number(),
+                "timestamp_domain": str(frames.get_frame_timestamp_domain()),
+                "depth_frame_number": depth.get_frame_number(),
+                "colour_frame_number": colour.get_frame_number(),
             }
 
-            if self.visualise:
-                canvas = np.hstack(
-                    [cv2.resize(color_image, (720, 480)), cv2.resize(aligned_depth_cm_image, (720, 480))]
-                )
-
-                if self.config.ir_enabled:
-                    canvas = np.vstack([
-                        canvas,
-                        to3d(np.hstack([cv2.resize(ir_left_image, (720, 480)), cv2.resize(ir_right_image, (720, 480))]))
-                    ])
-
-                cv2.imshow(self.display, canvas)
-                key_code = cv2.waitKey(1)
-
-            self.frames = RealsenseData(color_image, depth_image, aligned_depth_image, aligned_depth_cm_image,
-                                        ir_left_image, ir_right_image, image_info)
-            if return_key:
-                return self.frames, key_code
-            return self.frames
+        producers = {
+            "colour": stage("convert", lambda f: np.asanyarray(colour.get_data())),
+            "depth": stage("convert", lambda f: np.asanyarray(depth.get_data())),
+            "aligned_depth_frame": aligned_depth_frame,
+            "aligned_depth": aligned_depth_image,
+            "aligned_depth_cm": aligned_depth_cm,
+            "calibration": calibration,
+            "frame_info": stage("metadata", frame_info),
+            "meta": lambda f: join_meta(f.calibration, f.frame_info),
+        }
+        if self.config.ir_enabled:
+            producers["ir_left"] = stage("convert", lambda f: np.asanyarray(ir_left.get_data()))
+            producers["ir_right"] = stage("convert", lambda f: np.asanyarray(ir_right.get_data()))
+        return producers
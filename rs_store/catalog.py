@@ -0,0 +1,203 @@
+import argparse
+import pathlib
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from rs_store.container import ChunkedSessionReader, is_container
+from rs_store.utils import get_saved_data_root, parse_capture_name, parse_str_datetime
+
+CATALOG_FILE = "catalog.sqlite"
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS captures (
+    session TEXT NOT NULL,
+    serial TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    timestamp REAL,
+    time_str TEXT,
+    stream TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (session, serial, idx, stream)
+);
+CREATE INDEX IF NOT EXISTS captures_time ON captures (timestamp, stream);
+CREATE INDEX IF NOT EXISTS captures_session ON captures (session, serial, stream, idx);
+"""
+
+
+def _timestamp(time_str):
+    try:
+        return parse_str_datetime(time_str).timestamp()
+    except (ValueError, AttributeError):
+        return None
+
+
+def _to_timestamp(t):
+    if t is None or isinstance(t, (int, float)):
+        return t
+    if isinstance(t, datetime):
+        return t.timestamp()
+    return _timestamp(t) or datetime.fromisoformat(t).timestamp()
+
+
+class Catalog:
+    """SQLite index of every saved stream under a saved_data root (capture index, time, serial, stream -> path).
+
+    Paths are relative to the root, chunked sessions store the container directory (read it with
+    rs_store.container.ChunkedSessionReader). add() is thread safe and batches inserts, call flush() or close() to
+    make sure everything is committed.
+    """
+
+    def __init__(self, root, batch_size=256, flush_interval=2.0):
+        self.root = pathlib.Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.path = self.root / CATALOG_FILE
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = []
+        self._last_flush = time.monotonic()
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+
+    def _relative(self, path):
+        path = pathlib.Path(path)
+        try:
+            return str(path.resolve().relative_to(self.root.resolve()))
+        except ValueError:
+            return str(path)
+
+    def add(self, session, serial, idx, time_str, stream, path):
+        row = (str(session), str(serial), int(idx), _timestamp(time_str), time_str, stream, self._relative(path))
+        with self._lock:
+            self._pending.append(row)
+            if len(self._pending) >= self.batch_size or time.monotonic() - self._last_flush > self.flush_interval:
+                self._flush()
+
+    def add_path(self, path):
+        """Catalogue a file written by main.py, laid out as <root>/<session>/<serial>/<capture name>"""
+        path = pathlib.Path(path)
+        parsed = parse_capture_name(path)
+        if parsed is None:
+            return False
+        idx, time_str, stream = parsed
+        self.add(path.parent.parent.name, path.parent.name, idx, time_str, stream, path)
+        return True
+
+    def _flush(self):
+        if self._pending:
+            self._db.executemany("INSERT OR REPLACE INTO captures VALUES (?, ?, ?, ?, ?, ?, ?)", self._pending)
+            self._db.commit()
+            self._pending = []
+        self._last_flush = time.monotonic()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._db.close()
+
+    def rebuild(self, session=None):
+        """Re-index sessions from what is on disk (all of them by default)"""
+        sessions = [self.root / session] if session else sorted(p for p in self.root.iterdir() if p.is_dir())
+        count = 0
+        with self._lock:
+            self._flush()
+        for session_path in sessions:
+            with self._lock:
+                self._db.execute("DELETE FROM captures WHERE session = ?", (session_path.name,))
+            for serial_path in sorted(p for p in session_path.iterdir() if p.is_dir()):
+                if is_container(serial_path):
+                    reader = ChunkedSessionReader(serial_path)
+                    for (idx, stream), record in reader.records.items():
+                        self.add(session_path.name, serial_path.name, idx, record["time"], stream, serial_path)
+                        count += 1
+                    reader.close()
+                    continue
+                for p in serial_path.iterdir():
+                    count += self.add_path(p) if p.is_file() else 0
+        self.flush()
+        return count
+
+    def remove(self, session, serial=None, stream=None, idxs=None):
+        """Forget captures deleted from disk, idxs limits it to those capture indices"""
+        clauses, params = ["session = ?"], [str(session)]
+        for column, value in [("serial", serial), ("stream", stream)]:
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(str(value))
+        sql = "DELETE FROM captures WHERE " + " AND ".join(clauses)
+        with self._lock:
+            self._flush()
+            if idxs is None:
+                self._db.execute(sql, params)
+            else:
+                self._db.executemany(sql + " AND idx = ?", [params + [int(i)] for i in idxs])
+            self._db.commit()
+
+    def query(self, start=None, end=None, stream=None, session=None, serial=None, limit=None):
+        """Rows (session, serial, idx, timestamp, time_str, stream, path) ordered by time then capture index
+
+        start/end may be unix timestamps, datetimes, ISO strings or capture time strings (get_str_datetime).
+        """
+        clauses, params = [], []
+        for column, op, value in [("timestamp", ">=", _to_timestamp(start)), ("timestamp", "<=", _to_timestamp(end)),
+                                  ("stream", "=", stream), ("session", "=", session), ("serial", "=", serial)]:
+            if value is not None:
+                clauses.append(f"{column} {op} ?")
+                params.append(value)
+        sql = "SELECT session, serial, idx, timestamp, time_str, stream, path FROM captures"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY timestamp, session, serial, idx"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        self.flush()
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def sessions(self):
+        self.flush()
+        with self._lock:
+            return [r[0] for r in self._db.execute("SELECT DISTINCT session FROM captures ORDER BY session")]
+
+    def serials(self, session):
+        self.flush()
+        with self._lock:
+            rows = self._db.execute("SELECT DISTINCT serial FROM captures WHERE session = ? ORDER BY serial",
+                                    (str(session),))
+            return [r[0] for r in rows]
+
+    def resolve(self, path):
+        return self.root / path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or query the saved_data catalog")
+    parser.add_argument("command", choices=["rebuild", "query", "sessions"])
+    parser.add_argument("--root", default=str(get_saved_data_root()))
+    parser.add_argument("--session", default=None)
+    parser.add_argument("--serial", default=None)
+    parser.add_argument("--stream", default=None)
+    parser.add_argument("--start", default=None, help="ISO time e.g. 2021-04-01T12:00:00")
+    parser.add_argument("--end", default=None)
+    parser.add_argument("--limit", default=None, type=int)
+    args = parser.parse_args()
+
+    catalog = Catalog(args.root)
+    if args.command == "rebuild":
+        print(f"Indexed {catalog.rebuild(args.session)} files in {catalog.path}")
+    elif args.command == "sessions":
+        print("\n".join(catalog.sessions()))
+    else:
+        for row in catalog.query(args.start, args.end, args.stream, args.session, args.serial, args.limit):
+            print(*row, sep="\t")
+    catalog.close()
+
+
+if __name__ == '__main__':
+    main()
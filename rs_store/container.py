@@ -0,0 +1,194 @@
+import json
+import os
+import pathlib
+import threading
+
+import numpy as np
+
+from rs_store.data import LazyRealsenseData, STREAMS, split_meta
+from rs_store.metastore import capture_meta
+from rs_store.metrics import inc, timed
+from rs_store.save import decode_img, encode_img, json_default
+
+CONTAINER_FILE = "container.json"
+INDEX_FILE = "index.jsonl"
+
+
+def is_container(path):
+    return (pathlib.Path(path) / CONTAINER_FILE).exists()
+
+
+def chunk_name(chunk):
+    return f"chunk_{chunk:06d}.bin"
+
+
+def encode_record(data, codec=None):
+    if isinstance(data, dict):
+        return json.dumps(data, default=json_default).encode(), {"codec": "json"}
+    if isinstance(data, np.ndarray) and codec is not None:
+        return encode_img(data, codec), {"codec": codec}
+    if isinstance(data, np.ndarray):
+        data = np.ascontiguousarray(data)
+        return data.tobytes(), {"codec": "raw", "dtype": data.dtype.str, "shape": list(data.shape)}
+    raise TypeError
+
+
+def decode_record(payload, record):
+    if record["codec"] == "json":
+        return json.loads(payload.decode())
+    if record["codec"] == "raw":
+        return np.frombuffer(payload, dtype=np.dtype(record["dtype"])).reshape(record["shape"])
+    return decode_img(payload)
+
+
+class ChunkedSessionWriter:
+    """Append-only session container, one chunk file per chunk_size captures plus an index of offsets.
+
+    Safe to call write() from several writer threads, captures may arrive out of order. Records written with
+    published=False (by rs_store.writer.Writer for captures published by seal()) stay invisible to readers until
+    publish() appends a marker for them, so captures that were interrupted are never read back.
+    """
+
+    def __init__(self, path, chunk_size=100):
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.chunk_size = int(chunk_size)
+        self._lock = threading.Lock()
+        self._chunks = {}
+        self.bytes_written = 0  # Payload and index bytes appended by this writer
+        container_file = self.path / CONTAINER_FILE
+        if container_file.exists():
+            with container_file.open('r') as fh:
+                self.chunk_size = int(json.load(fh)["chunk_size"])
+        else:
+            with container_file.open('w') as fh:
+                json.dump({"format": "rs_store.chunked", "version": 2, "chunk_size": self.chunk_size}, fh)
+        self._index = (self.path / INDEX_FILE).open('a')
+
+    def _chunk(self, chunk):
+        if chunk not in self._chunks:
+            # Late writes to older chunks are rare, keep only a couple of handles open
+            for old in [c for c in self._chunks if c < chunk - 1]:
+                self._chunks.pop(old).close()
+            self._chunks[chunk] = (self.path / chunk_name(chunk)).open('ab')
+        return self._chunks[chunk]
+
+    def write(self, idx, stream, data, time_str=None, codec=None, published=True):
+        with timed("rs_store_save_seconds", stage="encode", codec=codec or "raw"):
+            payload, record = encode_record(data, codec)
+        chunk = idx // self.chunk_size
+        with self._lock:
+            with timed("rs_store_save_seconds", stage="write", codec=record["codec"]):
+                fh = self._chunk(chunk)
+                offset = fh.tell()
+                fh.write(payload)
+                record.update(idx=idx, stream=stream, time=time_str, chunk=chunk, offset=offset, length=len(payload))
+                if published:
+                    record["published"] = True
+                line = json.dumps(record) + "\n"
+                self._index.write(line)
+                self.bytes_written += len(payload) + len(line)
+        inc("rs_store_saved_bytes_total", len(payload), codec=record["codec"])
+        return len(payload)
+
+    def publish(self, idx, streams):
+        """Make records of capture idx written with published=False visible to readers"""
+        with self._lock:
+            line = json.dumps({"publish": idx, "streams": list(streams)}) + "\n"
+            self._index.write(line)
+            self.bytes_written += len(line)
+
+    def flush(self):
+        with self._lock:
+            for fh in self._chunks.values():
+                fh.flush()
+            self._index.flush()
+
+    def sync(self):
+        """Flush and fsync everything appended so far"""
+        with self._lock:
+            for fh in list(self._chunks.values()) + [self._index]:
+                fh.flush()
+                os.fsync(fh.fileno())
+
+    def close(self):
+        with self._lock:
+            for fh in self._chunks.values():
+                fh.close()
+            self._chunks.clear()
+            self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ChunkedSessionReader:
+    """Random access to capture idx / stream k of a chunked session, the index is read once on open. Records that
+    were never published are skipped (every record of containers from before publish markers existed)."""
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        if not is_container(self.path):
+            raise FileNotFoundError(f"{self.path} is not a chunked session")
+        with (self.path / CONTAINER_FILE).open('r') as fh:
+            version = int(json.load(fh).get("version", 1))
+        self.records = {}
+        pending = {}  # Latest record of each capture stream waiting for its publish marker
+        with (self.path / INDEX_FILE).open('r') as fh:
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break  # Truncated final line from an unclean shutdown
+                if "publish" in record:
+                    for stream in record["streams"]:
+                        key = (record["publish"], stream)
+                        if key in pending:
+                            self.records[key] = pending.pop(key)
+                elif version < 2 or record.get("published"):
+                    self.records[(record["idx"], record["stream"])] = record
+                else:
+                    pending[(record["idx"], record["stream"])] = record
+        self.indices = sorted({idx for idx, _ in self.records})
+        self._lock = threading.Lock()
+        self._handles = {}
+
+    def __len__(self):
+        return len(self.indices)
+
+    def streams(self, idx):
+        return [k for k in STREAMS if (idx, k) in self.records]
+
+    def time_str(self, idx):
+        for k in STREAMS:
+            if (idx, k) in self.records:
+                return self.records[(idx, k)]["time"]
+        raise KeyError(idx)
+
+    def read(self, idx, stream):
+        record = self.records[(idx, stream)]
+        with self._lock:
+            fh = self._handles.get(record["chunk"])
+            if fh is None:
+                fh = self._handles[record["chunk"]] = (self.path / chunk_name(record["chunk"])).open('rb')
+            fh.seek(record["offset"])
+            payload = fh.read(record["length"])
+        return decode_record(payload, record)
+
+    def frame(self, idx, products=None):
+        producers = {k: (lambda f, k=k: self.read(idx, k)) for k in self.streams(idx)}
+        if "meta" not in producers:
+            producers["meta"] = lambda f: capture_meta(self.path, idx)
+        if "meta" in producers:
+            producers["calibration"] = lambda f: split_meta(f.compute("meta"))[0]
+            producers["frame_info"] = lambda f: split_meta(f.compute("meta"))[1]
+        return LazyRealsenseData(producers, products)
+
+    def close(self):
+        with self._lock:
+            for fh in self._handles.values():
+                fh.close()
+            self._handles.clear()
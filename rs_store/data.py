@@ -0,0 +1,99 @@
+import threading
+
+import numpy as np
+
+STREAMS = ("colour", "depth", "aligned_depth", "aligned_depth_cm", "ir_left", "ir_right", "meta")
+# Saved with --raw-only, aligned_depth and aligned_depth_cm are rebuilt offline by rs_store.align
+RAW_STREAMS = ("colour", "depth", "ir_left", "ir_right", "meta")
+# Not saved as streams, meta is the union of both (calibration is shared between frames of the same stream profile)
+FIELDS = ("calibration", "frame_info")
+
+
+def to3d(im):
+    return np.dstack((im, im, im))
+
+
+def compose_canvas(colour, aligned_depth_cm, ir_left=None, ir_right=None, size=(720, 480)):
+    """Side by side colour | colourised depth with the IR pair underneath (as shown by --visualise)"""
+    import cv2
+    canvas = np.hstack([cv2.resize(colour, size), cv2.resize(aligned_depth_cm, size)])
+    if ir_left is not None and ir_right is not None:
+        canvas = np.vstack([canvas, to3d(np.hstack([cv2.resize(ir_left, size), cv2.resize(ir_right, size)]))])
+    return canvas
+
+
+class RealsenseData:
+    def __init__(self, colour=None, depth=None, aligned_depth=None, aligned_depth_cm=None, ir_left=None, ir_right=None,
+                 meta=None, calibration=None, frame_info=None):
+        self.colour = colour
+        self.depth = depth
+        self.aligned_depth = aligned_depth
+        self.aligned_depth_cm = aligned_depth_cm
+        self.ir_left = ir_left
+        self.ir_right = ir_right
+        self.meta = meta
+        self.calibration = calibration
+        self.frame_info = frame_info
+
+    def __bool__(self):
+        return any([
+            self.colour is not None,
+            self.depth is not None,
+            self.aligned_depth is not None,
+            self.aligned_depth_cm is not None,
+            self.ir_left is not None,
+            self.ir_right is not None,
+            self.meta is not None,
+        ])
+
+
+class LazyRealsenseData(RealsenseData):
+    """RealsenseData whose streams are only computed when first read.
+
+    producers maps a stream (or intermediate) name to a callable taking this frame set, products limits which streams
+    are visible (others read as None). Producers may depend on each other through compute(), and every result is
+    cached so each product is computed at most once per frame set, even when read from several threads.
+    """
+
+    def __init__(self, producers, products=None):
+        self._producers = producers
+        self._products = set(STREAMS if products is None else products)
+        self._cache = {}
+        self._lock = threading.RLock()
+
+    def compute(self, item):
+        with self._lock:
+            if item not in self._cache:
+                producer = self._producers.get(item)
+                self._cache[item] = producer(self) if producer is not None else None
+            return self._cache[item]
+
+    def __getattr__(self, item):
+        if item in FIELDS:
+            value = self.compute(item)
+        elif item in STREAMS:
+            value = self.compute(item) if item in self._products else None
+        else:
+            raise AttributeError(item)
+        setattr(self, item, value)
+        return value
+
+    def __bool__(self):
+        return any(k in self._producers for k in self._products)
+
+    def materialise(self):
+        for k in STREAMS:
+            getattr(self, k)
+        return self
+
+
+def join_meta(calibration, frame_info):
+    meta = dict(calibration or {})
+    meta.update(frame_info or {})
+    return meta
+
+
+def split_meta(meta):
+    calibration = {k: v for k, v in meta.items() if k.endswith(("_intrinsics", "_extrinsics")) or k == "depth_scale"}
+    frame_info = {k: v for k, v in meta.items() if k not in calibration}
+    return calibration, frame_info
@@ -0,0 +1,277 @@
+"""Export saved sessions as fixed size shards of training samples.
+
+    python -m rs_store.dataset saved_data/<session> [saved_data/<session> ...] --out dataset --format tar
+    python -m rs_store.dataset saved_data/D2021-* --out dataset --format npz --resize 640x360 --crop 0,0.1,1,0.9
+
+A sample is one camera's capture: the requested streams, plus json with the parsed intrinsics of every stream (after
+crop and resize), depth scale, extrinsics and the capture's frame info. tar shards follow the WebDataset layout
+(<key>.colour.png, <key>.depth.png (16 bit), ..., <key>.json). npz shards hold <key>.<stream> arrays,
+<key>.<stream>_K 3x3 camera matrices and <key>.json, written one member at a time so memory does not grow with the
+shard size, open them with np.load.
+
+Each session is split into its own shards of --shard-size samples in (serial, index) order, so the shards of a session
+never change when other sessions are added and exporting a growing archive again only writes new shards (and the last
+shard of a session that grew). Shards are built in parallel, written to a .partial file and renamed when complete,
+and every finished shard is appended to manifest.jsonl, so an interrupted export picks up where it stopped.
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import pathlib
+import tarfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from rs_store.container import ChunkedSessionReader, is_container
+from rs_store.sources import list_session, read_capture
+from rs_store.utils import parse_capture_name
+
+DATASET_FILE = "dataset.json"
+MANIFEST_FILE = "manifest.jsonl"
+DEFAULT_STREAMS = ("colour", "depth", "ir_left", "ir_right")
+# Calibration key holding each stream's intrinsics, aligned streams are in the colour camera
+INTRINSICS = {"colour": "colour_intrinsics", "depth": "depth_intrinsics", "ir_left": "ir_left_intrinsics",
+              "ir_right": "ir_right_intrinsics", "aligned_depth": "aligned_depth_intrinsics",
+              "aligned_depth_cm": "aligned_depth_intrinsics"}
+RAW_DEPTH = ("depth", "aligned_depth")
+
+
+def session_samples(session):
+    """(key, source, idx, time_str) for every capture of every camera of a session, in (serial, index) order"""
+    session = pathlib.Path(session)
+    samples = []
+    for directory in [session] + sorted(p for p in session.iterdir() if p.is_dir() and not p.name.startswith(".")):
+        prefix = session.name if directory == session else f"{session.name}/{directory.name}"
+        if is_container(directory):
+            reader = ChunkedSessionReader(directory)
+            samples.extend((f"{prefix}/{idx:07d}", str(directory), idx, reader.time_str(idx)) for idx in reader.indices)
+            reader.close()
+            continue
+        for idx, files in list_session(directory).items():
+            time_str = parse_capture_name(next(iter(files.values())))[1]
+            samples.append((f"{prefix}/{idx:07d}", {k: str(p) for k, p in files.items()}, idx, time_str))
+    return samples
+
+
+def _digest(keys):
+    return hashlib.sha1("\n".join(keys).encode()).hexdigest()[:16]
+
+
+def plan_shards(sessions, shard_size):
+    """[(shard name, session name, samples)], deterministic for the same captures on disk"""
+    shards = []
+    for session in sessions:
+        session = pathlib.Path(session)
+        samples = session_samples(session)
+        for n, start in enumerate(range(0, len(samples), shard_size)):
+            shards.append((f"{session.name}-{n:06d}", session.name, samples[start:start + shard_size]))
+    return shards
+
+
+def parse_size(value):
+    """'640x360' -> (640, 360)"""
+    if not value:
+        return None
+    width, _, height = value.lower().partition("x")
+    return int(width), int(height)
+
+
+def parse_crop(value):
+    """'left,top,right,bottom' as fractions of the image -> tuple of floats"""
+    if not value:
+        return None
+    crop = tuple(float(v) for v in value.split(","))
+    if len(crop) != 4 or not (0 <= crop[0] < crop[2] <= 1 and 0 <= crop[1] < crop[3] <= 1):
+        raise ValueError(f"--crop must be left,top,right,bottom fractions (left < right, top < bottom) not {value}")
+    return crop
+
+
+def crop_and_resize(image, intrinsics=None, crop=None, size=None, nearest=False):
+    """Crop (fractions of the image) then resize an image, returns it with its intrinsics updated to match"""
+    import cv2
+    intrinsics = dict(intrinsics) if intrinsics else None
+    height, width = image.shape[:2]
+    if crop is not None:
+        x0, y0 = int(round(crop[0] * width)), int(round(crop[1] * height))
+        x1, y1 = int(round(crop[2] * width)), int(round(crop[3] * height))
+        image = image[y0:y1, x0:x1]
+        if intrinsics:
+            intrinsics.update(ppx=float(intrinsics["ppx"]) - x0, ppy=float(intrinsics["ppy"]) - y0,
+                              width=x1 - x0, height=y1 - y0)
+    if size is not None and (image.shape[1], image.shape[0]) != tuple(size):
+        sx, sy = size[0] / image.shape[1], size[1] / image.shape[0]
+        # Depth is never interpolated, mixing depths across an edge creates points that do not exist
+        interpolation = cv2.INTER_NEAREST if nearest else cv2.INTER_AREA
+        image = cv2.resize(image, tuple(size), interpolation=interpolation)
+        if intrinsics:
+            intrinsics.update(fx=float(intrinsics["fx"]) * sx, fy=float(intrinsics["fy"]) * sy,
+                              ppx=(float(intrinsics["ppx"]) + 0.5) * sx - 0.5,
+                              ppy=(float(intrinsics["ppy"]) + 0.5) * sy - 0.5, width=size[0], height=size[1])
+    return image, intrinsics
+
+
+def camera_matrix(intrinsics):
+    return np.array([[intrinsics["fx"], 0, intrinsics["ppx"]], [0, intrinsics["fy"], intrinsics["ppy"]], [0, 0, 1]],
+                    dtype=np.float32)
+
+
+def build_sample(sample, streams, crop=None, size=None):
+    """({stream: image}, info) for one capture or None when a requested stream is missing"""
+    key, source, idx, time_str = sample
+    meta = read_capture(source, idx, "meta") or {}
+    images, intrinsics = {}, {}
+    for stream in streams:
+        image = read_capture(source, idx, stream)
+        if image is None:
+            return None
+        calibration = meta.get(INTRINSICS.get(stream)) or (meta.get("colour_intrinsics") if "aligned" in stream
+                                                           else None)
+        images[stream], intrinsics[stream] = crop_and_resize(image, calibration, crop, size, stream in RAW_DEPTH)
+    info = {"key": key, "idx": idx, "time": time_str, "intrinsics": {k: v for k, v in intrinsics.items() if v},
+            "depth_scale": meta.get("depth_scale"),
+            "extrinsics": {k: v for k, v in meta.items() if k.endswith("_extrinsics")},
+            "frame_info": {k: v for k, v in meta.items() if not k.endswith(("_intrinsics", "_extrinsics"))
+                           and k != "depth_scale"}}
+    return images, info
+
+
+def _encode_png(image):
+    import cv2
+    ok, payload = cv2.imencode(".png", image)
+    if not ok:
+        raise ValueError("Could not encode image")
+    return payload.tobytes()
+
+
+def _add_bytes(tar, name, payload):
+    member = tarfile.TarInfo(name)
+    member.size = len(payload)
+    tar.addfile(member, io.BytesIO(payload))
+
+
+def _add_array(archive, name, array):
+    with archive.open(name + ".npy", "w", force_zip64=True) as fh:
+        np.lib.format.write_array(fh, np.asanyarray(array), allow_pickle=False)
+
+
+def write_shard(job):
+    """Build one shard, returns its manifest entry"""
+    path, name, session, samples, settings = job
+    path = pathlib.Path(path)
+    partial = path.with_name(path.name + ".partial")
+    streams, crop, size = settings["streams"], settings["crop"], settings["resize"]
+    written, skipped = [], []
+    if settings["format"] == "tar":
+        archive = tarfile.open(str(partial), "w")
+    else:
+        archive = zipfile.ZipFile(str(partial), "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1)
+    with archive:
+        for sample in samples:
+            built = build_sample(sample, streams, crop, size)
+            if built is None:
+                skipped.append(sample[0])
+                continue
+            images, info = built
+            key = info["key"]
+            text = json.dumps(info, default=str).encode()
+            if settings["format"] == "tar":
+                for stream, image in images.items():
+                    _add_bytes(archive, f"{key}.{stream}.png", _encode_png(image))
+                _add_bytes(archive, f"{key}.json", text)
+            else:
+                for stream, image in images.items():
+                    _add_array(archive, f"{key}.{stream}", image)
+                    if stream in info["intrinsics"]:
+                        _add_array(archive, f"{key}.{stream}_K", camera_matrix(info["intrinsics"][stream]))
+                _add_array(archive, f"{key}.json", np.array(text.decode()))
+            written.append(key)
+    os.replace(str(partial), str(path))
+    return {"shard": path.name, "session": session, "samples": len(written), "skipped": skipped,
+            "first": written[0] if written else None, "last": written[-1] if written else None,
+            "digest": _digest([s[0] for s in samples]), "bytes": path.stat().st_size}
+
+
+def read_manifest(out):
+    """{shard: entry} of finished shards, later entries win"""
+    entries = {}
+    path = pathlib.Path(out) / MANIFEST_FILE
+    if path.exists():
+        with path.open('r') as fh:
+            for line in fh:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break  # Truncated final line from an interrupted export
+                entries[entry["shard"]] = entry
+    return entries
+
+
+def export_dataset(sessions, out, streams=DEFAULT_STREAMS, fmt="tar", shard_size=256, resize=None, crop=None,
+                   workers=None, log=print):
+    """Write every missing or out of date shard of the sessions into out, returns the number of shards written"""
+    out = pathlib.Path(out)
+    out.mkdir(parents=True, exist_ok=True)
+    settings = {"format": fmt, "streams": list(streams), "shard_size": shard_size,
+                "resize": list(resize) if resize else None, "crop": list(crop) if crop else None}
+    settings_path = out / DATASET_FILE
+    done = read_manifest(out)
+    if settings_path.exists() and json.loads(settings_path.read_text()) != settings:
+        log(f"{out} was exported with different settings, rebuilding every shard")
+        done = {}
+        (out / MANIFEST_FILE).unlink(missing_ok=True)
+    settings_path.write_text(json.dumps(settings, indent=2))
+
+    suffix = ".tar" if fmt == "tar" else ".npz"
+    jobs = []
+    shards = plan_shards(sessions, shard_size)
+    for name, session, samples in shards:
+        path = out / (name + suffix)
+        entry = done.get(path.name)
+        if entry is not None and entry["digest"] == _digest([s[0] for s in samples]) and path.exists():
+            continue
+        jobs.append((str(path), name, session, samples, settings))
+    log(f"{len(shards) - len(jobs)} of {len(shards)} shards already exported, writing {len(jobs)}")
+    if not jobs:
+        return 0
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor, \
+            (out / MANIFEST_FILE).open('a') as manifest:
+        futures = [executor.submit(write_shard, job) for job in jobs]
+        for n, future in enumerate(as_completed(futures), 1):
+            entry = future.result()
+            manifest.write(json.dumps(entry) + "\n")
+            manifest.flush()
+            log(f"[{n}/{len(jobs)}] {entry['shard']} {entry['samples']} samples"
+                + (f", skipped {len(entry['skipped'])} missing a stream" if entry["skipped"] else ""))
+    return len(jobs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export saved sessions as tar or npz shards of training samples")
+    parser.add_argument("sessions", nargs="+", help="Session directories under saved_data")
+    parser.add_argument("--out", required=True, help="Directory the shards and manifest.jsonl are written to")
+    parser.add_argument("--format", default="tar", choices=["tar", "npz"])
+    parser.add_argument("--streams", default=",".join(DEFAULT_STREAMS),
+                        help="Comma separated streams per sample (colour, depth, ir_left, ir_right, aligned_depth, "
+                             "aligned_depth_cm)")
+    parser.add_argument("--shard-size", default=256, type=int, help="Samples per shard")
+    parser.add_argument("--resize", default=None, help="Resize every stream to WIDTHxHEIGHT e.g. 640x360")
+    parser.add_argument("--crop", default=None,
+                        help="Crop before resizing, left,top,right,bottom as fractions of the image e.g. 0,0.1,1,0.9")
+    parser.add_argument("--workers", default=None, type=int)
+    args = parser.parse_args()
+    streams = [s.strip() for s in args.streams.split(",") if s.strip()]
+    unknown = [s for s in streams if s not in INTRINSICS]
+    if unknown:
+        parser.error(f"Unknown streams {unknown}")
+    sessions = [p for p in args.sessions if pathlib.Path(p).is_dir()]
+    written = export_dataset(sessions, args.out, streams, args.format, args.shard_size, parse_size(args.resize),
+                             parse_crop(args.crop), args.workers)
+    print(f"Wrote {written} shards to {args.out}")
+
+
+if __name__ == '__main__':
+    main()
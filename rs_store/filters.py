@@ -0,0 +1,190 @@
+import time
+
+import numpy as np
+
+from rs_store.metrics import observe
+from rs_store.save import log
+
+STAGES = ("before_align", "after_align")
+BACKENDS = ("numpy", "realsense")
+# librealsense temporal filter persistency modes as (valid frames required, out of the last n)
+PERSISTENCY = {0: None, 1: (8, 8), 2: (2, 3), 3: (2, 4), 4: (2, 8), 5: (1, 2), 6: (1, 5), 7: (1, 8), 8: (0, 8)}
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _smooth_pass(d, alpha, delta, reverse):
+    """One recursive edge preserving pass down the rows of d, every column is processed at once"""
+    steps = range(d.shape[0] - 2, -1, -1) if reverse else range(1, d.shape[0])
+    diff = np.empty(d.shape[1], dtype=d.dtype)
+    mask = np.empty(d.shape[1], dtype=bool)
+    valid = d > 0
+    for i in steps:
+        prev = d[i + 1] if reverse else d[i - 1]
+        cur = d[i]
+        np.subtract(cur, prev, out=diff)
+        np.abs(diff, out=diff)
+        np.less(diff, delta, out=mask)
+        mask &= valid[i]
+        mask &= valid[i + 1 if reverse else i - 1]
+        # cur = alpha * cur + (1 - alpha) * prev == cur - (1 - alpha) * (cur - prev)
+        np.subtract(cur, prev, out=diff)
+        diff *= 1 - alpha
+        np.subtract(cur, diff, out=cur, where=mask)
+
+
+class SpatialFilter:
+    name = "spatial"
+
+    def __init__(self, filter_magnitude=2, filter_smooth_alpha=0.5, filter_smooth_delta=20, **kwargs):
+        self.magnitude = int(filter_magnitude)
+        self.alpha = float(filter_smooth_alpha)
+        self.delta = float(filter_smooth_delta)
+
+    def __call__(self, depth):
+        d = depth.astype(np.float32)
+        for _ in range(self.magnitude):
+            # Horizontal passes run down the rows of the transposed copy so each step reads contiguous memory
+            t = np.ascontiguousarray(d.T)
+            _smooth_pass(t, self.alpha, self.delta, reverse=False)
+            _smooth_pass(t, self.alpha, self.delta, reverse=True)
+            d = np.ascontiguousarray(t.T)
+            _smooth_pass(d, self.alpha, self.delta, reverse=False)
+            _smooth_pass(d, self.alpha, self.delta, reverse=True)
+        return d
+
+    def rs_block(self, rs):
+        block = rs.spatial_filter()
+        block.set_option(rs.option.filter_magnitude, self.magnitude)
+        block.set_option(rs.option.filter_smooth_alpha, self.alpha)
+        block.set_option(rs.option.filter_smooth_delta, self.delta)
+        return block
+
+
+class TemporalFilter:
+    """Blends each pixel with its filtered history, stateful so it should see every frame of a stream"""
+    name = "temporal"
+
+    def __init__(self, filter_smooth_alpha=0.4, filter_smooth_delta=20, persistency_mode=3, **kwargs):
+        self.alpha = float(filter_smooth_alpha)
+        self.delta = float(filter_smooth_delta)
+        self.persistency_mode = int(persistency_mode)
+        self.reset()
+
+    def reset(self):
+        self._previous = None
+        self._history = None
+
+    def __call__(self, depth):
+        d = depth.astype(np.float32)
+        valid = d > 0
+        if self._previous is None or self._previous.shape != d.shape:
+            self._previous = d.copy()
+            self._history = valid.astype(np.uint8)
+            return d
+        prev = self._previous
+        mask = valid & (prev > 0) & (np.abs(d - prev) < self.delta)
+        d[mask] = self.alpha * d[mask] + (1 - self.alpha) * prev[mask]
+
+        persistency = PERSISTENCY.get(self.persistency_mode)
+        if persistency is not None:
+            required, last = persistency
+            recent = self._history & np.uint8((1 << last) - 1)
+            fill = ~valid & (prev > 0) & (POPCOUNT[recent] >= required)
+            d[fill] = prev[fill]
+        self._history = (self._history << 1) | valid.astype(np.uint8)
+        self._previous = d
+        return d.copy()
+
+    def rs_block(self, rs):
+        block = rs.temporal_filter()
+        block.set_option(rs.option.filter_smooth_alpha, self.alpha)
+        block.set_option(rs.option.filter_smooth_delta, self.delta)
+        block.set_option(rs.option.holes_fill, self.persistency_mode)
+        return block
+
+
+FILTERS = {"spatial": SpatialFilter, "temporal": TemporalFilter}
+
+
+class PostProcessor:
+    """Depth post-processing configured by the filters: block of the config.
+
+        filters:
+          stage: after_align  # before_align filters depth (and aligns the filtered depth with the realsense backend)
+          backend: numpy      # or realsense to use the librealsense filter blocks
+          spatial: {...}
+          temporal: {...}
+
+    Filters run in the order they are declared, time spent in each is kept in timings (name -> [count, seconds]).
+    """
+
+    def __init__(self, filters, stage="after_align", backend="numpy"):
+        if stage not in STAGES:
+            raise ValueError(f"Unknown filter stage '{stage}' (choose from {STAGES})")
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown filter backend '{backend}' (choose from {BACKENDS})")
+        self.filters = filters
+        self.stage = stage
+        self.backend = backend
+        self.stream = "depth" if stage == "before_align" else "aligned_depth"
+        self.timings = {f.name: [0, 0.0] for f in filters}
+        self._rs_blocks = None
+
+    @classmethod
+    def from_config(cls, config, backend=None):
+        if not config.has_key("filters") or not config.filters:
+            return None
+        options = dict(config.filters)
+        stage = options.pop("stage", "after_align")
+        backend = backend or options.pop("backend", "numpy")
+        options.pop("backend", None)
+        filters = []
+        for name, params in options.items():
+            if name not in FILTERS:
+                raise ValueError(f"Unknown depth filter '{name}' (choose from {list(FILTERS)})")
+            filters.append(FILTERS[name](**(params or {})))
+        return cls(filters, stage=stage, backend=backend) if filters else None
+
+    @property
+    def stateful(self):
+        return any(isinstance(f, TemporalFilter) for f in self.filters)
+
+    def _timed(self, name, fn, value):
+        start = time.perf_counter()
+        value = fn(value)
+        timing = self.timings[name]
+        timing[0] += 1
+        elapsed = time.perf_counter() - start
+        timing[1] += elapsed
+        observe("rs_store_capture_seconds", elapsed, stage=f"filter_{name}")
+        return value
+
+    def apply(self, depth):
+        """Filter a uint16 depth image with the numpy implementations"""
+        if depth is None:
+            return None
+        for f in self.filters:
+            depth = self._timed(f.name, f, depth)
+        return np.clip(np.rint(depth), 0, np.iinfo(np.uint16).max).astype(np.uint16)
+
+    def process(self, frame):
+        """Filter a librealsense depth frame (or frameset) with the librealsense blocks"""
+        if self._rs_blocks is None:
+            import pyrealsense2 as rs
+            self._rs_blocks = [(f.name, f.rs_block(rs)) for f in self.filters]
+        for name, block in self._rs_blocks:
+            frame = self._timed(name, block.process, frame)
+        return frame
+
+    def attach(self, frames):
+        """Filter the configured stream of a lazy frame set when it is read (numpy backend)"""
+        producer = frames._producers.get(self.stream)
+        if producer is not None:
+            frames._producers[self.stream] = lambda f: self.apply(producer(f))
+        return frames
+
+    def summary(self):
+        return ", ".join(f"{name}={1000 * total / max(count, 1):.1f}ms" for name, (count, total) in self.timings.items())
+
+    def log_summary(self):
+        log(f"Depth filters ({self.backend}, {self.stage}): {self.summary()}")
@@ -0,0 +1,111 @@
+import json
+import threading
+
+import numpy as np
+
+from rs_store.utils import get_str_datetime
+
+GATE_FILE = "gate.jsonl"
+SIGNATURE_STREAMS = ("colour", "depth")
+
+
+class GateDecision:
+    __slots__ = ("saved", "reason", "score", "scores", "since_saved")
+
+    def __init__(self, saved, reason, score, scores, since_saved):
+        self.saved = saved
+        self.reason = reason
+        self.score = score
+        self.scores = scores
+        self.since_saved = since_saved
+
+
+def signature(frames, streams=SIGNATURE_STREAMS, size=(32, 24)):
+    """Tiny float32 thumbnails of the given streams (colour as grey levels, depth in raw units)"""
+    import cv2
+    sig = {}
+    colour = frames.colour if "colour" in streams else None
+    if colour is not None:
+        grey = cv2.cvtColor(colour, cv2.COLOR_BGR2GRAY) if colour.ndim == 3 else colour
+        sig["colour"] = cv2.resize(grey, size, interpolation=cv2.INTER_AREA).astype(np.float32)
+    depth = frames.depth if "depth" in streams else None
+    if depth is not None:
+        # Nearest so missing depth (0) is not averaged into its neighbours
+        sig["depth"] = cv2.resize(depth, size, interpolation=cv2.INTER_NEAREST).astype(np.float32)
+    return sig
+
+
+def change(previous, current, depth_tolerance=50):
+    """Percentage change per stream, mean absolute grey level difference for colour, share of pixels valid in both
+    that moved more than depth_tolerance for depth"""
+    scores = {}
+    for stream, value in current.items():
+        last = previous.get(stream)
+        if last is None or last.shape != value.shape:
+            scores[stream] = 100.0
+        elif stream == "depth":
+            valid = (last > 0) & (value > 0)
+            moved = np.abs(value - last) > depth_tolerance
+            appeared = (last > 0) != (value > 0)
+            scores[stream] = 100.0 * float(np.count_nonzero((moved & valid) | appeared)) / value.size
+        else:
+            scores[stream] = 100.0 * float(np.mean(np.abs(value - last))) / 255
+    return scores
+
+
+class ChangeGate:
+    """Decides whether a capture differs enough from the last saved one to be worth saving.
+
+    A capture is saved when any camera's signature changed by more than threshold percent (see change()), on the
+    first capture, when forced (space key) and at least every keyframe_every captures considered. Every decision is
+    appended to <session>/gate.jsonl so gaps in a session can be explained.
+    """
+
+    def __init__(self, threshold=1.0, keyframe_every=60, streams=SIGNATURE_STREAMS, depth_tolerance=50,
+                 size=(32, 24)):
+        self.threshold = threshold
+        self.keyframe_every = keyframe_every
+        self.streams = tuple(streams)
+        self.depth_tolerance = depth_tolerance
+        self.size = size
+        self.saved = 0
+        self.skipped = 0
+        self._last = {}
+        self._since_saved = 0
+        self._lock = threading.Lock()
+
+    def decide(self, group, force=False):
+        """group maps serial numbers to frames (a FrameGroup or a dict), returns a GateDecision"""
+        current = {serial: signature(frames, self.streams, self.size) for serial, frames in group.items()}
+        scores = {}
+        for serial, sig in current.items():
+            for stream, score in change(self._last.get(serial, {}), sig, self.depth_tolerance).items():
+                scores[f"{serial}/{stream}"] = round(score, 3)
+        score = max(scores.values()) if scores else 100.0
+        with self._lock:
+            self._since_saved += 1
+            if force:
+                reason = "forced"
+            elif not self._last:
+                reason = "first"
+            elif score > self.threshold:
+                reason = "changed"
+            elif self.keyframe_every and self._since_saved >= self.keyframe_every:
+                reason = "keyframe"
+            else:
+                reason = "unchanged"
+            decision = GateDecision(reason != "unchanged", reason, score, scores, self._since_saved)
+            if decision.saved:
+                self._last = current
+                self._since_saved = 0
+                self.saved += 1
+            else:
+                self.skipped += 1
+        return decision
+
+    def record(self, path, decision, idx=None, time_str=None):
+        """Append a decision to the session's gate.jsonl, idx is the capture index it was saved as (None if skipped)"""
+        with open(str(path), 'a') as fh:
+            fh.write(json.dumps({"time": time_str or get_str_datetime(), "idx": idx, "saved": decision.saved,
+                                 "reason": decision.reason, "score": round(decision.score, 3),
+                                 "scores": decision.scores, "threshold": self.threshold}) + "\n")
@@ -0,0 +1,229 @@
+import hashlib
+import json
+import os
+import pathlib
+import threading
+import time
+
+import numpy as np
+
+from rs_store.data import join_meta
+from rs_store.save import json_default
+
+CALIBRATION_FILE = "calibration.jsonl"
+FRAMES_FILE = "frames.jsonl"
+# Columns every frame record has, the rest are the source's frame_info
+RECORD_KEYS = ("idx", "time", "serial", "calibration", "files")
+
+
+def calibration_id(calibration):
+    """Short content hash, the same calibration gets the same id in every session"""
+    text = json.dumps(calibration, default=json_default, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(text.encode()).hexdigest()[:12]
+
+
+class MetadataLog:
+    """Session metadata written as two append-only line delimited json files next to the camera directories.
+
+        calibration.jsonl   {"id": ..., "calibration": {...}}, once per distinct calibration (profile change)
+        frames.jsonl        {"idx", "time", "serial", "calibration": id, "files": {stream: name}, **frame_info}
+
+    Frame records are buffered and written in batches (every batch_size records or flush_interval seconds), call
+    flush() or close() to make sure everything is on disk. Calibrations are written straight away so a frame record
+    never refers to one that is not in the file. A later record for the same capture and camera (e.g. streams derived
+    offline) adds its files to the first one. Read it back with load_metadata().
+    """
+
+    def __init__(self, path, batch_size=64, flush_interval=2.0):
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.bytes_written = 0
+        self._lock = threading.Lock()
+        self._pending = []
+        self._last_flush = time.monotonic()
+        self._known = set()
+        # id(calibration) -> (calibration, id), sources return the same dict until their profile changes so hashing
+        # only happens then. The dict is kept so its id() can not be reused by another object.
+        self._by_object = {}
+        calibration_file = self.path / CALIBRATION_FILE
+        if calibration_file.exists():
+            self._known.update(record["id"] for record in _read_lines(calibration_file))
+        self._calibration_fh = calibration_file.open('a')
+        self._frames_fh = (self.path / FRAMES_FILE).open('a')
+
+    def _calibration_id(self, calibration):
+        entry = self._by_object.get(id(calibration))
+        if entry is not None and entry[0] is calibration:
+            return entry[1]
+        cid = calibration_id(calibration)
+        if len(self._by_object) > 256:
+            self._by_object.clear()
+        self._by_object[id(calibration)] = (calibration, cid)
+        if cid not in self._known:
+            self._known.add(cid)
+            line = json.dumps({"id": cid, "calibration": calibration}, default=json_default) + "\n"
+            self._calibration_fh.write(line)
+            self._calibration_fh.flush()
+            self.bytes_written += len(line)
+        return cid
+
+    def append(self, idx, time_str, serial, calibration=None, frame_info=None, files=None):
+        with self._lock:
+            record = {"idx": int(idx), "time": time_str, "serial": str(serial),
+                      "calibration": None if not calibration else self._calibration_id(calibration),
+                      "files": files or {}}
+            for k, v in (frame_info or {}).items():
+                record.setdefault(k, v)
+            self._pending.append(json.dumps(record, default=json_default) + "\n")
+            if len(self._pending) >= self.batch_size or time.monotonic() - self._last_flush > self.flush_interval:
+                self._flush()
+
+    def _flush(self):
+        if self._pending:
+            text = "".join(self._pending)
+            self._frames_fh.write(text)
+            self._frames_fh.flush()
+            self.bytes_written += len(text)
+            self._pending = []
+        self._last_flush = time.monotonic()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._frames_fh.close()
+            self._calibration_fh.close()
+
+
+def _read_lines(path):
+    records = []
+    with open(str(path), 'r') as fh:
+        for line in fh:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break  # Truncated final line from an unclean shutdown
+    return records
+
+
+def _column(values):
+    if all(isinstance(v, bool) for v in values):
+        return np.array(values, dtype=bool)
+    if all(isinstance(v, int) and not isinstance(v, bool) for v in values):
+        return np.array(values, dtype=np.int64)
+    if all(v is None or (isinstance(v, (int, float)) and not isinstance(v, bool)) for v in values):
+        return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+    return np.array(values, dtype=object)
+
+
+class SessionMetadata:
+    """A session's metadata log as columns (numpy arrays, one row per frame record) plus the calibrations by id"""
+
+    def __init__(self, columns, calibrations):
+        self.columns = columns
+        self.calibrations = calibrations
+        self._rows = None
+
+    def __len__(self):
+        return len(self.columns.get("idx", ()))
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def select(self, serial):
+        """Only the records of one camera"""
+        keep = self.columns["serial"] == str(serial) if len(self) else np.zeros(0, dtype=bool)
+        return SessionMetadata({k: v[keep] for k, v in self.columns.items()}, self.calibrations)
+
+    def row(self, idx, serial=None):
+        """Position of capture idx (of serial) in the columns, or None"""
+        if self._rows is None:
+            self._rows = {}
+            for i, (capture, camera) in enumerate(zip(self.columns.get("idx", ()), self.columns.get("serial", ()))):
+                self._rows.setdefault((int(capture), camera), i)
+                self._rows.setdefault((int(capture), None), i)
+        return self._rows.get((int(idx), None if serial is None else str(serial)))
+
+    def calibration(self, idx, serial=None):
+        i = self.row(idx, serial)
+        return None if i is None else self.calibrations.get(self.columns["calibration"][i])
+
+    def frame_info(self, idx, serial=None):
+        i = self.row(idx, serial)
+        if i is None:
+            return None
+        info = {}
+        for k, column in self.columns.items():
+            if k not in RECORD_KEYS:
+                v = column[i]
+                v = v.item() if isinstance(v, np.generic) else v
+                if not (isinstance(v, float) and np.isnan(v)):
+                    info[k] = v
+        return info
+
+    def meta(self, idx, serial=None):
+        """The same dict the meta stream of a capture holds (calibration and frame_info joined), or None"""
+        i = self.row(idx, serial)
+        if i is None:
+            return None
+        return join_meta(self.calibration(idx, serial), self.frame_info(idx, serial))
+
+
+def load_metadata(path):
+    """Read a session's calibration.jsonl and frames.jsonl in one pass, path is the session or one of its camera
+    directories. Returns a SessionMetadata, empty if the session has no metadata log."""
+    path = find_metadata(path) or pathlib.Path(path)
+    calibrations = {}
+    if (path / CALIBRATION_FILE).exists():
+        calibrations = {r["id"]: r["calibration"] for r in _read_lines(path / CALIBRATION_FILE)}
+    merged = {}
+    for record in _read_lines(path / FRAMES_FILE) if (path / FRAMES_FILE).exists() else []:
+        key = (record.get("idx"), record.get("serial"))
+        if key not in merged:
+            merged[key] = record
+            continue
+        first = merged[key]
+        first["files"] = dict(first.get("files") or {}, **(record.get("files") or {}))
+        for k, v in record.items():
+            if v is not None and first.get(k) is None:
+                first[k] = v
+    records = list(merged.values())
+    keys = list(RECORD_KEYS)
+    for record in records:
+        for k in record:
+            if k not in keys:
+                keys.append(k)
+    columns = {k: _column([record.get(k) for record in records]) for k in keys} if records else {}
+    return SessionMetadata(columns, calibrations)
+
+
+def find_metadata(path):
+    """The directory holding the metadata log of a session or camera directory, or None"""
+    path = pathlib.Path(path)
+    for candidate in (path, path.parent):
+        if (candidate / FRAMES_FILE).exists():
+            return candidate
+    return None
+
+
+_loaded = {}
+
+
+def capture_meta(directory, idx):
+    """Meta of capture idx of a camera directory from its session's metadata log (loaded once per process and
+    reloaded when the log grows), None if there is no record for it"""
+    directory = pathlib.Path(directory)
+    location = find_metadata(directory)
+    if location is None:
+        return None
+    key = str(location.resolve())
+    size = os.stat(str(location / FRAMES_FILE)).st_size
+    if key not in _loaded or _loaded[key][0] != size:
+        _loaded[key] = (size, load_metadata(location))
+    serial = directory.name if location != directory else None
+    return _loaded[key][1].meta(idx, serial)
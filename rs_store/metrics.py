@@ -0,0 +1,196 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds, spans a cheap numpy conversion up to a stalled disk write
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+DESCRIPTIONS = {
+    "rs_store_capture_seconds": "Time spent in each stage of getting a frame set ready (wait, align, colourise, ...)",
+    "rs_store_save_seconds": "Time spent encoding and writing each saved stream",
+    "rs_store_write_seconds": "Time from a writer picking up a task to it being written",
+    "rs_store_queue_wait_seconds": "Time tasks spent queued before a writer picked them up",
+    "rs_store_frames_total": "Frame sets read from each source",
+    "rs_store_invalid_framesets_total": "Frame sets skipped because a required frame was missing",
+    "rs_store_unsynced_groups_total": "Camera groups further apart than the sync tolerance",
+    "rs_store_dropped_tasks_total": "Write tasks discarded by the writer's overflow policy",
+    "rs_store_failed_writes_total": "Write tasks that raised",
+    "rs_store_saved_bytes_total": "Encoded bytes written to disk",
+    "rs_store_writer_queue_tasks": "Tasks waiting in the writer queue",
+    "rs_store_writer_queue_bytes": "Bytes waiting in the writer queue",
+    "rs_store_writer_in_flight": "Tasks currently being written",
+    "rs_store_schedule_jitter_seconds": "How far each scheduled capture's frame set was from its deadline",
+    "rs_store_schedule_missed_total": "Scheduled capture deadlines skipped because the previous capture overran",
+    "rs_store_pool_exhausted_total": "Captures copied to private memory because every pooled buffer was in use",
+    "rs_store_commit_seconds": "Time to sync and publish each group of completed captures",
+    "rs_store_published_captures_total": "Captures whose files were renamed to their final names",
+}
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimated by interpolating within the bucket the quantile falls in"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+class Registry:
+    """Thread safe histograms, counters and gauges keyed by metric name and labels.
+
+    Metrics recorded in process writer workers stay in those processes, the parent only sees the writer's own
+    timings (rs_store_write_seconds) for them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def inc(self, name, n=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def set_gauge(self, name, value, **labels):
+        """value may be a number or a callable read when the metrics are collected"""
+        with self._lock:
+            self.gauges[self._key(name, labels)] = value
+
+    @contextmanager
+    def timed(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def clear(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+            self.gauges.clear()
+
+    def _snapshot(self):
+        with self._lock:
+            histograms = {k: (h.buckets, list(h.counts), h.sum, h.count) for k, h in self.histograms.items()}
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+        for key, value in gauges.items():
+            try:
+                gauges[key] = value() if callable(value) else value
+            except Exception:
+                gauges[key] = float("nan")
+        return histograms, counters, gauges
+
+    def prometheus(self):
+        """The metrics in the Prometheus text exposition format"""
+        histograms, counters, gauges = self._snapshot()
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in DESCRIPTIONS:
+                    lines.append(f"# HELP {name} {DESCRIPTIONS[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), (buckets, counts, total, count) in sorted(histograms.items()):
+            describe(name, "histogram")
+            cumulative = 0
+            for upper, n in zip(list(buckets) + ["+Inf"], counts):
+                cumulative += n
+                lines.append(f"{name}_bucket{_labels(labels + (('le', str(upper)),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+        for kind, values in (("counter", counters), ("gauge", gauges)):
+            for (name, labels), value in sorted(values.items()):
+                describe(name, kind)
+                lines.append(f"{name}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Short human readable lines for log.txt, latencies are estimated from the histogram buckets"""
+        histograms, counters, gauges = self._snapshot()
+        lines = []
+        for (name, labels), (buckets, counts, total, count) in sorted(histograms.items()):
+            h = Histogram(buckets)
+            h.counts, h.sum, h.count = counts, total, count
+            lines.append(f"{name}{_labels(labels)} n={count} mean={total / max(count, 1) * 1000:.2f}ms "
+                         f"p50={h.quantile(0.5) * 1000:.2f}ms p95={h.quantile(0.95) * 1000:.2f}ms")
+        for (name, labels), value in sorted(counters.items()) + sorted(gauges.items()):
+            lines.append(f"{name}{_labels(labels)} {value}")
+        return lines
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = ((k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+# Process wide registry used by the capture, filter and save code
+METRICS = Registry()
+observe = METRICS.observe
+inc = METRICS.inc
+set_gauge = METRICS.set_gauge
+timed = METRICS.timed
+
+
+def serve(port, host="127.0.0.1", registry=METRICS):
+    """Serve registry.prometheus() at http://host:port/metrics from a background thread, returns the server"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name="rs_store-metrics").start()
+    return server
@@ -0,0 +1,139 @@
+import threading
+import time
+from collections import deque
+
+from rs_store.metrics import inc
+from rs_store.save import log
+from rs_store.sources import VISUALISE_STREAMS
+
+
+class FrameGroup(dict):
+    """Frame sets from several cameras (serial -> RealsenseData) that were captured at about the same time"""
+
+    def __init__(self, frames, timestamps=None, tolerance_ms=None):
+        super().__init__(frames)
+        self.timestamps = timestamps or {}
+        values = list(self.timestamps.values())
+        self.timestamp = min(values) if values else None
+        self.skew_ms = max(values) - min(values) if values else 0.0
+        self.synced = tolerance_ms is None or self.skew_ms <= tolerance_ms
+
+
+def frame_timestamp(frames):
+    info = frames.frame_info or {}
+    return info.get("timestamp")
+
+
+class _CaptureThread(threading.Thread):
+    def __init__(self, source, depth):
+        super().__init__(daemon=True, name=f"rs_store-capture-{source.serial_number}")
+        self.source = source
+        self.recent = deque(maxlen=depth)
+        self.cv = None
+        self.error = None
+        self.running = True
+
+    def run(self):
+        while self.running:
+            try:
+                frames = self.source.get_frames()
+                timestamp = frame_timestamp(frames)
+                if timestamp is None:
+                    timestamp = time.time() * 1000
+            except Exception as e:
+                self.error = e
+                with self.cv:
+                    self.cv.notify_all()
+                return
+            with self.cv:
+                self.recent.append((timestamp, frames))
+                self.cv.notify_all()
+
+
+class MultiCamera:
+    """Captures from N frame sources in one process and groups their frames by hardware timestamp.
+
+    Each source is read on its own thread keeping the last few frame sets, get_frames() waits until every camera
+    has a frame newer than the previous group and then picks, per camera, the frame closest to the oldest of the
+    newest frames. Groups further apart than tolerance_ms are still returned but marked as not synced.
+    A single source is read directly with no extra threads.
+
+    With several sources, create them with visualise=False and set visualise here, the first camera is shown (on the
+    source's preview thread, so the display never holds up grouping).
+    """
+
+    def __init__(self, sources, tolerance_ms=20, depth=4, visualise=False):
+        if not sources:
+            raise ValueError("MultiCamera needs at least one frame source")
+        self.sources = list(sources)
+        self.tolerance_ms = tolerance_ms
+        self.serial_numbers = [str(s.serial_number) for s in self.sources]
+        if len(set(self.serial_numbers)) != len(self.serial_numbers):
+            raise ValueError(f"Frame sources must have unique serial numbers not {self.serial_numbers}")
+        self.visualise = visualise and len(self.sources) > 1
+        self._last = {}
+        self._cv = threading.Condition()
+        self._threads = []
+        if len(self.sources) > 1:
+            for source in self.sources:
+                thread = _CaptureThread(source, depth)
+                thread.cv = self._cv
+                self._threads.append(thread)
+
+    def require(self, save=(), visualise=()):
+        for i, source in enumerate(self.sources):
+            shown = VISUALISE_STREAMS if self.visualise and i == 0 else ()
+            source.require(save=save, visualise=tuple(visualise) + tuple(shown))
+
+    def start(self):
+        for thread in self._threads:
+            if not thread.is_alive():
+                thread.start()
+
+    def stop(self):
+        for thread in self._threads:
+            thread.running = False
+        for thread in self._threads:
+            thread.join(timeout=5)
+        for source in self.sources:
+            source.stop()
+
+    def drain(self):
+        """Drains a single source, with several sources their capture threads keep reading (lazily) anyway"""
+        return self.sources[0].drain() if not self._threads else 0
+
+    def _ready(self):
+        for serial, thread in zip(self.serial_numbers, self._threads):
+            if thread.error is not None:
+                return True
+            if not thread.recent or thread.recent[-1][0] == self._last.get(serial):
+                return False
+        return True
+
+    def get_frames(self, return_key=False):
+        if not self._threads:
+            source = self.sources[0]
+            frames, key_code = source.get_frames(return_key=True)
+            group = FrameGroup({self.serial_numbers[0]: frames}, {self.serial_numbers[0]: frame_timestamp(frames)})
+        else:
+            self.start()
+            with self._cv:
+                self._cv.wait_for(self._ready)
+                for thread in self._threads:
+                    if thread.error is not None:
+                        raise thread.error
+                recent = {serial: list(t.recent) for serial, t in zip(self.serial_numbers, self._threads)}
+            reference = min(r[-1][0] for r in recent.values())
+            frames, timestamps = {}, {}
+            for serial, candidates in recent.items():
+                timestamp, f = min(candidates, key=lambda c: abs(c[0] - reference))
+                frames[serial], timestamps[serial] = f, timestamp
+            self._last = timestamps
+            group = FrameGroup(frames, timestamps, self.tolerance_ms)
+            if not group.synced:
+                inc("rs_store_unsynced_groups_total")
+                log(f"Cameras out of sync by {group.skew_ms:.1f}ms (tolerance {self.tolerance_ms}ms)")
+            key_code = self.sources[0].render(group[self.serial_numbers[0]]) if self.visualise else None
+        if return_key:
+            return group, key_code
+        return group
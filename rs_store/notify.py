@@ -0,0 +1,236 @@
+import asyncio
+import http.client
+import json
+import socket
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from rs_store.save import log
+
+
+def get_interfaces():
+    extra_info = {}
+    try:
+        extra_info["HOST"] = socket.gethostname()
+    except Exception as e:
+        print("Could not get hostname:", e)
+    try:
+        import netifaces
+        for interface in netifaces.interfaces():
+            try:
+                for link in netifaces.ifaddresses(interface)[netifaces.AF_INET]:
+                    extra_info[f"IP {interface}"] = link['addr']
+            except Exception:
+                pass  # Interfaces without an IPv4 address
+    except Exception as e:
+        print("Could not get network interfaces:", e)
+    return extra_info
+
+
+class HTTPClient:
+    """Keeps one connection open per host, requests are made from a single thread"""
+
+    def __init__(self, timeout=10):
+        self.timeout = timeout
+        self._connections = {}
+
+    def _connection(self, parts):
+        key = (parts.scheme, parts.netloc)
+        if key not in self._connections:
+            cls = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+            self._connections[key] = cls(parts.netloc, timeout=self.timeout)
+        return self._connections[key]
+
+    def request(self, method, url, body=None, headers=None):
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        for retry in (False, True):
+            connection = self._connection(parts)
+            try:
+                connection.request(method, path, body=body, headers=headers or {})
+                response = connection.getresponse()
+                response.read()
+                if response.status >= 400:
+                    raise IOError(f"{method} {url} returned {response.status} {response.reason}")
+                return response.status
+            except (http.client.RemoteDisconnected, http.client.CannotSendRequest, BrokenPipeError,
+                    ConnectionResetError):
+                # The server closed the kept-alive connection, reconnect once before counting it as a failure
+                self.close(parts)
+                if retry:
+                    raise
+            except Exception:
+                self.close(parts)
+                raise
+
+    def close(self, parts=None):
+        keys = list(self._connections) if parts is None else [(parts.scheme, parts.netloc)]
+        for key in keys:
+            connection = self._connections.pop(key, None)
+            if connection is not None:
+                connection.close()
+
+
+class _Channel:
+    """Coalesces everything posted between sends into one message, sent at most once per interval"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.last_sent = None
+        self.count = 0
+        self.first = None
+        self.latest = None
+        self.urgent = []
+
+    def due(self, now):
+        return self.urgent or (self.count and (self.last_sent is None or now - self.last_sent >= self.interval))
+
+    def wait_time(self, now):
+        if self.urgent or not self.count or self.last_sent is None:
+            return 0
+        return max(0.0, self.interval - (now - self.last_sent))
+
+
+class Dispatcher:
+    """Sends health check pings and MS Teams notifications from an asyncio loop on its own thread.
+
+    Nothing here shares workers with disk writes. heartbeat() and notify() only record the event, repeated events
+    are coalesced so at most one ping per heartbeat_interval and one notification per notify_interval seconds are
+    sent, each carrying how many events it stands for. notify(..., urgent=True) (connected, errors) skips the rate
+    limit. Failed requests are retried with exponential backoff, host and interface information is looked up once.
+    """
+
+    def __init__(self, health_url=None, webhook_url=None, heartbeat_interval=60, notify_interval=300, timeout=10,
+                 max_attempts=4, backoff=1.0, max_backoff=60):
+        self.health_url = health_url
+        self.webhook_url = webhook_url
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sent = 0
+        self.failed = 0
+        self._channels = {"health": _Channel(heartbeat_interval), "webhook": _Channel(notify_interval)}
+        self._host_info = None
+        self._client = HTTPClient(timeout=timeout)
+        # A single worker so connections are only ever used from one thread
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rs_store-notify")
+        self._loop = asyncio.new_event_loop()
+        self._wake = None
+        self._closing = False
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True, name="rs_store-dispatcher")
+        self._started = threading.Event()
+        self._thread.start()
+        self._started.wait()
+
+    @property
+    def host_info(self):
+        if self._host_info is None:
+            self._host_info = get_interfaces()
+        return self._host_info
+
+    def heartbeat(self, **stats):
+        if self.health_url:
+            self._post("health", None, stats)
+
+    def notify(self, title, extra_info=None, urgent=False):
+        if self.webhook_url:
+            self._post("webhook", title, extra_info or {}, urgent)
+
+    def _post(self, name, title, info, urgent=False):
+        def record():
+            channel = self._channels[name]
+            if urgent:
+                channel.urgent.append((title, info))
+            else:
+                channel.count += 1
+                channel.first = channel.first or info
+                channel.latest = (title, info)
+            self._wake.set()
+        if not self._closed:
+            try:
+                self._loop.call_soon_threadsafe(record)
+            except RuntimeError:
+                pass  # Closed in the meantime
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._wake = asyncio.Event()
+        self._started.set()
+        self._loop.run_until_complete(self._dispatch())
+        self._loop.close()
+
+    async def _dispatch(self):
+        while True:
+            now = time.monotonic()
+            for name, channel in self._channels.items():
+                if channel.due(now) or (self._closing and channel.count):
+                    await self._flush(name, channel)
+            if self._closing and not any(c.urgent or c.count for c in self._channels.values()):
+                return
+            waits = [c.wait_time(time.monotonic()) for c in self._channels.values() if c.count or c.urgent]
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=min(waits) if waits else None)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _flush(self, name, channel):
+        messages = channel.urgent
+        channel.urgent = []
+        if channel.count and (self._closing or channel.last_sent is None or
+                              time.monotonic() - channel.last_sent >= channel.interval):
+            title, info = channel.latest
+            info = dict(info)
+            if channel.count > 1:
+                info["events_since_last_message"] = channel.count
+                if "capture_number" in channel.first:
+                    info["first_capture_number"] = channel.first["capture_number"]
+            messages.append((title, info))
+            channel.count, channel.first, channel.latest = 0, None, None
+            channel.last_sent = time.monotonic()
+        for title, info in messages:
+            await self._send(name, title, info)
+
+    def _request(self, name, title, info):
+        if name == "health":
+            body = "\n".join(f"{k}: {v}" for k, v in info.items()).encode()
+            return self._client.request("POST", self.health_url, body=body, headers={"Content-Type": "text/plain"})
+        info = dict(info)
+        info.update(self.host_info)
+        body = json.dumps({"title": title, "text": " " + ',   \n'.join([f"{k}: {v}" for k, v in info.items()])})
+        return self._client.request("POST", self.webhook_url, body=body.encode(),
+                                    headers={"Content-Type": "application/json"})
+
+    async def _send(self, name, title, info):
+        delay = self.backoff
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                await self._loop.run_in_executor(self._io, self._request, name, title, info)
+                self.sent += 1
+                return True
+            except Exception as e:
+                log(f"Failed to send {name} message (attempt {attempt}/{self.max_attempts}): {e}")
+                if attempt < self.max_attempts and not self._closing:
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.max_backoff)
+        self.failed += 1
+        return False
+
+    def close(self, timeout=30):
+        """Send anything still pending (ignoring the rate limits) and stop the dispatcher thread"""
+        if self._closed:
+            return
+        self._closed = True
+
+        def closing():
+            self._closing = True
+            self._wake.set()
+        self._loop.call_soon_threadsafe(closing)
+        self._thread.join(timeout=timeout)
+        self._io.shutdown(wait=False)
+        self._client.close()
@@ -0,0 +1,203 @@
+import pathlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from rs_store.container import ChunkedSessionReader, is_container
+from rs_store.data import to3d
+from rs_store.sources import list_session, read_stream
+from rs_store.utils import parse_capture_name
+
+
+def _camera_directories(path):
+    path = pathlib.Path(path)
+    return [path] + sorted(p for p in path.iterdir() if p.is_dir() and not p.name.startswith("."))
+
+
+def session_serials(path):
+    """Names of the camera directories of a session that hold captures (the directory itself for a camera folder)"""
+    return [d.name for d in _camera_directories(path) if is_container(d) or list_session(d)]
+
+
+def session_captures(path, serial=None):
+    """(key, time_str, {stream: loader}) for every capture in a session directory (loose files or chunked, including
+    <session>/<serial> sub folders), only those of camera serial if given"""
+    captures = []
+    for directory in _camera_directories(path):
+        if serial is not None and directory.name != serial:
+            continue
+        if is_container(directory):
+            reader = ChunkedSessionReader(directory)
+            for idx in reader.indices:
+                loaders = {k: (lambda idx=idx, k=k, reader=reader: reader.read(idx, k)) for k in reader.streams(idx)}
+                captures.append((f"{directory.name}_{idx:07d}", reader.time_str(idx), loaders))
+            continue
+        for idx, files in list_session(directory).items():
+            loaders = {k: (lambda p=p, k=k: read_stream(p, k)) for k, p in files.items()}
+            time_str = parse_capture_name(next(iter(files.values())))[1]
+            captures.append((f"{directory.name}_{idx:07d}", time_str, loaders))
+    return captures
+
+
+def catalog_captures(catalog, session, start=None, end=None, streams=None, serial=None):
+    readers = {}
+    captures = OrderedDict()
+    for _, serial, idx, _, time_str, stream, rel_path in catalog.query(start, end, session=session, serial=serial):
+        if streams is not None and stream not in streams:
+            continue
+        path = catalog.resolve(rel_path)
+        if path.is_dir():
+            reader = readers.get(path) or readers.setdefault(path, ChunkedSessionReader(path))
+            loader = lambda reader=reader, idx=idx, stream=stream: reader.read(idx, stream)
+        else:
+            loader = lambda path=path, stream=stream: read_stream(path, stream)
+        key = f"{serial}_{idx:07d}"
+        captures.setdefault(key, (key, time_str, {}))[2][stream] = loader
+    return list(captures.values())
+
+
+def session_refs(path, stream="colour"):
+    return [(key, loaders[stream]) for key, _, loaders in session_captures(path) if stream in loaders]
+
+
+def catalog_refs(catalog, session, stream="colour", start=None, end=None):
+    return [(key, loaders[stream]) for key, _, loaders in catalog_captures(catalog, session, start, end, [stream])]
+
+
+def for_display(stream, image):
+    """Make any stream showable with cv2.imshow (depth is colourised, IR is made three channel)"""
+    if image is None:
+        return None
+    if image.dtype == np.uint16:
+        return cv2.applyColorMap(cv2.convertScaleAbs(image, alpha=255 / 4000), cv2.COLORMAP_JET)
+    if image.ndim == 2:
+        return to3d(image)
+    return image
+
+
+class Player:
+    """Decodes frames on a thread pool ahead of the play position and keeps them in a memory bounded LRU cache.
+
+    refs is a list of (key, loader) pairs (see session_refs/catalog_refs). With thumbnail_width set, frames are
+    downscaled once and the thumbnails are written to thumbnail_dir (if given) so later sessions skip full decodes.
+    """
+
+    def __init__(self, refs, stream="colour", workers=4, cache_mb=256, readahead=8, thumbnail_width=None,
+                 thumbnail_dir=None):
+        self.refs = refs
+        self.stream = stream
+        self.readahead = readahead
+        self.cache_bytes = int(cache_mb * 1024 * 1024)
+        self.thumbnail_width = thumbnail_width
+        self.thumbnail_dir = None
+        if thumbnail_dir is not None and thumbnail_width:
+            self.thumbnail_dir = pathlib.Path(thumbnail_dir) / f"{stream}_{thumbnail_width}"
+            self.thumbnail_dir.mkdir(parents=True, exist_ok=True)
+        self.position = 0
+        self.direction = 1
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        self._pending = {}
+        self._lock = threading.RLock()  # Callbacks of already finished futures run inline while it is held
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def __len__(self):
+        return len(self.refs)
+
+    def _thumbnail_path(self, key):
+        return None if self.thumbnail_dir is None else self.thumbnail_dir / f"{key}.png"
+
+    def _decode(self, i):
+        key, load = self.refs[i]
+        thumbnail_path = self._thumbnail_path(key)
+        if thumbnail_path is not None and thumbnail_path.exists():
+            return cv2.imread(str(thumbnail_path), cv2.IMREAD_UNCHANGED)
+        image = load()
+        if image is not None and self.thumbnail_width and image.shape[1] > self.thumbnail_width:
+            height = int(round(image.shape[0] * self.thumbnail_width / image.shape[1]))
+            image = cv2.resize(image, (self.thumbnail_width, height), interpolation=cv2.INTER_AREA)
+            if thumbnail_path is not None:
+                cv2.imwrite(str(thumbnail_path), image)
+        return image
+
+    def _store(self, i, future):
+        if future.cancelled():
+            with self._lock:
+                self._pending.pop(i, None)
+            return
+        try:
+            image = future.result()
+        except Exception as e:
+            print(f"Could not decode {self.refs[i][0]}: {e}")
+            image = None
+        with self._lock:
+            self._pending.pop(i, None)
+            if image is None or i in self._cache:
+                return
+            self._cache[i] = image
+            self._cached_bytes += image.nbytes
+            while self._cached_bytes > self.cache_bytes and len(self._cache) > 1:
+                _, evicted = self._cache.popitem(last=False)
+                self._cached_bytes -= evicted.nbytes
+
+    def _request(self, i):
+        # Caller holds the lock
+        if i in self._cache or i in self._pending or not 0 <= i < len(self.refs):
+            return self._pending.get(i)
+        future = self._executor.submit(self._decode, i)
+        self._pending[i] = future
+        future.add_done_callback(lambda f, i=i: self._store(i, f))
+        return future
+
+    def prefetch(self):
+        with self._lock:
+            for n in range(1, self.readahead + 1):
+                self._request(self.position + n * self.direction)
+
+    def get(self, i):
+        with self._lock:
+            if i in self._cache:
+                self.hits += 1
+                self._cache.move_to_end(i)
+                return self._cache[i]
+            self.misses += 1
+            future = self._request(i)
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except Exception:
+            return None
+
+    def seek(self, i):
+        self.position = max(0, min(int(i), len(self.refs) - 1))
+        self.prefetch()
+
+    def reverse(self):
+        self.direction = -self.direction
+        self.prefetch()
+
+    def current(self):
+        image = self.get(self.position)
+        self.prefetch()
+        return image
+
+    def step(self, n=1):
+        """Advance n frames in the play direction, returns False at either end"""
+        target = self.position + n * self.direction
+        if not 0 <= target < len(self.refs):
+            return False
+        self.position = target
+        return True
+
+    def close(self):
+        # Drop read ahead that has not started (shutdown(cancel_futures=True) needs Python 3.9)
+        with self._lock:
+            for future in list(self._pending.values()):
+                future.cancel()
+        self._executor.shutdown(wait=False)
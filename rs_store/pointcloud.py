@@ -0,0 +1,200 @@
+import argparse
+import os
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+
+from rs_store.container import ChunkedSessionReader, is_container
+from rs_store.sources import list_session, read_capture
+from rs_store.utils import parse_capture_name
+
+DEFAULT_DEPTH_SCALE = 0.001  # D400 default, older sessions do not store depth_scale
+POINT_DTYPE = np.dtype([("x", "<f4"), ("y", "<f4"), ("z", "<f4"), ("red", "u1"), ("green", "u1"), ("blue", "u1")])
+
+
+def _key(intrinsics):
+    i = intrinsics
+    return (int(i["width"]), int(i["height"]), float(i["ppx"]), float(i["ppy"]), float(i["fx"]), float(i["fy"]),
+            str(i.get("model", "none")).split(".")[-1], tuple(float(c) for c in (i.get("coeffs") or [0.0] * 5)))
+
+
+@lru_cache(maxsize=32)
+def _ray_grid(key):
+    width, height, ppx, ppy, fx, fy, model, coeffs = key
+    xs, ys = np.meshgrid(np.arange(width, dtype=np.float64), np.arange(height, dtype=np.float64))
+    x, y = (xs - ppx) / fx, (ys - ppy) / fy
+    k1, k2, p1, p2, k3 = coeffs
+    if any(coeffs) and model == "inverse_brown_conrady":
+        # Same as rs2_deproject_pixel_to_point
+        r2 = x * x + y * y
+        f = 1 + k1 * r2 + k2 * r2 * r2 + k3 * r2 * r2 * r2
+        ux = x * f + 2 * p1 * x * y + p2 * (r2 + 2 * x * x)
+        uy = y * f + 2 * p2 * x * y + p1 * (r2 + 2 * y * y)
+        x, y = ux, uy
+    elif any(coeffs) and model == "brown_conrady":
+        # Iteratively undistort, as librealsense does
+        x0, y0 = x.copy(), y.copy()
+        for _ in range(10):
+            r2 = x * x + y * y
+            icdist = 1 / (1 + ((k3 * r2 + k2) * r2 + k1) * r2)
+            dx = 2 * p1 * x * y + p2 * (r2 + 2 * x * x)
+            dy = 2 * p2 * x * y + p1 * (r2 + 2 * y * y)
+            x, y = (x0 - dx) * icdist, (y0 - dy) * icdist
+    grid = np.stack([x, y], axis=-1).astype(np.float32)
+    grid.setflags(write=False)
+    return grid
+
+
+def ray_grid(intrinsics):
+    """Per pixel (x/z, y/z) for an intrinsics dict, computed once per intrinsics and cached"""
+    return _ray_grid(_key(intrinsics))
+
+
+def deproject(depth, intrinsics, depth_scale=DEFAULT_DEPTH_SCALE):
+    """(h, w, 3) points in metres in the camera frame, zero depth gives (0, 0, 0)"""
+    grid = ray_grid(intrinsics)
+    if grid.shape[:2] != depth.shape:
+        raise ValueError(f"Depth {depth.shape} does not match intrinsics {grid.shape[:2]}")
+    z = depth.astype(np.float32) * np.float32(depth_scale)
+    points = np.empty(depth.shape + (3,), dtype=np.float32)
+    np.multiply(grid, z[..., None], out=points[..., :2])
+    points[..., 2] = z
+    return points
+
+
+def transform(points, extrinsics):
+    """Apply a librealsense extrinsics dict (column major rotation, translation in metres) to (..., 3) points"""
+    rotation = np.asarray(extrinsics["rotation"], dtype=np.float32).reshape(3, 3).T
+    translation = np.asarray(extrinsics["translation"], dtype=np.float32)
+    return points @ rotation.T + translation
+
+
+def project(points, intrinsics):
+    """(..., 3) points to (..., 2) pixel coordinates (distortion ignored), points with z <= 0 give nan"""
+    _, _, ppx, ppy, fx, fy, _, _ = _key(intrinsics)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = np.where(points[..., 2] > 0, points[..., 2], np.nan)
+        return np.stack([points[..., 0] / z * fx + ppx, points[..., 1] / z * fy + ppy], axis=-1)
+
+
+def point_cloud(depth, intrinsics, colour=None, depth_scale=DEFAULT_DEPTH_SCALE, colour_intrinsics=None,
+                extrinsics=None):
+    """Structured array of valid points (x, y, z, red, green, blue).
+
+    colour is sampled per pixel when it is on the depth grid (aligned_depth), for raw depth pass the colour
+    intrinsics and the depth_to_colour extrinsics so points are projected into the colour image.
+    """
+    points = deproject(depth, intrinsics, depth_scale)
+    valid = depth > 0
+    cloud = np.zeros(int(valid.sum()), dtype=POINT_DTYPE)
+    xyz = points[valid]
+    cloud["x"], cloud["y"], cloud["z"] = xyz[:, 0], xyz[:, 1], xyz[:, 2]
+    if colour is not None:
+        if colour.shape[:2] == depth.shape and colour_intrinsics is None:
+            rgb = colour[valid]
+        else:
+            pixels = project(transform(xyz, extrinsics) if extrinsics else xyz, colour_intrinsics)
+            u = np.nan_to_num(np.rint(pixels[:, 0]), nan=-1).astype(np.int64)
+            v = np.nan_to_num(np.rint(pixels[:, 1]), nan=-1).astype(np.int64)
+            inside = (u >= 0) & (v >= 0) & (u < colour.shape[1]) & (v < colour.shape[0])
+            rgb = np.zeros((len(xyz), 3), dtype=np.uint8)
+            rgb[inside] = colour[v[inside], u[inside]]
+        if rgb.ndim == 1:
+            rgb = np.stack([rgb] * 3, axis=-1)
+        # OpenCV images are BGR
+        cloud["red"], cloud["green"], cloud["blue"] = rgb[:, 2], rgb[:, 1], rgb[:, 0]
+    return cloud
+
+
+def save_ply(p, cloud):
+    header = (f"ply\nformat binary_little_endian 1.0\nelement vertex {len(cloud)}\n"
+              "property float x\nproperty float y\nproperty float z\n"
+              "property uchar red\nproperty uchar green\nproperty uchar blue\nend_header\n")
+    with open(str(p), 'wb') as f:
+        f.write(header.encode("ascii"))
+        f.write(cloud.astype(POINT_DTYPE, copy=False).tobytes())
+
+
+def save_cloud(p, cloud, fmt="ply"):
+    p = pathlib.Path(str(p)).with_suffix("." + fmt)
+    if fmt == "ply":
+        save_ply(p, cloud)
+    elif fmt == "npy":
+        np.save(str(p), cloud)
+    else:
+        raise ValueError(f"Unknown point cloud format '{fmt}'")
+    return p
+
+
+def cloud_from_capture(source, idx, stream="aligned_depth"):
+    """Point cloud of one saved capture, source is {stream: path} for loose files or a chunked session directory"""
+    depth = read_capture(source, idx, stream)
+    meta = read_capture(source, idx, "meta")
+    colour = read_capture(source, idx, "colour")
+    if depth is None or meta is None:
+        return None
+    depth_scale = float(meta.get("depth_scale", DEFAULT_DEPTH_SCALE))
+    if stream == "aligned_depth":
+        # Depth aligned offline by rs_store.align has the colour camera's intrinsics
+        intrinsics = meta.get("aligned_depth_intrinsics") or meta["colour_intrinsics"]
+        return point_cloud(depth, intrinsics, colour, depth_scale)
+    return point_cloud(depth, meta["depth_intrinsics"], colour, depth_scale, meta.get("colour_intrinsics"),
+                       meta.get("depth_to_colour_extrinsics"))
+
+
+def _export_job(job):
+    source, idx, out, stream, fmt = job
+    cloud = cloud_from_capture(source, idx, stream)
+    if cloud is None:
+        return 0
+    save_cloud(out, cloud, fmt)
+    return len(cloud)
+
+
+def session_jobs(session, out, stream="aligned_depth", fmt="ply"):
+    session, out = pathlib.Path(session), pathlib.Path(out)
+    jobs = []
+    for directory in [session] + sorted(p for p in session.iterdir() if p.is_dir() and not p.name.startswith(".")):
+        if is_container(directory):
+            reader = ChunkedSessionReader(directory)
+            captures = [(str(directory), idx, reader.time_str(idx)) for idx in reader.indices]
+        else:
+            captures = []
+            for idx, files in list_session(directory).items():
+                time_str = parse_capture_name(next(iter(files.values())))[1]
+                captures.append(({k: str(p) for k, p in files.items()}, idx, time_str))
+        for source, idx, time_str in captures:
+            name = f"{idx:07d}_{time_str}_{stream}_points"
+            target = out / directory.relative_to(session) / name
+            jobs.append((source, idx, target, stream, fmt))
+    return jobs
+
+
+def export_session(session, out, stream="aligned_depth", fmt="ply", workers=None, skip_existing=True):
+    """Write a point cloud per capture of a session in parallel, returns the number of points written"""
+    jobs = session_jobs(session, out, stream, fmt)
+    if skip_existing:
+        jobs = [j for j in jobs if not j[2].with_suffix("." + fmt).exists()]
+    for job in jobs:
+        job[2].parent.mkdir(parents=True, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        return sum(executor.map(_export_job, jobs, chunksize=4))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export point clouds for every capture in a saved session")
+    parser.add_argument("session")
+    parser.add_argument("--out", default=None, help="Output directory (defaults to <session>_points)")
+    parser.add_argument("--stream", default="aligned_depth", choices=["aligned_depth", "depth"])
+    parser.add_argument("--format", default="ply", choices=["ply", "npy"])
+    parser.add_argument("--workers", default=None, type=int)
+    args = parser.parse_args()
+    out = args.out or f"{pathlib.Path(args.session).resolve()}_points"
+    points = export_session(args.session, out, args.stream, args.format, args.workers)
+    print(f"Wrote {points} points to {out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+import threading
+
+import numpy as np
+
+from rs_store.metrics import inc
+
+
+def stream_shapes(config):
+    """Buffer shape and dtype for each image stream from rgb_width/rgb_height and stream-width/stream-height"""
+    width, height = int(config["stream-width"]), int(config["stream-height"])
+    colour_width, colour_height = int(config.rgb_width), int(config.rgb_height)
+    shapes = {
+        "colour": ((colour_height, colour_width, 3), np.uint8),
+        "depth": ((height, width), np.uint16),
+        "aligned_depth": ((colour_height, colour_width), np.uint16),
+        "aligned_depth_cm": ((colour_height, colour_width, 3), np.uint8),
+    }
+    if config.ir_enabled:
+        shapes["ir_left"] = ((height, width), np.uint8)
+        shapes["ir_right"] = ((height, width), np.uint8)
+    return shapes
+
+
+class Slot:
+    """One capture worth of pre-allocated arrays, returned to its pool once every user has released it"""
+
+    def __init__(self, pool, index, buffer, layout):
+        self.pool = pool
+        self.index = index
+        self._buffer = buffer
+        self._refs = 0
+        self._lock = threading.Lock()
+        self.offsets = {}
+        self.arrays = {}
+        self.filled = set()  # Streams whose latest put() was copied into the slot's buffer
+        for stream, (offset, shape, dtype) in layout.items():
+            self.offsets[stream] = offset
+            self.arrays[stream] = np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset)
+
+    def put(self, stream, data):
+        """Copy data into this slot, streams with an unexpected shape fall back to a private copy"""
+        out = self.arrays.get(stream)
+        if out is None or out.shape != data.shape or out.dtype != data.dtype:
+            self.pool.misses += 1
+            self.filled.discard(stream)
+            return np.array(data)
+        np.copyto(out, data)
+        self.filled.add(stream)
+        return out
+
+    def shared_ref(self, stream):
+        """(shared memory name, offset) of a stream for process writers, None for private memory pools and streams
+        that put() did not copy into shared memory"""
+        if self.pool.shared and stream in self.filled:
+            return self.pool.shm[self.index].name, self.offsets[stream]
+        return None
+
+    def retain(self):
+        with self._lock:
+            self._refs += 1
+
+    def release(self, *args):
+        # Accepts (and ignores) Writer on_done arguments so it can be used directly as a callback
+        with self._lock:
+            self._refs -= 1
+            free = self._refs == 0
+        if free:
+            self.filled.clear()
+            self.pool._give_back(self)
+
+
+class UnpooledSlot:
+    """Stands in for a Slot when the pool is exhausted, every stream is a private copy"""
+
+    def __init__(self, pool):
+        pool.exhausted += 1
+        inc("rs_store_pool_exhausted_total")
+
+    def put(self, stream, data):
+        return np.array(data)
+
+    def shared_ref(self, stream):
+        return None
+
+    def retain(self):
+        pass
+
+    def release(self, *args):
+        pass
+
+
+class BufferPool:
+    """A bounded ring of reusable capture buffers, acquire() blocks while every slot is in use so peak memory is
+    size * (bytes per capture)"""
+
+    def __init__(self, shapes, size=4, shared=False):
+        self.shapes = shapes
+        self.size = int(size)
+        self.shared = shared
+        self.misses = 0
+        self.exhausted = 0
+        layout, offset = {}, 0
+        for stream, (shape, dtype) in shapes.items():
+            layout[stream] = (offset, shape, np.dtype(dtype))
+            offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+            offset += -offset % 64  # Keep each array cache line aligned
+        self.slot_bytes = offset
+        self.shm = []
+        self._free = []
+        self._cv = threading.Condition()
+        for i in range(self.size):
+            if shared:
+                from multiprocessing import shared_memory
+                self.shm.append(shared_memory.SharedMemory(create=True, size=max(offset, 1)))
+                buffer = self.shm[-1].buf
+            else:
+                buffer = bytearray(max(offset, 1))
+            self._free.append(Slot(self, i, buffer, layout))
+
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        return cls(stream_shapes(config), **kwargs)
+
+    def acquire(self, timeout=None, fallback=False):
+        """A free slot, waits up to timeout seconds (forever if None). With fallback an UnpooledSlot is returned
+        rather than raising TimeoutError, so memory is bounded by whatever bounds the callers (the writer queue)."""
+        with self._cv:
+            if not self._cv.wait_for(lambda: self._free, timeout=timeout):
+                if fallback:
+                    return UnpooledSlot(self)
+                raise TimeoutError("No free buffers in pool")
+            slot = self._free.pop()
+        slot.retain()
+        return slot
+
+    def _give_back(self, slot):
+        with self._cv:
+            self._free.append(slot)
+            self._cv.notify()
+
+    def available(self):
+        return len(self._free)
+
+    def close(self):
+        for shm in self.shm:
+            shm.close()
+            shm.unlink()
+        self.shm = []
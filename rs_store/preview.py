@@ -0,0 +1,108 @@
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from rs_store.metrics import timed
+
+SPACE = 32
+
+
+class Preview(threading.Thread):
+    """Shows the most recent frame set on its own thread at no more than fps.
+
+    show() only swaps a reference so the capture thread never waits on resizing or the GUI, frames that arrive faster
+    than the display rate are skipped rather than queued. All of OpenCV's HighGUI calls happen on this thread, key
+    presses are handed back through poll_key(). The canvas and per tile buffers are allocated once.
+    """
+
+    def __init__(self, window="Realsense Saver", fps=15, tile_size=(720, 480)):
+        super().__init__(daemon=True, name="rs_store-preview")
+        self.window = window
+        self.fps = fps
+        self.tile_size = tile_size
+        self.shown = 0
+        self.skipped = 0
+        self._latest = None
+        self._latest_lock = threading.Lock()
+        self._new_frame = threading.Event()
+        self._keys = queue.SimpleQueue()
+        self._running = True
+        self._canvas = None
+        width, height = tile_size
+        self._tile = np.empty((height, width, 3), dtype=np.uint8)
+        self._grey_tile = np.empty((height, width), dtype=np.uint8)
+
+    def show(self, frames):
+        with self._latest_lock:
+            if self._latest is not None:
+                self.skipped += 1
+            self._latest = frames
+        self._new_frame.set()
+        if not self.is_alive() and self._running:
+            self.start()
+
+    def poll_key(self):
+        """Most recent key pressed in the window since the last call (or None). Space (save) wins over keys pressed
+        after it so a save request is never lost between two polls."""
+        key = None
+        while True:
+            try:
+                pressed = self._keys.get_nowait()
+            except queue.Empty:
+                return key
+            if key != SPACE:
+                key = pressed
+
+    def _place(self, image, row, column):
+        width, height = self.tile_size
+        if image.ndim == 2:
+            cv2.resize(image, self.tile_size, dst=self._grey_tile)
+            cv2.cvtColor(self._grey_tile, cv2.COLOR_GRAY2BGR, dst=self._tile)
+        else:
+            cv2.resize(image, self.tile_size, dst=self._tile)
+        self._canvas[row * height:(row + 1) * height, column * width:(column + 1) * width] = self._tile
+
+    def compose(self, frames):
+        rows = 2 if frames.ir_left is not None and frames.ir_right is not None else 1
+        width, height = self.tile_size
+        if self._canvas is None or self._canvas.shape[0] != rows * height:
+            self._canvas = np.zeros((rows * height, 2 * width, 3), dtype=np.uint8)
+        for column, image in enumerate([frames.colour, frames.aligned_depth_cm]):
+            if image is not None:
+                self._place(image, 0, column)
+        if rows == 2:
+            self._place(frames.ir_left, 1, 0)
+            self._place(frames.ir_right, 1, 1)
+        return self._canvas
+
+    def run(self):
+        cv2.namedWindow(self.window, cv2.WINDOW_GUI_EXPANDED)
+        period = 1.0 / self.fps if self.fps else 0
+        while self._running:
+            start = time.perf_counter()
+            if self._new_frame.wait(timeout=0.05):
+                self._new_frame.clear()
+                with self._latest_lock:
+                    frames, self._latest = self._latest, None
+                if frames is not None:
+                    try:
+                        with timed("rs_store_capture_seconds", stage="render"):
+                            cv2.imshow(self.window, self.compose(frames))
+                        self.shown += 1
+                    except Exception as e:
+                        print("Could not show frames:", e)
+            # waiting inside waitKey keeps the window responsive while holding the display rate
+            remaining = period - (time.perf_counter() - start)
+            key = cv2.waitKey(max(1, int(remaining * 1000)))
+            if key != -1:
+                self._keys.put(key)
+        cv2.destroyWindow(self.window)
+        cv2.waitKey(1)
+
+    def stop(self):
+        self._running = False
+        if self.is_alive():
+            self.join(timeout=2)
@@ -1,8 +1,12 @@
 import json
 import pathlib
+import struct
+import zlib
 from datetime import datetime
 import numpy as np
-import cv2
+
+from rs_store.metrics import inc, timed
+from rs_store.utils import parse_capture_name
 
 folder_name = str(datetime.now())
 for o in ['.', ':', " "]:
@@ -19,23 +23,170 @@ def log(*args, **kwargs):
     print(*args, **kwargs)
 
 
-def save_img(p, i):
-    if not str(p).lower().endswith(('.png', '.jpg', '.jpeg')):
-        p = str(p) + '.png'
-    cv2.imwrite(str(p), i)
+# Lossless 16-bit depth codec ("rsd"), the row-wise delta + zigzag transform turns the piecewise-smooth D400 depth
+# into mostly tiny values, the high and low byte planes are then compressed separately by a fast general compressor
+RSD_MAGIC = b"RSD1"
+RSD_HEADER = struct.Struct("<4sBII")
+COMPRESSORS = {
+    "zlib": (1, lambda b, level: zlib.compress(b, 1 if level is None else level), zlib.decompress),
+}
+try:
+    import zstandard
+
+    COMPRESSORS["zstd"] = (2, lambda b, level: zstandard.ZstdCompressor(level=3 if level is None else level).compress(b),
+                           lambda b: zstandard.ZstdDecompressor().decompress(b))
+except ImportError:
+    pass
+try:
+    import lz4.frame
+
+    COMPRESSORS["lz4"] = (3, lambda b, level: lz4.frame.compress(b, compression_level=level or 0), lz4.frame.decompress)
+except ImportError:
+    pass
+
+
+def parse_codec(spec):
+    """'png', 'png:1', 'rsd', 'rsd-zstd:3' -> (name, compressor, level)"""
+    name, _, level = (spec or "png").partition(":")
+    name, _, compressor = name.partition("-")
+    if name == "rsd":
+        compressor = compressor or "zlib"
+        if compressor not in COMPRESSORS:
+            raise ValueError(f"Depth compressor '{compressor}' is not available (have {list(COMPRESSORS)})")
+    elif name != "png":
+        raise ValueError(f"Unknown codec '{spec}'")
+    return name, compressor or None, int(level) if level else None
+
+
+def encode_depth(i, compressor="zlib", level=None):
+    if i.dtype != np.uint16 or i.ndim != 2:
+        raise TypeError(f"Depth codec expects a 2D uint16 image not {i.dtype} {i.shape}")
+    h, w = i.shape
+    delta = np.empty(i.shape, dtype=np.uint16)  # C order whatever the layout of i (transposed, strided views)
+    delta[:, 0] = i[:, 0]
+    np.subtract(i[:, 1:], i[:, :-1], out=delta[:, 1:])  # Wraps modulo 2^16 so it is always reversible
+    signed = delta.view(np.int16)
+    zigzag = ((signed << 1) ^ (signed >> 15)).view(np.uint16)
+    planes = np.ascontiguousarray(zigzag.view(np.uint8).reshape(h, w, 2).transpose(2, 0, 1))
+    compressor_id, compress, _ = COMPRESSORS[compressor]
+    return RSD_HEADER.pack(RSD_MAGIC, compressor_id, h, w) + compress(planes.tobytes(), level)
+
+
+def decode_depth(b):
+    magic, compressor_id, h, w = RSD_HEADER.unpack_from(b)
+    if magic != RSD_MAGIC:
+        raise ValueError("Not an rsd depth image")
+    decompress = next(d for cid, _, d in COMPRESSORS.values() if cid == compressor_id)
+    planes = np.frombuffer(decompress(bytes(b[RSD_HEADER.size:])), dtype=np.uint8).reshape(2, h, w)
+    zigzag = np.ascontiguousarray(planes.transpose(1, 2, 0)).view(np.uint16).reshape(h, w)
+    delta = (zigzag >> 1) ^ (-(zigzag & 1).astype(np.int16)).view(np.uint16)
+    return np.cumsum(delta, axis=1, dtype=np.uint16)
+
+
+def encode_img(i, codec=None):
+    name, compressor, level = parse_codec(codec)
+    if name == "rsd":
+        return encode_depth(i, compressor, level)
+    import cv2
+    params = [] if level is None else [cv2.IMWRITE_PNG_COMPRESSION, level]
+    return cv2.imencode('.png', i, params)[1].tobytes()
+
+
+# OpenCV is imported on first use, it is the slowest import on the capture start up path
+IMREAD_UNCHANGED = -1  # cv2.IMREAD_UNCHANGED
+IMREAD_COLOR = 1  # cv2.IMREAD_COLOR
+
+
+def decode_img(b, flags=IMREAD_UNCHANGED):
+    if bytes(b[:4]) == RSD_MAGIC:
+        return decode_depth(b)
+    import cv2
+    return cv2.imdecode(np.frombuffer(b, dtype=np.uint8), flags)
+
 
+def load_img(p, flags=IMREAD_UNCHANGED):
+    if str(p).lower().endswith('.rsd'):
+        with open(str(p), 'rb') as f:
+            return decode_depth(f.read())
+    import cv2
+    return cv2.imread(str(p), flags)
 
-def save_dict(p, d):
-    if not str(p).lower().endswith('.json'):
-        p = str(p) + '.json'
-    with open(str(p), 'w') as f:
-        json.dump(d, f, default=lambda obj: str(obj), indent=4)
 
+# Files are written under a hidden temporary name and renamed once their whole capture is written (see
+# rs_store.writer), so a crash never leaves a truncated file under a capture name
+PARTIAL_SUFFIX = ".partial"
 
-def save(p, d, job_meta=None):
+
+def partial_name(p):
+    p = pathlib.Path(p)
+    return p.with_name("." + p.name + PARTIAL_SUFFIX)
+
+
+def published_name(p):
+    """Inverse of partial_name"""
+    p = pathlib.Path(p)
+    return p.with_name(p.name[1:-len(PARTIAL_SUFFIX)])
+
+
+def write_bytes(p, payload, kind, partial=False):
+    p = partial_name(p) if partial else p
+    with timed("rs_store_save_seconds", stage="write", codec=kind):
+        with open(str(p), 'wb') as f:
+            f.write(payload)
+    inc("rs_store_saved_bytes_total", len(payload), codec=kind)
+    return str(p)
+
+
+def json_default(obj):
+    """Numbers from numpy stay numbers, anything else json can not encode (e.g. rs enums) becomes its string"""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    return str(obj)
+
+
+def file_name(p, d, codec=None):
+    """The path save() writes d to for capture name p (with the codec's suffix added)"""
+    p = str(p)
     if isinstance(d, dict):
-        save_dict(p, d)
+        return p if p.lower().endswith('.json') else p + '.json'
+    if parse_codec(codec)[0] == "rsd":
+        return p if p.lower().endswith('.rsd') else p + '.rsd'
+    return p if p.lower().endswith(('.png', '.jpg', '.jpeg')) else p + '.png'
+
+
+def save_img(p, i, codec=None, partial=False):
+    name, compressor, level = parse_codec(codec)
+    p = file_name(p, i, codec)
+    if name == "rsd":
+        with timed("rs_store_save_seconds", stage="encode", codec=name):
+            payload = encode_depth(i, compressor, level)
+        return write_bytes(p, payload, name, partial)
+    import cv2
+    # Encoded in memory rather than with cv2.imwrite so encoding and writing are timed separately
+    with timed("rs_store_save_seconds", stage="encode", codec=name):
+        params = [] if level is None else [cv2.IMWRITE_PNG_COMPRESSION, level]
+        payload = cv2.imencode(pathlib.Path(p).suffix, i, params)[1]
+    return write_bytes(p, payload, name, partial)
+
+
+def save_dict(p, d, partial=False):
+    p = file_name(p, d)
+    return write_bytes(p, json.dumps(d, default=json_default, separators=(",", ":")).encode(), "json", partial)
+
+
+def save(p, d, job_meta=None, store=None, codec=None, partial=False):
+    """Write d for capture name p, returns the path written (the temporary name when partial)"""
+    if store is not None:
+        # Chunked container (rs_store.container), p is only used for its capture name. Partial records are hidden
+        # from readers until the writer publishes them
+        idx, time_str, stream = parse_capture_name(p)
+        store.write(idx, stream, d, time_str=time_str, codec=codec, published=not partial)
+        return str(store.path)
+    elif isinstance(d, dict):
+        return save_dict(p, d, partial)
     elif isinstance(d, np.ndarray):
-        save_img(p, d)
+        return save_img(p, d, codec=codec, partial=partial)
     else:
         raise TypeError
@@ -0,0 +1,87 @@
+import math
+import threading
+import time
+
+from rs_store.metrics import inc, observe
+
+
+class CaptureScheduler:
+    """Wakes for captures at wall clock multiples of interval (plus offset), so cameras at several sites started at
+    different times still capture at the same moments (e.g. interval=600 captures at :00, :10, :20 ...).
+
+    Between captures the camera is only drained with cheap non-blocking polls every poll_interval seconds, nothing
+    is converted, aligned or filtered. For the last warmup seconds before a deadline frames are read again (and
+    stateful post filters see them) so exposure and filters have settled by the capture. The difference between each
+    deadline and when its frame set was captured is recorded as the scheduling jitter, deadlines that had already
+    passed by the time wait() was called are skipped and counted as missed.
+    """
+
+    def __init__(self, interval, warmup=0.5, offset=0.0, poll_interval=0.05, clock=time.time):
+        if interval <= 0 or math.isinf(interval):
+            raise ValueError(f"A capture schedule needs a finite interval, not {interval}")
+        self.interval = float(interval)
+        self.warmup = min(float(warmup), self.interval)
+        self.offset = float(offset)
+        self.poll_interval = poll_interval
+        self.clock = clock
+        self.deadline = None
+        self.missed = 0
+        self.drained = 0
+        self.jitter = []  # Seconds late per capture, recent captures only
+        self._stop = threading.Event()
+
+    def next_deadline(self, now=None):
+        now = self.clock() if now is None else now
+        return (math.floor((now - self.offset) / self.interval) + 1) * self.interval + self.offset
+
+    def _sleep_until(self, t):
+        remaining = t - self.clock()
+        if remaining > 0:
+            self._stop.wait(remaining)
+
+    def wait(self, camera):
+        """Idle until the next deadline, returns it (wall clock seconds). Read the capture with camera.get_frames()
+        straight after and call captured() once it has arrived."""
+        deadline = self.next_deadline()
+        if self.deadline is not None:
+            missed = int(round((deadline - self.deadline) / self.interval)) - 1
+            if missed > 0:
+                self.missed += missed
+                inc("rs_store_schedule_missed_total", missed)
+        self.deadline = deadline
+        while not self._stop.is_set():
+            remaining = deadline - self.warmup - self.clock()
+            if remaining <= 0:
+                break
+            self.drained += camera.drain()
+            self._stop.wait(min(self.poll_interval, remaining))
+        period = 0.0
+        # Stop warming up one frame early, so the capture is the first frame after the deadline rather than the next
+        while not self._stop.is_set() and self.clock() + period < deadline:
+            start = self.clock()
+            camera.get_frames()
+            period = self.clock() - start
+        self._sleep_until(deadline)
+        return deadline
+
+    def captured(self, timestamp_ms=None):
+        """Record how late the capture for the current deadline was, in seconds. timestamp_ms is the frame set's
+        timestamp, used when it is on the wall clock (global time) so processing in get_frames() is not counted."""
+        late = self.clock() - self.deadline
+        if timestamp_ms is not None and abs(timestamp_ms / 1000 - self.deadline) < min(late + 1, self.interval):
+            late = timestamp_ms / 1000 - self.deadline
+        observe("rs_store_schedule_jitter_seconds", abs(late))
+        self.jitter = self.jitter[-999:] + [late]
+        return late
+
+    def stats(self):
+        jitter = sorted(abs(j) for j in self.jitter)
+        if not jitter:
+            return {"captures": 0, "missed": self.missed}
+        return {"captures": len(jitter), "missed": self.missed, "drained": self.drained,
+                "jitter_mean_ms": 1000 * sum(jitter) / len(jitter),
+                "jitter_p95_ms": 1000 * jitter[min(int(0.95 * len(jitter)), len(jitter) - 1)],
+                "jitter_max_ms": 1000 * jitter[-1]}
+
+    def stop(self):
+        self._stop.set()
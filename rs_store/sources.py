@@ -0,0 +1,286 @@
+import json
+import pathlib
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from rs_store.container import ChunkedSessionReader, is_container
+from rs_store.data import LazyRealsenseData, RealsenseData, STREAMS, join_meta, split_meta
+from rs_store.metastore import capture_meta
+from rs_store.metrics import inc
+from rs_store.save import IMREAD_COLOR, IMREAD_UNCHANGED, load_img
+from rs_store.utils import parse_capture_name
+
+
+VISUALISE_STREAMS = ("colour", "aligned_depth_cm", "ir_left", "ir_right")
+
+
+class SourceExhausted(Exception):
+    pass
+
+
+class FrameSource:
+    """Base class for anything that produces RealsenseData (camera, synthetic generator, replayed session)"""
+    display = "Realsense Saver"
+    display_fps = 15
+    # Whether aligned_depth is computed from the (numpy filtered) depth stream rather than by the camera/recording
+    aligns_filtered_depth = False
+
+    def __init__(self, visualise=False):
+        self.serial_number = None
+        self.started = False
+        self.visualise = visualise
+        self.frames = RealsenseData()
+        self.products = set(STREAMS)
+        self.post = None  # rs_store.filters.PostProcessor
+        self.preview = None
+        if visualise:
+            self.require(visualise=VISUALISE_STREAMS)
+
+    def start(self):
+        self.started = True
+
+    def stop(self):
+        self.stop_preview()
+        self.started = False
+
+    def require(self, save=(), visualise=()):
+        """Declare the streams consumers will read, anything else is never computed"""
+        self.products = set(save) | set(visualise) | (set(VISUALISE_STREAMS) if self.visualise else set())
+
+    def drain(self):
+        """Discard frame sets waiting to be read without processing them, returns how many. Sources that do not
+        queue frames have nothing to drain."""
+        return 0
+
+    def warmup(self, n=100):
+        for _ in range(n):
+            self.get_frames()
+
+    def read(self):
+        """Return the next RealsenseData or None if the source is exhausted"""
+        raise NotImplementedError
+
+    def get_frames(self, return_key=False):
+        frames = self.read()
+        if frames is None:
+            raise SourceExhausted(f"Frame source {self.serial_number} is exhausted")
+        inc("rs_store_frames_total", serial=self.serial_number)
+        if self.post is not None:
+            if self.post.backend == "numpy":
+                self.post.attach(frames)
+            if self.post.stateful:
+                frames.compute(self.post.stream)  # Temporal filters need to see every frame, not just saved ones
+        key_code = self.render(frames) if self.visualise else None
+        self.frames = frames
+        if return_key:
+            return self.frames, key_code
+        return self.frames
+
+    def render(self, frames):
+        """Hand frames to the preview thread and return the last key pressed in its window, never blocks"""
+        if self.preview is None:
+            from rs_store.preview import Preview
+            self.preview = Preview(self.display, fps=self.display_fps)
+        self.preview.show(frames)
+        return self.preview.poll_key()
+
+    def stop_preview(self):
+        if self.preview is not None:
+            self.preview.stop()
+            self.preview = None
+
+
+def _synthetic_intrinsics(width, height):
+    return {"width": width, "height": height, "ppx": width / 2, "ppy": height / 2, "fx": width * 0.9,
+            "fy": width * 0.9, "model": "distortion.none", "coeffs": [0.0] * 5}
+
+
+class SyntheticSource(FrameSource):
+    """Generates moving piecewise-smooth depth, colour and IR frames at a given resolution and rate (fps=0 is
+    unthrottled)"""
+    aligns_filtered_depth = True
+
+    def __init__(self, width=1280, height=720, fps=30, colour_width=1920, colour_height=1080, ir_enabled=True,
+                 serial_number="synthetic", n_frames=None, visualise=False):
+        super().__init__(visualise=visualise)
+        self.serial_number = serial_number
+        self.width, self.height, self.fps = width, height, fps
+        self.colour_width, self.colour_height = colour_width, colour_height
+        self.ir_enabled = ir_enabled
+        self.n_frames = n_frames
+        self.frame_number = 0
+        self._next_deadline = None
+
+        ys, xs = np.mgrid[0:height, 0:width].astype(np.float32)
+        self._depth_base = (800 + 0.4 * ys + 0.1 * xs).astype(np.uint16)  # Sloping floor in millimetres
+        cys, cxs = np.mgrid[0:colour_height, 0:colour_width]
+        self._colour_base = np.dstack([
+            (cxs * 255 // max(colour_width - 1, 1)),
+            (cys * 255 // max(colour_height - 1, 1)),
+            np.full_like(cxs, 128)
+        ]).astype(np.uint8)
+        self._ir_base = ((xs + ys) % 256).astype(np.uint8)
+        self._rng = np.random.default_rng(0)
+        self._meta = {
+            "depth_scale": 0.001,
+            "ir_left_intrinsics": _synthetic_intrinsics(width, height),
+            "ir_right_intrinsics": _synthetic_intrinsics(width, height),
+            "depth_intrinsics": _synthetic_intrinsics(width, height),
+            "aligned_depth_intrinsics": _synthetic_intrinsics(colour_width, colour_height),
+            "colour_intrinsics": _synthetic_intrinsics(colour_width, colour_height),
+            "depth_to_colour_extrinsics": {"rotation": [1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0],
+                                           "translation": [0.0, 0.0, 0.0]},
+        }
+        self.start()
+
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        return cls(width=int(config["stream-width"]), height=int(config["stream-height"]),
+                   fps=int(config["stream-fps"]), colour_width=int(config.rgb_width),
+                   colour_height=int(config.rgb_height), ir_enabled=bool(config.ir_enabled), **kwargs)
+
+    def _throttle(self):
+        if not self.fps:
+            return
+        now = time.perf_counter()
+        if self._next_deadline is None:
+            self._next_deadline = now
+        if self._next_deadline > now:
+            time.sleep(self._next_deadline - now)
+        self._next_deadline = max(self._next_deadline, now - 1.0 / self.fps) + 1.0 / self.fps
+
+    def read(self):
+        if self.n_frames is not None and self.frame_number >= self.n_frames:
+            return None
+        self._throttle()
+        i = self.frame_number
+        self.frame_number += 1
+
+        return LazyRealsenseData(self._producers(i), self.products)
+
+    def _depth(self, i):
+        # A box moving across a sloping floor with some sensor noise
+        depth = self._depth_base.copy()
+        bw, bh = self.width // 5, self.height // 4
+        bx = (i * 8) % max(self.width - bw, 1)
+        by = self.height // 3
+        depth[by:by + bh, bx:bx + bw] = 500
+        depth += self._rng.integers(0, 3, size=depth.shape, dtype=np.uint16)
+        depth[:, :self.width // 40] = 0  # D400 style invalid band on the left
+        return depth
+
+    def _producers(self, i):
+        import cv2
+        size = (self.colour_width, self.colour_height)
+        timestamp = time.time() * 1000
+        producers = {
+            "colour": lambda f: np.roll(self._colour_base, i * 4, axis=1),
+            "depth": lambda f: self._depth(i),
+            "aligned_depth": lambda f: cv2.resize(f.compute("depth"), size, interpolation=cv2.INTER_NEAREST),
+            "aligned_depth_cm": lambda f: cv2.applyColorMap(
+                cv2.convertScaleAbs(f.compute("aligned_depth"), alpha=255 / 2000), cv2.COLORMAP_JET),
+            "calibration": lambda f: self._meta,
+            "frame_info": lambda f: {"frame_number": i, "timestamp": timestamp},
+            "meta": lambda f: join_meta(f.calibration, f.frame_info),
+        }
+        if self.ir_enabled:
+            producers["ir_left"] = lambda f: np.roll(self._ir_base, i, axis=1)
+            producers["ir_right"] = lambda f: np.roll(self._ir_base, i + 10, axis=1)
+        return producers
+
+
+def read_stream(path, stream):
+    if stream == "meta":
+        with open(str(path), 'r') as fh:
+            return json.load(fh)
+    if stream in ("depth", "aligned_depth", "ir_left", "ir_right"):
+        return load_img(path, IMREAD_UNCHANGED)
+    return load_img(path, IMREAD_COLOR)
+
+
+_readers = {}
+
+
+def read_capture(source, idx, stream):
+    """One stream of a saved capture or None, source is {stream: path} for loose files or a chunked camera directory.
+    meta falls back to the session's metadata log (rs_store.metastore). Chunked readers are kept open per process."""
+    if isinstance(source, dict):
+        if stream == "meta" and stream not in source:
+            return capture_meta(pathlib.Path(next(iter(source.values()))).parent, idx)
+        return read_stream(source[stream], stream) if stream in source else None
+    reader = _readers.get(source) or _readers.setdefault(source, ChunkedSessionReader(source))
+    if (idx, stream) in reader.records:
+        return reader.read(idx, stream)
+    return capture_meta(source, idx) if stream == "meta" else None
+
+
+def list_session(path):
+    """Group the files of a saved session directory by capture index ({idx:07d}_{time_str}_{stream}.ext)"""
+    captures = OrderedDict()
+    for p in sorted(pathlib.Path(path).glob("*")):
+        parsed = parse_capture_name(p) if p.is_file() else None
+        if parsed is not None:
+            captures.setdefault(parsed[0], {})[parsed[2]] = p
+    return captures
+
+
+class ReplaySource(FrameSource):
+    """Replays a directory written by main.py --save (loose files or chunked), optionally looping and at a fixed rate"""
+
+    def __init__(self, path, fps=0, loop=False, visualise=False):
+        super().__init__(visualise=visualise)
+        self.path = pathlib.Path(path)
+        self.serial_number = self.path.name
+        self.fps = fps
+        self.loop = loop
+        self.reader = ChunkedSessionReader(self.path) if is_container(self.path) else None
+        self.captures = None if self.reader else list_session(self.path)
+        self._order = self.reader.indices if self.reader else list(self.captures.keys())
+        if not self._order:
+            raise FileNotFoundError(f"No saved captures found in {self.path}")
+        self._position = 0
+        self._last = None
+        self.start()
+
+    def __len__(self):
+        return len(self._order)
+
+    def read(self):
+        if self._position >= len(self._order):
+            if not self.loop:
+                return None
+            self._position = 0
+        if self.fps and self._last is not None:
+            time_to_sleep = 1.0 / self.fps - (time.perf_counter() - self._last)
+            if time_to_sleep > 0:
+                time.sleep(time_to_sleep)
+        self._last = time.perf_counter()
+        idx = self._order[self._position]
+        self._position += 1
+        if self.reader is not None:
+            return self.reader.frame(idx, self.products)
+        files = self.captures[idx]
+        producers = {k: (lambda f, p=p, k=k: read_stream(p, k)) for k, p in files.items()}
+        if "meta" not in files:
+            producers["meta"] = lambda f: capture_meta(self.path, idx)
+        if "meta" in producers:
+            producers["calibration"] = lambda f: split_meta(f.compute("meta"))[0]
+            producers["frame_info"] = lambda f: split_meta(f.compute("meta"))[1]
+        return LazyRealsenseData(producers, self.products)
+
+
+def make_source(name, config_path=None, replay=None, visualise=False, serial_number=None):
+    if name == "realsense":
+        from rs_store.camera import RealsenseD400Camera
+        return RealsenseD400Camera(config_path=config_path, visualise=visualise, serial_number=serial_number)
+    if name == "synthetic":
+        from rs_store.config import Config
+        return SyntheticSource.from_config(Config(config_path), visualise=visualise,
+                                           serial_number=serial_number or "synthetic")
+    if name == "replay":
+        if replay is None:
+            raise ValueError("--replay must be set to a saved session directory when using the replay source")
+        return ReplaySource(replay, visualise=visualise)
+    raise ValueError(f"Unknown frame source '{name}'")
@@ -0,0 +1,292 @@
+import os
+import pathlib
+import shutil
+import tarfile
+import threading
+import time
+from collections import defaultdict
+
+from rs_store.container import is_container
+from rs_store.save import log
+from rs_store.utils import parse_capture_name, parse_str_datetime
+from rs_store.writer import DERIVED_STREAMS
+
+ARCHIVE_SUFFIX = ".tar.gz"
+
+
+def _size(path):
+    try:
+        return os.stat(str(path)).st_size
+    except OSError:
+        return 0
+
+
+def tree_size(path, before=None):
+    """Bytes of every file under path, only files last modified before the time before if given"""
+    total = 0
+    for root, _, files in os.walk(str(path)):
+        for f in files:
+            try:
+                st = os.stat(os.path.join(root, f))
+            except OSError:
+                continue
+            if before is None or st.st_mtime < before:
+                total += st.st_size
+    return total
+
+
+def session_time(path):
+    """When a session started from its name (get_str_datetime), None if it is not a session"""
+    name = pathlib.Path(path).name
+    name = name[:-len(ARCHIVE_SUFFIX)] if name.endswith(ARCHIVE_SUFFIX) else name
+    try:
+        return parse_str_datetime(name).timestamp()
+    except ValueError:
+        return None
+
+
+class StorageManager:
+    """Keeps a saved_data root within a disk budget and applies retention to old sessions.
+
+    Bytes are counted once when started (on the worker thread) and then incrementally from record() and watched
+    chunked stores, never by rescanning. A single low priority worker thread applies in order:
+        thin          sessions older than thin_after_hours keep one capture per thin_every seconds
+        drop derived  while over budget, derived streams (aligned_depth_cm, aligned_depth) of the oldest sessions
+        delete        while still over budget, the oldest whole sessions
+        compact       sessions older than compact_after_hours are packed into <session>.tar.gz
+    budget_bytes limits the size of the root, min_free_bytes the free space left on its volume. Only directories
+    (and archives) named like sessions (get_str_datetime) are managed, anything else in the root is left alone but
+    still counts towards the budget. The active session is never touched and what is written to it only counts when
+    it is in the root. Chunked sessions can only be deleted or compacted, not thinned. Thinning and compaction wait
+    while busy() is true (e.g. the writer has a queue), freeing space to get back under budget does not.
+    """
+
+    def __init__(self, root, budget_bytes=None, min_free_bytes=None, thin_after_hours=None, thin_every=3600,
+                 compact_after_hours=None, active=None, catalog=None, busy=None, check_interval=30):
+        self.root = pathlib.Path(root)
+        self.budget_bytes = budget_bytes
+        self.min_free_bytes = min_free_bytes
+        self.thin_after_hours = thin_after_hours
+        self.thin_every = thin_every
+        self.compact_after_hours = compact_after_hours
+        self.active = None if active is None else pathlib.Path(active).name
+        # Bytes of the active session only count when it is saved inside the root
+        self.counts_active = active is not None and pathlib.Path(active).resolve().parent == self.root.resolve()
+        self.catalog = catalog
+        self.busy = busy or (lambda: False)
+        self.check_interval = check_interval
+        self.freed = 0
+        self._used = 0
+        self._stores = {}
+        self._thinned = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._warned = False
+        self._started = None
+        self._thread = threading.Thread(target=self._run, daemon=True, name="rs_store-storage")
+
+    def start(self):
+        # Files modified from now on are counted by record() and watch(), the startup scan skips them
+        self._started = time.time()
+        self._thread.start()
+        return self
+
+    def record(self, path, nbytes=None):
+        """Count a file that was just written (to the active session)"""
+        if not self.counts_active:
+            return
+        with self._lock:
+            self._used += _size(path) if nbytes is None else nbytes
+            if self.budget_bytes is not None and self._used > self.budget_bytes:
+                self._wake.set()
+
+    def watch(self, store):
+        """Count what a ChunkedSessionWriter appends, read from store.bytes_written when checked"""
+        if not self.counts_active:
+            return
+        with self._lock:
+            self._stores[id(store)] = [store, store.bytes_written]
+
+    @property
+    def used_bytes(self):
+        with self._lock:
+            for entry in self._stores.values():
+                store, seen = entry
+                self._used += store.bytes_written - seen
+                entry[1] = store.bytes_written
+            return self._used
+
+    def disk_usage(self):
+        """(total, used, free) of the volume the root is on"""
+        return shutil.disk_usage(str(self.root))
+
+    def over_budget(self):
+        if self.budget_bytes is not None and self.used_bytes > self.budget_bytes:
+            return True
+        return self.min_free_bytes is not None and self.disk_usage()[2] < self.min_free_bytes
+
+    def summary(self):
+        total, _, free = self.disk_usage()
+        return {"used": self.used_bytes, "budget": self.budget_bytes, "freed": self.freed, "volume_total": total,
+                "volume_free": free}
+
+    def _freed(self, nbytes):
+        with self._lock:
+            self._used -= nbytes
+            self.freed += nbytes
+
+    def _sessions(self, archives=False):
+        """Old sessions (never the active one) oldest first, optionally including compacted ones"""
+        sessions = [p for p in self.root.iterdir() if p.name != self.active and session_time(p) is not None and
+                    (p.is_dir() or (archives and p.name.endswith(ARCHIVE_SUFFIX)))]
+        return sorted(sessions, key=session_time)
+
+    def _pause(self, urgent=False):
+        # Yield to capture unless space is needed now, returns False when stopping
+        while not urgent and self.busy() and not self._stop.is_set():
+            self._stop.wait(0.5)
+        return not self._stop.is_set()
+
+    def _delete_files(self, session, serial, files, stream=None, urgent=False):
+        freed = 0
+        idxs = set()
+        for path in files:
+            if not self._pause(urgent):
+                break
+            freed += _size(path)
+            try:
+                path.unlink()
+            except OSError as e:
+                log(f"Could not delete {path}: {e}")
+                continue
+            idxs.add(parse_capture_name(path)[0])
+        self._freed(freed)
+        if self.catalog is not None and idxs:
+            self.catalog.remove(session.name, serial.name, stream=stream, idxs=sorted(idxs))
+        return freed
+
+    def _captures(self, serial):
+        captures = defaultdict(list)
+        for path in serial.iterdir():
+            parsed = parse_capture_name(path) if path.is_file() else None
+            if parsed is not None:
+                captures[parsed[0]].append((path, parsed))
+        return captures
+
+    def thin(self, session):
+        """Keep the first capture in every thin_every seconds of a session"""
+        freed = 0
+        for serial in [p for p in session.iterdir() if p.is_dir() and not is_container(p)]:
+            kept = set()
+            remove = []
+            for idx, files in sorted(self._captures(serial).items()):
+                try:
+                    bucket = int(parse_str_datetime(files[0][1][1]).timestamp() // self.thin_every)
+                except ValueError:
+                    continue
+                if bucket in kept:
+                    remove.extend(path for path, _ in files)
+                kept.add(bucket)
+            freed += self._delete_files(session, serial, remove)
+        if freed:
+            log(f"Thinned {session.name} to one capture per {self.thin_every}s, freed {freed} bytes")
+        return freed
+
+    def drop_streams(self, session, streams=DERIVED_STREAMS):
+        freed = 0
+        for serial in [p for p in session.iterdir() if p.is_dir() and not is_container(p)]:
+            for stream in streams:
+                files = [path for path in serial.iterdir()
+                         if path.is_file() and (parse_capture_name(path) or (None, None, None))[2] == stream]
+                freed += self._delete_files(session, serial, files, stream=stream, urgent=True)
+        if freed:
+            log(f"Dropped {', '.join(streams)} from {session.name} to stay within budget, freed {freed} bytes")
+        return freed
+
+    def delete(self, session):
+        if session.is_file():
+            size = _size(session)
+            session.unlink()
+        else:
+            size = tree_size(session)
+            shutil.rmtree(str(session), ignore_errors=True)
+        self._freed(size)
+        if self.catalog is not None:
+            self.catalog.remove(session.name)
+        log(f"Deleted session {session.name} to stay within budget, freed {size} bytes")
+        return size
+
+    def compact(self, session):
+        """Pack a session into <root>/<session>.tar.gz and remove the directory"""
+        archive = self.root / (session.name + ARCHIVE_SUFFIX)
+        partial = archive.with_name(archive.name + ".partial")
+        size = tree_size(session)
+        with tarfile.open(str(partial), "w:gz", compresslevel=6) as tar:
+            for root, _, files in os.walk(str(session)):
+                for f in sorted(files):
+                    if not self._pause():
+                        tar.close()
+                        partial.unlink()
+                        return 0
+                    path = pathlib.Path(root) / f
+                    tar.add(str(path), arcname=str(path.relative_to(self.root)))
+        os.replace(str(partial), str(archive))
+        shutil.rmtree(str(session), ignore_errors=True)
+        self._freed(size - _size(archive))
+        if self.catalog is not None:
+            self.catalog.remove(session.name)
+        log(f"Compacted {session.name} into {archive.name} ({size} -> {_size(archive)} bytes)")
+        return size
+
+    def check(self):
+        """One pass of retention, budget enforcement and compaction"""
+        now = time.time()
+        for session in self._sessions():
+            if not self._pause():
+                return
+            age_hours = (now - session_time(session)) / 3600
+            if self.thin_after_hours is not None and age_hours > self.thin_after_hours and session not in self._thinned:
+                self.thin(session)
+                self._thinned.add(session)
+        if self.over_budget():
+            for session in self._sessions():
+                if not self.over_budget() or not self._pause(urgent=True):
+                    break
+                self.drop_streams(session)
+        if self.over_budget():
+            for session in self._sessions(archives=True):
+                if not self.over_budget() or not self._pause(urgent=True):
+                    break
+                self.delete(session)
+        over = self.over_budget()
+        if over and not self._warned:
+            log("Storage is still over budget with no more old sessions to remove")
+        self._warned = over
+        if self.compact_after_hours is not None:
+            for session in self._sessions():
+                if (now - session_time(session)) / 3600 > self.compact_after_hours and self._pause():
+                    self.compact(session)
+
+    def _run(self):
+        try:
+            os.nice(19)  # Per thread on Linux, capture and writer threads keep their priority
+        except (AttributeError, OSError):
+            pass
+        scanned = tree_size(self.root, before=self._started)
+        with self._lock:
+            self._used += scanned
+        log(f"Storage: {scanned} bytes in {self.root}")
+        while not self._stop.is_set():
+            try:
+                self.check()
+            except Exception as e:
+                log(f"Storage check failed: {e}")
+            self._wake.wait(self.check_interval)
+            self._wake.clear()
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout=10)
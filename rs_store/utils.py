@@ -1,6 +1,8 @@
 import pathlib
 from datetime import datetime
 
+from rs_store.data import STREAMS
+
 
 def get_saved_data_root():
     return pathlib.Path(__file__).parent.parent / "saved_data"
@@ -15,3 +17,38 @@ def get_str_datetime():
 
 def get_new_save_path():
     return get_saved_data_root() / get_str_datetime()
+
+
+def format_capture_name(idx, time_str, stream):
+    return f"{idx:07d}_{time_str}_{stream}"
+
+
+def parse_capture_name(name):
+    """Inverse of format_capture_name, returns (idx, time_str, stream) or None for unrelated files"""
+    name = pathlib.Path(str(name)).name.split(".", 1)[0]
+    for stream in sorted(STREAMS, key=len, reverse=True):
+        if name.endswith("_" + stream):
+            idx, _, time_str = name[:-len(stream) - 1].partition("_")
+            if idx.isdigit():
+                return int(idx), time_str, stream
+            return None
+    return None
+
+
+def parse_str_datetime(time_str):
+    """Inverse of get_str_datetime"""
+    time_str = time_str[1:] if time_str.startswith("D") else time_str
+    for fmt in ("%Y-%m-%dT%H_%M_%S_%f", "%Y-%m-%dT%H_%M_%S"):
+        try:
+            return datetime.strptime(time_str, fmt)
+        except ValueError:
+            pass
+    raise ValueError(f"'{time_str}' is not a capture time")
+
+
+def sizeof_fmt(num, suffix='B'):
+    for unit in ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi']:
+        if abs(num) < 1024.0:
+            return "%3.1f%s%s" % (num, unit, suffix)
+        num /= 1024.0
+    return "%.1f%s%s" % (num, 'Yi', suffix)
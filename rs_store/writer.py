@@ -0,0 +1,423 @@
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from rs_store.metrics import inc, observe, set_gauge
+from rs_store.save import PARTIAL_SUFFIX, log, published_name, save
+from rs_store.utils import parse_capture_name
+
+POLICIES = ("block", "drop-oldest", "drop-newest", "drop-derived")
+# Streams that can be rebuilt from the others, dropped first under the drop-derived policy
+DERIVED_STREAMS = ("aligned_depth_cm", "aligned_depth")
+# Durability policies, a number of milliseconds syncs captures in groups at most that often
+DURABILITY = ("none", "capture")
+
+
+def parse_durability(value):
+    """'none', 'capture' or milliseconds ('250') -> (policy, window seconds)"""
+    value = str(value or "none").strip().lower()
+    if value in DURABILITY:
+        return value, None
+    try:
+        return "window", float(value.rstrip("ms").strip()) / 1000
+    except ValueError:
+        raise ValueError(f"Durability must be one of {DURABILITY} or a number of milliseconds, not '{value}'")
+
+
+def _fsync(path, directory=False):
+    try:
+        fd = os.open(str(path), os.O_RDONLY | (getattr(os, "O_DIRECTORY", 0) if directory else 0))
+    except OSError:
+        if directory:
+            return  # Directories can not be opened (or synced) on Windows
+        raise
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def clean_partial(path):
+    """Delete temporary files of captures that were never published (e.g. after a power cut), returns how many"""
+    removed = 0
+    for root, _, files in os.walk(str(path)):
+        for f in files:
+            if f.startswith(".") and f.endswith(PARTIAL_SUFFIX):
+                try:
+                    os.remove(os.path.join(root, f))
+                    removed += 1
+                except OSError:
+                    pass
+    return removed
+
+
+def _save_shared(p, name, shape, dtype, codec=None, offset=0, partial=False):
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return save(p, np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset), codec=codec, partial=partial)
+    finally:
+        shm.close()
+
+
+def _nbytes(data):
+    return data.nbytes if isinstance(data, np.ndarray) else 1024
+
+
+class WriteTask:
+    __slots__ = ("path", "data", "stream", "kwargs", "on_done", "nbytes", "shared", "result", "queued_at", "capture",
+                 "ok")
+
+    def __init__(self, path, data, stream, kwargs, on_done, shared=None, capture=None):
+        self.path = path
+        self.shared = shared
+        self.data = data
+        self.stream = stream
+        self.kwargs = kwargs
+        self.on_done = on_done
+        self.nbytes = _nbytes(data)
+        self.result = None  # Return value of save(), the path that was written (its final name once published)
+        self.queued_at = time.perf_counter()
+        self.capture = capture
+        self.ok = False
+
+
+class _Capture:
+    __slots__ = ("tasks", "pending", "sealed", "on_publish", "discard")
+
+    def __init__(self):
+        self.tasks = []
+        self.pending = 0
+        self.sealed = False
+        self.on_publish = None
+        self.discard = False  # Never sealed (interrupted), its files are removed rather than published
+
+
+class Writer:
+    """Writes captures to disk from a byte-bounded queue using thread or process workers.
+
+    When the queue is full the overflow policy decides what happens to new tasks:
+        block         wait for space (the capture loop stalls)
+        drop-oldest   discard the oldest queued tasks
+        drop-newest   discard the incoming task
+        drop-derived  discard queued derived streams (aligned_depth_cm, aligned_depth) first, then block
+
+    Process workers receive arrays through shared memory rather than pickling them.
+
+    Tasks submitted with a capture key are written under hidden temporary names and published by renaming them once
+    seal(capture) was called and every task of the capture is done. Each file is renamed on its own, so publishing is
+    atomic per file, not per capture: a crash while publishing can leave some of a capture's files under their final
+    names, never a truncated one. on_publish is only called once every rename is done, so what it records (the
+    catalog and metadata log in main.py) marks captures that were published whole. The durability policy decides
+    when data reaches the disk before being published:
+        none          rename only (safe against crashes of the process, not power cuts)
+        capture       fsync each capture's files before renaming them and their directory after
+        <ms>          group commit, completed captures are fsynced and published together at most every ms
+    Chunked stores are append-only, their records are synced (store.sync()) with the same policy and then published
+    by appending a marker (store.publish()) instead of being renamed. Records of discarded captures never get one.
+    """
+
+    def __init__(self, workers=1, mode="thread", max_bytes=512 * 1024 * 1024, policy="block", durability="none"):
+        if mode not in ("thread", "process"):
+            raise ValueError(f"Unknown writer mode '{mode}'")
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown overflow policy '{policy}' (choose from {POLICIES})")
+        self.mode = mode
+        self.policy = policy
+        self.max_bytes = int(max_bytes)
+        self._queue = deque()
+        self._queued_bytes = 0
+        self._in_flight = 0
+        self._cv = threading.Condition()
+        self._closed = False
+        self._completed = deque(maxlen=1000)
+        self.submitted = 0
+        self.written = 0
+        self.failed = 0
+        self.dropped = {}
+        self.durability, self.sync_window = parse_durability(durability)
+        self.published = 0
+        self.syncs = 0
+        self._captures = {}
+        self._ready = []
+        self._committing = 0
+        # Spawned rather than forked, forking after OpenCV has started its own threads can deadlock the workers
+        self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) \
+            if mode == "process" else None
+        self._threads = [threading.Thread(target=self._run, daemon=True, name=f"rs_store-writer-{n}")
+                         for n in range(workers)]
+        for t in self._threads:
+            t.start()
+        self._committer = threading.Thread(target=self._commit_loop, daemon=True, name="rs_store-committer")
+        self._committer.start()
+        set_gauge("rs_store_writer_queue_tasks", lambda: len(self._queue))
+        set_gauge("rs_store_writer_queue_bytes", lambda: self._queued_bytes)
+        set_gauge("rs_store_writer_in_flight", lambda: self._in_flight)
+
+    def submit(self, path, data, stream=None, on_done=None, shared=None, capture=None, **kwargs):
+        """Queue save(path, data, **kwargs), returns False if the task was dropped
+
+        shared is an optional (shared memory name, offset) already holding data (see rs_store.pool.Slot.shared_ref)
+        which lets process workers read it without another copy. capture is a key grouping the tasks published
+        together by seal(), on_done is called when the task is written (or dropped), before it is published.
+        """
+        if self.mode == "process" and kwargs.get("store") is not None:
+            raise ValueError("Chunked storage needs thread writers (--workers thread)")
+        if capture is not None:
+            kwargs["partial"] = True
+        task = WriteTask(path, data, stream, kwargs, on_done, shared, capture)
+        with self._cv:
+            self.submitted += 1
+            if capture is not None:
+                group = self._captures.get(capture) or self._captures.setdefault(capture, _Capture())
+                group.tasks.append(task)
+                group.pending += 1
+            while self._queue and self._queued_bytes + task.nbytes > self.max_bytes:
+                if self.policy == "drop-newest":
+                    self._drop(task)
+                    return False
+                if self.policy == "drop-oldest":
+                    self._drop(self._remove(0))
+                elif self.policy == "drop-derived" and self._evict_derived():
+                    continue
+                elif self.policy == "drop-derived" and stream in DERIVED_STREAMS:
+                    self._drop(task)
+                    return False
+                else:
+                    self._cv.wait()
+            self._queue.append(task)
+            self._queued_bytes += task.nbytes
+            self._cv.notify_all()
+        return True
+
+    def _remove(self, i):
+        task = self._queue[i]
+        del self._queue[i]
+        self._queued_bytes -= task.nbytes
+        return task
+
+    def _evict_derived(self):
+        for i, queued in enumerate(self._queue):
+            if queued.stream in DERIVED_STREAMS:
+                self._drop(self._remove(i))
+                return True
+        return False
+
+    def _drop(self, task):
+        # Called with self._cv held
+        self.dropped[task.stream] = self.dropped.get(task.stream, 0) + 1
+        inc("rs_store_dropped_tasks_total", stream=task.stream)
+        if task.on_done is not None:
+            task.on_done(task, False)
+        self._finished(task)
+
+    def _finished(self, task):
+        # Called with self._cv held, queues the task's capture for publishing once it is sealed and complete
+        group = self._captures.get(task.capture) if task.capture is not None else None
+        if group is None:
+            return
+        group.pending -= 1
+        if group.sealed and not group.pending:
+            self._ready.append(self._captures.pop(task.capture))
+            self._cv.notify_all()
+
+    def seal(self, capture, on_publish=None):
+        """No more tasks will be submitted for capture, publish it once they are written. on_publish(tasks) gets the
+        tasks that were written, with task.result set to their final path."""
+        with self._cv:
+            group = self._captures.get(capture) or self._captures.setdefault(capture, _Capture())
+            group.sealed = True
+            group.on_publish = on_publish
+            if not group.pending:
+                self._ready.append(self._captures.pop(capture))
+                self._cv.notify_all()
+
+    def _commit(self, batch):
+        start = time.perf_counter()
+        for group in batch:
+            if group.discard:
+                for t in group.tasks:
+                    if t.ok and t.kwargs.get("partial") and t.kwargs.get("store") is None:
+                        t.ok = False
+                        try:
+                            os.remove(t.result)
+                        except OSError:
+                            pass
+        batch = [group for group in batch if not group.discard]
+        written = [t for group in batch for t in group.tasks if t.ok]
+        stored = [t for t in written if t.kwargs.get("store") is not None]
+        stores = {id(t.kwargs["store"]): t.kwargs["store"] for t in stored}
+        files = [t for t in written if t.kwargs.get("partial") and t.kwargs.get("store") is None]
+        if self.durability != "none":
+            for t in files:
+                _fsync(t.result)
+            for store in stores.values():
+                store.sync()
+        markers = {}
+        for t in stored:
+            idx, _, stream = parse_capture_name(t.path)
+            markers.setdefault((id(t.kwargs["store"]), idx), []).append(stream)
+        for (store, idx), streams in markers.items():
+            stores[store].publish(idx, streams)
+        if self.durability != "none":
+            for store in stores.values():
+                store.sync()
+        directories = set()
+        for t in files:
+            final = published_name(t.result)
+            try:
+                os.replace(t.result, str(final))
+            except OSError as e:
+                t.ok = False
+                log(f"Could not publish {final}: {e}")
+                continue
+            t.result = str(final)
+            directories.add(final.parent)
+        if self.durability != "none":
+            for directory in directories:
+                _fsync(directory, directory=True)
+            self.syncs += 1
+        observe("rs_store_commit_seconds", time.perf_counter() - start, durability=self.durability)
+        inc("rs_store_published_captures_total", len(batch))
+        for group in batch:
+            if group.on_publish is not None:
+                try:
+                    group.on_publish([t for t in group.tasks if t.ok])
+                except Exception as e:
+                    log(f"Publish callback failed: {e}")
+
+    def _commit_loop(self):
+        last = time.perf_counter()
+        while True:
+            with self._cv:
+                while True:
+                    if self._ready and self.durability == "window" and not self._closed:
+                        remaining = self.sync_window - (time.perf_counter() - last)
+                        if remaining > 0:
+                            self._cv.wait(remaining)
+                            continue
+                    if self._ready:
+                        break
+                    if self._closed and not self._captures:
+                        return
+                    self._cv.wait()
+                batch, self._ready = self._ready, []
+                self._committing += 1
+            try:
+                self._commit(batch)
+            except Exception as e:
+                log(f"Could not publish {len(batch)} captures: {e}")
+            last = time.perf_counter()
+            with self._cv:
+                self._committing -= 1
+                self.published += sum(not group.discard for group in batch)
+                self._cv.notify_all()
+
+    def _write(self, task):
+        if self._executor is not None and task.shared is not None:
+            name, offset = task.shared
+            return self._executor.submit(_save_shared, task.path, name, task.data.shape, task.data.dtype.str,
+                                         task.kwargs.get("codec"), offset, task.kwargs.get("partial", False)).result()
+        elif self._executor is not None and isinstance(task.data, np.ndarray):
+            from multiprocessing import shared_memory
+            shm = shared_memory.SharedMemory(create=True, size=max(task.data.nbytes, 1))
+            try:
+                np.ndarray(task.data.shape, dtype=task.data.dtype, buffer=shm.buf)[...] = task.data
+                return self._executor.submit(_save_shared, task.path, shm.name, task.data.shape,
+                                             task.data.dtype.str, task.kwargs.get("codec"), 0,
+                                             task.kwargs.get("partial", False)).result()
+            finally:
+                shm.close()
+                shm.unlink()
+        elif self._executor is not None:
+            return self._executor.submit(save, task.path, task.data, **task.kwargs).result()
+        return save(task.path, task.data, **task.kwargs)
+
+    def _run(self):
+        while True:
+            with self._cv:
+                while not self._queue and not self._closed:
+                    self._cv.wait()
+                if not self._queue:
+                    return
+                task = self._remove(0)
+                self._in_flight += 1
+                self._cv.notify_all()
+            ok = True
+            start = time.perf_counter()
+            observe("rs_store_queue_wait_seconds", start - task.queued_at)
+            try:
+                task.result = self._write(task)
+                observe("rs_store_write_seconds", time.perf_counter() - start, stream=task.stream)
+            except Exception as e:
+                ok = False
+                inc("rs_store_failed_writes_total", stream=task.stream)
+                print(f"Failed to write {task.path}: {e}")
+            if task.on_done is not None:
+                task.on_done(task, ok)
+            with self._cv:
+                task.ok = ok
+                self._finished(task)
+                self._in_flight -= 1
+                if ok:
+                    self.written += 1
+                    self._completed.append(time.perf_counter())
+                else:
+                    self.failed += 1
+                self._cv.notify_all()
+
+    def qsize(self):
+        return len(self._queue)
+
+    def queued_bytes(self):
+        return self._queued_bytes
+
+    def tasks_per_second(self, window=5.0):
+        now = time.perf_counter()
+        with self._cv:
+            recent = [t for t in self._completed if now - t <= window]
+        return len(recent) / window
+
+    def stats(self):
+        with self._cv:
+            return {
+                "queue_size": len(self._queue),
+                "queue_bytes": self._queued_bytes,
+                "in_flight": self._in_flight,
+                "submitted": self.submitted,
+                "written": self.written,
+                "failed": self.failed,
+                "dropped": sum(self.dropped.values()),
+                "dropped_by_stream": dict(self.dropped),
+            }
+
+    def join(self):
+        """Wait for everything queued so far to be written and every sealed capture to be published"""
+        with self._cv:
+            while self._queue or self._in_flight or self._ready or self._committing or \
+                    any(group.sealed for group in self._captures.values()):
+                self._cv.wait()
+
+    def close(self):
+        with self._cv:
+            # Captures that were never sealed are incomplete, nothing more will come for them
+            for key, group in list(self._captures.items()):
+                group.discard = not group.sealed
+                group.sealed = True
+                if not group.pending:
+                    self._ready.append(self._captures.pop(key))
+            self._cv.notify_all()
+        self.join()
+        with self._cv:
+            self._closed = True
+            self._cv.notify_all()
+        for t in self._threads:
+            t.join()
+        self._committer.join()
+        if self._executor is not None:
+            self._executor.shutdown()
@@ -23,11 +23,9 @@ if __name__ == '__main__':
             'numpy',
             'raytils',
             'opencv-python',
-            'tqdm',
             'pyyaml',
             'pyrealsense2',
-            'pymsteams',
             'netifaces',
         ],
-        python_requires='>=3.7',
+        python_requires='>=3.8',
     )
\ No newline at end of file
@@ -0,0 +1,89 @@
+import math
+
+import numpy as np
+
+from rs_store.align import COLOUR_MAP_SIZE, JET_TABLE, align_depth, colourise
+
+
+def intrinsics(width, height, f, ppx=None, ppy=None):
+    return {"width": width, "height": height, "ppx": width / 2 if ppx is None else ppx,
+            "ppy": height / 2 if ppy is None else ppy, "fx": f, "fy": f, "model": "distortion.none",
+            "coeffs": [0.0] * 5}
+
+
+def rotation_y(degrees):
+    c, s = math.cos(math.radians(degrees)), math.sin(math.radians(degrees))
+    row_major = [[c, 0, s], [0, 1, 0], [-s, 0, c]]
+    return [row_major[r][c] for c in range(3) for r in range(3)]  # librealsense rotations are column major
+
+
+def reference_align(depth, meta):
+    """Scalar port of librealsense align_z_to_other (align.cpp), the nearest depth wins"""
+    di, ci, ex = meta["depth_intrinsics"], meta["colour_intrinsics"], meta["depth_to_colour_extrinsics"]
+    r, t, scale = ex["rotation"], ex["translation"], meta["depth_scale"]
+    out = np.zeros((ci["height"], ci["width"]), dtype=np.uint16)
+
+    def corner(x, y, z):
+        px, py = (x - di["ppx"]) / di["fx"] * z, (y - di["ppy"]) / di["fy"] * z
+        ox = r[0] * px + r[3] * py + r[6] * z + t[0]
+        oy = r[1] * px + r[4] * py + r[7] * z + t[1]
+        oz = r[2] * px + r[5] * py + r[8] * z + t[2]
+        return int(ox / oz * ci["fx"] + ci["ppx"] + 0.5), int(oy / oz * ci["fy"] + ci["ppy"] + 0.5)
+
+    for y in range(depth.shape[0]):
+        for x in range(depth.shape[1]):
+            if not depth[y, x]:
+                continue
+            z = float(depth[y, x]) * scale
+            x0, y0 = corner(x - 0.5, y - 0.5, z)
+            x1, y1 = corner(x + 0.5, y + 0.5, z)
+            if x0 < 0 or y0 < 0 or x1 >= ci["width"] or y1 >= ci["height"]:
+                continue
+            for oy in range(y0, y1 + 1):
+                for ox in range(x0, x1 + 1):
+                    out[oy, ox] = min(out[oy, ox], depth[y, x]) if out[oy, ox] else depth[y, x]
+    return out
+
+
+def make_scene(seed=0):
+    rng = np.random.default_rng(seed)
+    depth = np.full((60, 80), 1500, dtype=np.uint16) + rng.integers(0, 200, size=(60, 80), dtype=np.uint16)
+    depth[20:35, 30:50] = 600  # A box in front of the floor, occludes it in the colour camera
+    depth[:, :3] = 0
+    depth[rng.random(depth.shape) < 0.05] = 0
+    meta = {"depth_scale": 0.001, "depth_intrinsics": intrinsics(80, 60, 70.0, 40.3, 29.7),
+            "colour_intrinsics": intrinsics(96, 72, 100.0, 47.6, 36.2),
+            "depth_to_colour_extrinsics": {"rotation": rotation_y(2.0), "translation": [0.015, 0.0, 0.001]}}
+    return depth, meta
+
+
+def test_align_matches_librealsense_reference():
+    # The module docstring promises at most 1% of valid pixels differ from rs.align
+    for seed in range(3):
+        depth, meta = make_scene(seed)
+        aligned, reference = align_depth(depth, meta), reference_align(depth, meta)
+        valid = (aligned > 0) | (reference > 0)
+        assert valid.sum() > 0.5 * aligned.size
+        assert ((aligned != reference) & valid).sum() <= 0.01 * valid.sum()
+
+
+def reference_colourise(depth):
+    """Scalar port of rs.colorizer's histogram equalisation with the Jet colour map"""
+    hist = np.zeros(1 << 16, dtype=np.int64)
+    for d in depth.ravel():
+        hist[d] += 1
+    hist[0] = 0
+    cumulative = np.cumsum(hist)
+    out = np.zeros(depth.shape + (3,), dtype=np.uint8)
+    for (y, x), d in np.ndenumerate(depth):
+        if d:
+            out[y, x] = JET_TABLE[int(cumulative[d] / cumulative[-1] * (COLOUR_MAP_SIZE - 1))]
+    return out
+
+
+def test_colourise_matches_reference_within_one_table_step():
+    depth, meta = make_scene()
+    colour, reference = colourise(depth).astype(int), reference_colourise(depth).astype(int)
+    step = np.abs(np.diff(JET_TABLE.astype(int), axis=0)).max()
+    assert np.abs(colour - reference).max() <= step
+    assert not colour[depth == 0].any()
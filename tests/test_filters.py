@@ -0,0 +1,95 @@
+import pathlib
+
+import numpy as np
+import pytest
+
+from rs_store.config import Config
+from rs_store.data import LazyRealsenseData
+from rs_store.filters import PostProcessor, SpatialFilter, TemporalFilter
+
+ADVANCED = pathlib.Path(__file__).parent.parent / "configs" / "advanced.json"
+
+
+def make_config(tmp_path, filters=None):
+    text = f"advanced_config: \"{ADVANCED}\"\n"
+    if filters is not None:
+        text += "filters:\n" + "".join(f"  {line}\n" for line in filters.strip().splitlines())
+    path = tmp_path / "config.yaml"
+    path.write_text(text)
+    return Config(path)
+
+
+def step_scene(seed=0):
+    # Two noisy planes a metre apart with a few holes
+    rng = np.random.default_rng(seed)
+    depth = np.full((40, 60), 1000.0)
+    depth[:, 30:] = 2000.0
+    depth += rng.normal(0, 3, size=depth.shape)
+    depth = depth.astype(np.uint16)
+    depth[rng.random(depth.shape) < 0.02] = 0
+    return depth
+
+
+def test_spatial_smooths_planes_and_keeps_edges():
+    depth = step_scene()
+    out = SpatialFilter(filter_magnitude=2, filter_smooth_alpha=0.5, filter_smooth_delta=20)(depth)
+    near, far = out[:, 2:28][depth[:, 2:28] > 0], out[:, 32:][depth[:, 32:] > 0]
+    assert near.std() < 0.5 * depth[:, 2:28][depth[:, 2:28] > 0].std()
+    assert abs(near.mean() - 1000) < 2 and abs(far.mean() - 2000) < 2
+    # Nothing is blended across the edge (the step is far above delta) and holes are not filled
+    assert out[:, 29].max() < 1100 and out[:, 30][depth[:, 30] > 0].min() > 1900
+    assert not out[depth == 0].any()
+    assert np.array_equal(depth, step_scene())  # The input is not modified in place
+
+
+def test_temporal_blends_small_changes_only():
+    f = TemporalFilter(filter_smooth_alpha=0.4, filter_smooth_delta=20, persistency_mode=0)
+    first = np.array([[1000, 1000, 0]], dtype=np.uint16)
+    assert np.array_equal(f(first), first)
+    out = f(np.array([[1010, 1500, 1000]], dtype=np.uint16))
+    assert out[0, 0] == pytest.approx(0.4 * 1010 + 0.6 * 1000)
+    assert out[0, 1] == 1500  # Moved further than delta, not blended
+    assert out[0, 2] == 1000  # Newly valid pixels start a new history
+    f.reset()
+    assert np.array_equal(f(np.array([[500, 500, 500]], dtype=np.uint16)), [[500, 500, 500]])
+
+
+@pytest.mark.parametrize("mode, filled", [(0, False), (3, True), (1, False)])
+def test_temporal_persistency_fills_holes(mode, filled):
+    # Mode 3 fills a hole valid in 2 of the last 4 frames, mode 1 needs 8 of the last 8
+    f = TemporalFilter(persistency_mode=mode)
+    for _ in range(3):
+        f(np.array([[1000, 1000]], dtype=np.uint16))
+    out = f(np.array([[0, 1000]], dtype=np.uint16))
+    assert out[0, 0] == (1000 if filled else 0)
+
+
+def test_post_processor_from_config(tmp_path):
+    assert PostProcessor.from_config(make_config(tmp_path)) is None
+    post = PostProcessor.from_config(make_config(tmp_path, """
+stage: before_align
+temporal:
+  filter_smooth_alpha: 0.2
+spatial:
+"""))
+    assert [f.name for f in post.filters] == ["temporal", "spatial"]
+    assert post.filters[0].alpha == 0.2 and post.filters[1].magnitude == 2
+    assert (post.stage, post.stream, post.backend) == ("before_align", "depth", "numpy")
+    assert post.stateful
+    assert PostProcessor.from_config(make_config(tmp_path, "backend: realsense\nspatial: {}"), backend="numpy") \
+        .backend == "numpy"
+    with pytest.raises(ValueError):
+        PostProcessor.from_config(make_config(tmp_path, "median: {}"))
+    with pytest.raises(ValueError):
+        PostProcessor.from_config(make_config(tmp_path, "stage: during_align\nspatial: {}"))
+
+
+def test_post_processor_filters_lazy_frames(tmp_path):
+    post = PostProcessor.from_config(make_config(tmp_path, "spatial: {}"))
+    depth = step_scene()
+    frames = post.attach(LazyRealsenseData({"depth": lambda f: depth, "aligned_depth": lambda f: depth}))
+    assert np.array_equal(frames.depth, depth)
+    filtered = frames.aligned_depth
+    assert filtered.dtype == np.uint16
+    assert np.array_equal(filtered, post.apply(depth))
+    assert post.timings["spatial"][0] == 2
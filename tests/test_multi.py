@@ -0,0 +1,82 @@
+import pytest
+
+from rs_store.multi import FrameGroup, MultiCamera
+from rs_store.sources import SourceExhausted, SyntheticSource
+
+
+class ShiftedSource(SyntheticSource):
+    """Synthetic camera whose hardware clock runs offset_ms ahead of the others"""
+
+    def __init__(self, offset_ms=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.offset_ms = offset_ms
+
+    def _producers(self, i):
+        producers = super()._producers(i)
+        info = producers["frame_info"]
+        producers["frame_info"] = lambda f: dict(info(f), timestamp=info(f)["timestamp"] + self.offset_ms)
+        return producers
+
+
+def make_source(serial, fps=100, **kwargs):
+    return ShiftedSource(serial_number=serial, fps=fps, width=64, height=48, colour_width=64, colour_height=48,
+                         **kwargs)
+
+
+@pytest.fixture
+def cameras():
+    created = []
+
+    def make(*sources, tolerance_ms=20):
+        camera = MultiCamera(list(sources), tolerance_ms=tolerance_ms)
+        camera.require(save=("depth", "colour"))
+        created.append(camera)
+        return camera
+    yield make
+    for camera in created:
+        camera.stop()
+
+
+def test_frame_group_tolerance():
+    group = FrameGroup({"a": None, "b": None}, {"a": 1000.0, "b": 1012.5}, tolerance_ms=10)
+    assert group.timestamp == 1000.0
+    assert group.skew_ms == pytest.approx(12.5)
+    assert not group.synced
+    assert FrameGroup({"a": None, "b": None}, {"a": 1000.0, "b": 1012.5}, tolerance_ms=None).synced
+
+
+def test_groups_one_frame_set_per_camera(cameras):
+    camera = cameras(make_source("cam_a"), make_source("cam_b"))
+    for _ in range(5):
+        group = camera.get_frames()
+        assert sorted(group) == ["cam_a", "cam_b"]
+        assert group.synced, group.skew_ms
+        assert group.skew_ms <= 20
+        for serial, frames in group.items():
+            assert frames.depth.shape == (48, 64)
+            assert frames.frame_info["timestamp"] == group.timestamps[serial]
+
+
+def test_offset_cameras_are_marked_unsynced(cameras):
+    camera = cameras(make_source("cam_a"), make_source("cam_b", offset_ms=200))
+    group = camera.get_frames()
+    assert not group.synced
+    assert group.skew_ms > 100
+
+
+def test_waits_for_a_new_frame_from_every_camera(cameras):
+    # cam_b delivers a fifth of the frames, no group may reuse one of its frames (or go without it)
+    camera = cameras(make_source("cam_a"), make_source("cam_b", fps=20), tolerance_ms=None)
+    seen = []
+    for _ in range(4):
+        group = camera.get_frames()
+        assert set(group) == {"cam_a", "cam_b"}
+        seen.append(group["cam_b"].frame_info["frame_number"])
+    assert seen == sorted(set(seen))
+
+
+def test_exhausted_camera_stops_the_group(cameras):
+    camera = cameras(make_source("cam_a"), make_source("cam_b", n_frames=3))
+    with pytest.raises(SourceExhausted):
+        for _ in range(10):
+            camera.get_frames()
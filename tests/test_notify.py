@@ -0,0 +1,134 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from rs_store.notify import Dispatcher
+
+
+class StubServer(ThreadingHTTPServer):
+    """Records every POST (time, path, body), optionally slow or failing the first few requests"""
+
+    def __init__(self, delay=0.0, fail_first=0):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.delay = delay
+        self.fail_first = fail_first
+        self.requests = []
+        self.cv = threading.Condition()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def wait_for(self, n, timeout=5.0):
+        with self.cv:
+            assert self.cv.wait_for(lambda: len(self.requests) >= n, timeout=timeout), self.requests
+            return list(self.requests)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+        time.sleep(self.server.delay)
+        with self.server.cv:
+            failing = self.server.fail_first > 0
+            self.server.fail_first -= 1
+            if not failing:
+                self.server.requests.append((time.monotonic(), self.path, body))
+            self.server.cv.notify_all()
+        self.send_response(500 if failing else 200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(**kwargs):
+        server = StubServer(**kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_heartbeat_is_rate_limited_and_coalesced(serve):
+    server = serve()
+    dispatcher = Dispatcher(health_url=server.url + "/ping", heartbeat_interval=0.5)
+    try:
+        dispatcher.heartbeat(capture_number=0)
+        first = server.wait_for(1)[0]
+        for idx in range(1, 10):
+            dispatcher.heartbeat(capture_number=idx)
+        requests = server.wait_for(2)
+        time.sleep(0.2)
+        assert len(server.requests) == 2
+    finally:
+        dispatcher.close()
+    assert first[1] == "/ping" and "capture_number: 0" in first[2]
+    sent_at, _, body = requests[1]
+    assert sent_at - first[0] >= 0.45
+    assert "capture_number: 9" in body
+    assert "events_since_last_message: 9" in body
+    assert "first_capture_number: 1" in body
+
+
+def test_webhook_delivery_and_close_flushes_pending(serve):
+    server = serve()
+    dispatcher = Dispatcher(webhook_url=server.url + "/hook", notify_interval=60)
+    dispatcher.notify("Connected", urgent=True)
+    dispatcher.notify("Data Collected", {"capture_number": 1})
+    server.wait_for(2)
+    dispatcher.notify("Data Collected", {"capture_number": 2})  # Rate limited until close()
+    time.sleep(0.2)
+    assert len(server.requests) == 2
+    dispatcher.close()
+    messages = [json.loads(body) for _, _, body in server.wait_for(3)]
+    assert [m["title"] for m in messages] == ["Connected", "Data Collected", "Data Collected"]
+    assert "capture_number: 2" in messages[-1]["text"]
+    assert dispatcher.sent == 3 and dispatcher.failed == 0
+
+
+def test_failed_requests_are_retried(serve):
+    server = serve(fail_first=2)
+    dispatcher = Dispatcher(health_url=server.url, backoff=0.01)
+    try:
+        dispatcher.heartbeat(capture_number=0)
+        server.wait_for(1)
+    finally:
+        dispatcher.close()
+    assert dispatcher.sent == 1 and dispatcher.failed == 0
+
+
+def test_sends_never_block_the_caller(serve):
+    # A server taking a second per request must not slow down capture/saving threads calling the dispatcher
+    server = serve(delay=1.0)
+    dispatcher = Dispatcher(health_url=server.url, webhook_url=server.url, heartbeat_interval=0, notify_interval=0)
+    senders = []
+    request = dispatcher._client.request
+
+    def recorded(*args, **kwargs):
+        senders.append(threading.current_thread().name)
+        return request(*args, **kwargs)
+    dispatcher._client.request = recorded
+    try:
+        start = time.perf_counter()
+        for idx in range(20):
+            dispatcher.heartbeat(capture_number=idx)
+            dispatcher.notify("Data Collected", {"capture_number": idx}, urgent=idx == 0)
+        assert time.perf_counter() - start < 0.1
+    finally:
+        dispatcher.close(timeout=10)
+    assert server.requests
+    assert senders and all(name.startswith("rs_store-notify") for name in senders)
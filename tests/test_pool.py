@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from rs_store.pool import BufferPool
+from rs_store.save import load_img
+from rs_store.writer import Writer
+
+SHAPES = {"depth": ((48, 64), np.uint16)}
+
+
+@pytest.fixture
+def shared_pool():
+    pool = BufferPool(SHAPES, size=1, shared=True)
+    yield pool
+    pool.close()
+
+
+def test_mismatched_shapes_are_not_shared(shared_pool):
+    slot = shared_pool.acquire()
+    slot.put("depth", np.zeros((48, 64), dtype=np.uint16))
+    assert slot.shared_ref("depth") is not None
+    slot.put("depth", np.zeros((24, 32), dtype=np.uint16))
+    assert slot.shared_ref("depth") is None
+    assert shared_pool.misses == 1
+    assert slot.shared_ref("colour") is None
+    slot.release()
+
+
+def test_process_writer_saves_the_frame_not_the_slot(shared_pool, tmp_path):
+    # e.g. replaying a session recorded at another resolution than the pool was sized for
+    frames = {"matched": np.full((48, 64), 4321, dtype=np.uint16),
+              "mismatched": np.full((24, 32), 1234, dtype=np.uint16)}
+    writer = Writer(mode="process")
+    try:
+        for name, frame in frames.items():
+            slot = shared_pool.acquire()
+            data = slot.put("depth", frame)
+            writer.submit(tmp_path / name, data, stream="depth", shared=slot.shared_ref("depth"),
+                          on_done=slot.release, codec="rsd-zlib")
+            writer.join()
+    finally:
+        writer.close()
+    assert writer.written == 2
+    for name, frame in frames.items():
+        assert np.array_equal(load_img(tmp_path / f"{name}.rsd"), frame)
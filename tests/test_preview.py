@@ -0,0 +1,13 @@
+from rs_store.preview import SPACE, Preview
+
+
+def test_poll_key_keeps_space():
+    preview = Preview()
+    assert preview.poll_key() is None
+    for key in (ord("a"), SPACE, ord("b")):
+        preview._keys.put(key)
+    assert preview.poll_key() == SPACE
+    assert preview.poll_key() is None
+    for key in (ord("a"), ord("b")):
+        preview._keys.put(key)
+    assert preview.poll_key() == ord("b")
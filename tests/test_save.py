@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from rs_store.save import COMPRESSORS, decode_img, encode_img, load_img, save
+
+CODECS = ["png", "png:1"] + [f"rsd-{c}" for c in COMPRESSORS] + ["rsd-zlib:9"]
+
+
+def depth_image(h=48, w=64, seed=0):
+    rng = np.random.default_rng(seed)
+    depth = (800 + 3 * np.arange(w)[None, :] + 2 * np.arange(h)[:, None]).astype(np.uint16)
+    depth += rng.integers(0, 40, size=(h, w), dtype=np.uint16)
+    depth[:, :4] = 0
+    depth[0, 5] = np.iinfo(np.uint16).max  # Deltas wrap around
+    return depth
+
+
+LAYOUTS = {
+    "contiguous": lambda d: d,
+    "transposed": lambda d: d.T,
+    "fortran": lambda d: np.asfortranarray(d),
+    "strided": lambda d: d[::2, ::3],
+    "reversed": lambda d: d[::-1, ::-1],
+}
+
+
+@pytest.mark.parametrize("codec", CODECS)
+@pytest.mark.parametrize("layout", LAYOUTS)
+def test_depth_round_trip(codec, layout):
+    depth = LAYOUTS[layout](depth_image())
+    decoded = decode_img(encode_img(depth, codec))
+    assert decoded.dtype == np.uint16
+    assert np.array_equal(decoded, depth)
+
+
+def test_rsd_rejects_non_depth():
+    with pytest.raises(TypeError):
+        encode_img(np.zeros((4, 4, 3), dtype=np.uint8), "rsd")
+
+
+@pytest.mark.parametrize("partial", [False, True])
+def test_save_rsd_file(tmp_path, partial):
+    depth = depth_image().T
+    written = save(tmp_path / "0000000_D2021-04-01T06_00_00_000000_depth", depth, codec="rsd-zlib", partial=partial)
+    assert written.endswith(".rsd.partial" if partial else ".rsd")
+    with open(written, "rb") as fh:
+        assert np.array_equal(decode_img(fh.read()), depth)
+    if not partial:
+        assert np.array_equal(load_img(written), depth)
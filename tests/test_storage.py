@@ -0,0 +1,119 @@
+import datetime
+import tarfile
+
+import pytest
+
+from rs_store.storage import StorageManager, tree_size
+from rs_store.utils import format_capture_name, parse_capture_name
+
+STREAMS = {"colour": ".png", "depth": ".png", "aligned_depth": ".png", "aligned_depth_cm": ".png", "meta": ".json"}
+START = datetime.datetime(2021, 4, 1, 6)
+
+
+def str_datetime(t):
+    return "D" + t.isoformat(timespec="microseconds").replace(".", "_").replace(":", "_")
+
+
+def make_session(root, hours_ago=0.0, captures=12, minutes_apart=10, serial="cam"):
+    """A session started hours_ago before START with captures minutes_apart, 1000 bytes per file"""
+    start = START - datetime.timedelta(hours=hours_ago)
+    session = root / str_datetime(start)
+    (session / serial).mkdir(parents=True)
+    (session / "frames.jsonl").write_text("{}\n")
+    for idx in range(captures):
+        time_str = str_datetime(start + datetime.timedelta(minutes=idx * minutes_apart))
+        for stream, suffix in STREAMS.items():
+            (session / serial / (format_capture_name(idx, time_str, stream) + suffix)).write_bytes(b"x" * 1000)
+    return session
+
+
+@pytest.fixture
+def root(tmp_path):
+    """Three old sessions, the active session (older than all of them) and a directory that is not a session"""
+    sessions = [make_session(tmp_path, hours_ago=h) for h in (30, 20, 10)]
+    active = make_session(tmp_path, hours_ago=40)
+    (tmp_path / "notes").mkdir()
+    (tmp_path / "notes" / "readme.txt").write_bytes(b"n" * 5000)
+    (tmp_path / "catalog.sqlite").write_bytes(b"c" * 100)
+    return tmp_path, sessions, active
+
+
+def snapshot(path):
+    return sorted((str(p.relative_to(path)), p.stat().st_size) for p in path.rglob("*") if p.is_file())
+
+
+def manager(root, active, **kwargs):
+    storage = StorageManager(root, active=active, **kwargs)
+    storage._used = tree_size(root)  # What the startup scan in start() counts
+    return storage
+
+
+def streams_left(session):
+    return sorted({parse_capture_name(p)[2] for p in (session / "cam").iterdir()})
+
+
+def test_thin_keeps_one_capture_per_interval(root):
+    root, (session, *_), active = root
+    storage = manager(root, active, thin_every=3600)
+    freed = storage.thin(session)
+    idxs = sorted({int(p.name[:7]) for p in (session / "cam").iterdir()})
+    assert idxs == [0, 6]  # Captures every 10 minutes from 06:00 on the hour
+    assert freed == 10 * len(STREAMS) * 1000 == storage.freed
+    assert (session / "frames.jsonl").exists()
+
+
+def test_drop_streams_only_removes_derived_streams(root):
+    root, (session, *_), active = root
+    storage = manager(root, active)
+    assert storage.drop_streams(session) == 12 * 2 * 1000
+    assert len(list((session / "cam").iterdir())) == 12 * 3
+    assert not any("aligned" in p.name for p in (session / "cam").iterdir())
+
+
+def test_delete_and_compact(root):
+    root, (first, second, _), active = root
+    storage = manager(root, active)
+    size = tree_size(first)
+    assert storage.delete(first) == size and not first.exists()
+    before, size = snapshot(second), tree_size(second)
+    assert storage.compact(second) == size
+    assert not second.exists()
+    with tarfile.open(str(root / (second.name + ".tar.gz"))) as tar:
+        members = sorted((m.name, m.size) for m in tar.getmembers() if m.isfile())
+    assert members == sorted((f"{second.name}/{name}", n) for name, n in before)
+    assert not list(root.glob("*.partial"))
+
+
+def test_over_budget_drops_derived_then_deletes_oldest_sessions(root):
+    root, (first, second, third), active = root
+    untouched = {p: snapshot(p) for p in (active, root / "notes")}
+    capture_bytes = len(STREAMS) * 1000
+    # Dropping the derived streams of every old session is not enough, deleting the oldest one too is
+    budget = tree_size(root) - 12 * capture_bytes - 12 * 2000
+    storage = manager(root, active, budget_bytes=budget)
+    storage.check()
+    assert not first.exists()
+    assert streams_left(second) == ["colour", "depth", "meta"]
+    assert streams_left(third) == ["colour", "depth", "meta"]
+    assert storage.used_bytes <= budget
+    assert {p: snapshot(p) for p in untouched} == untouched
+    assert (root / "catalog.sqlite").exists()
+
+
+def test_budget_never_touches_the_active_session_or_other_directories(root):
+    root, sessions, active = root
+    untouched = {p: snapshot(p) for p in (active, root / "notes")}
+    storage = manager(root, active, budget_bytes=1, compact_after_hours=1, thin_after_hours=1)
+    storage.check()
+    assert not any(s.exists() for s in sessions)
+    assert not list(root.glob("*.tar.gz"))  # Deleted to get under budget before compaction
+    assert {p: snapshot(p) for p in untouched} == untouched
+    assert storage.over_budget()
+
+
+def test_compacts_old_sessions_only(root):
+    root, sessions, active = root
+    storage = manager(root, active, compact_after_hours=0)
+    storage.check()
+    assert sorted(p.name for p in root.glob("*.tar.gz")) == sorted(s.name + ".tar.gz" for s in sessions)
+    assert active.is_dir() and (root / "notes").is_dir()
@@ -0,0 +1,206 @@
+import pathlib
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import rs_store.writer
+from rs_store.container import ChunkedSessionReader, ChunkedSessionWriter
+from rs_store.save import PARTIAL_SUFFIX, load_img
+from rs_store.utils import format_capture_name
+from rs_store.writer import Writer
+
+
+def frame(value=0, nbytes=100):
+    return np.full(nbytes, value, dtype=np.uint8)
+
+
+@pytest.fixture
+def stalled(monkeypatch):
+    """Thread writers whose saves wait for release.set(), the first submitted task is taken by the only worker and
+    the rest stay queued so the overflow policies can be checked"""
+    release = threading.Event()
+    saved = []
+
+    def slow_save(p, d, **kwargs):
+        release.wait(5)
+        saved.append(p)
+        return str(p)
+    monkeypatch.setattr(rs_store.writer, "save", slow_save)
+    writers = []
+
+    def make(policy, max_bytes=300):
+        writer = Writer(workers=1, max_bytes=max_bytes, policy=policy)
+        writers.append(writer)
+        writer.submit("in_flight", frame(), stream="depth")
+        deadline = time.monotonic() + 5
+        while writer.qsize() and time.monotonic() < deadline:
+            time.sleep(0.001)
+        return writer
+    make.release = release
+    make.saved = saved
+    yield make
+    release.set()
+    for writer in writers:
+        writer.close()
+
+
+def submit_all(writer, streams):
+    dropped = []
+    for n, stream in enumerate(streams):
+        writer.submit(f"{n}_{stream}", frame(), stream=stream,
+                      on_done=lambda task, ok: None if ok else dropped.append(task.path))
+    return dropped
+
+
+def queued(writer):
+    return [task.path for task in writer._queue]
+
+
+def test_drop_newest_keeps_the_queue(stalled):
+    writer = stalled("drop-newest")
+    dropped = submit_all(writer, ["depth", "colour", "depth", "colour", "depth"])
+    assert queued(writer) == ["0_depth", "1_colour", "2_depth"]
+    assert dropped == ["3_colour", "4_depth"]
+    assert writer.dropped == {"colour": 1, "depth": 1}
+    assert writer.queued_bytes() == 300
+
+
+def test_drop_oldest_keeps_the_newest(stalled):
+    writer = stalled("drop-oldest")
+    dropped = submit_all(writer, ["depth", "colour", "depth", "colour", "depth"])
+    assert queued(writer) == ["2_depth", "3_colour", "4_depth"]
+    assert dropped == ["0_depth", "1_colour"]
+    assert writer.dropped == {"depth": 1, "colour": 1}
+
+
+def test_drop_derived_evicts_derived_streams_first(stalled):
+    writer = stalled("drop-derived")
+    dropped = submit_all(writer, ["aligned_depth_cm", "depth", "aligned_depth", "colour", "depth", "aligned_depth"])
+    assert queued(writer) == ["1_depth", "3_colour", "4_depth"]
+    assert dropped == ["0_aligned_depth_cm", "2_aligned_depth", "5_aligned_depth"]
+    assert writer.dropped == {"aligned_depth_cm": 1, "aligned_depth": 2}
+    assert writer.stats()["dropped"] == 3
+
+
+def test_drop_derived_blocks_for_raw_streams(stalled):
+    writer = stalled("drop-derived")
+    submit_all(writer, ["depth", "colour", "depth"])
+    blocked = threading.Thread(target=writer.submit, args=("3_colour", frame()), kwargs={"stream": "colour"})
+    blocked.start()
+    blocked.join(0.2)
+    assert blocked.is_alive()
+    stalled.release.set()
+    blocked.join(5)
+    writer.join()
+    assert not writer.dropped
+    assert writer.written == 5
+
+
+def test_block_waits_for_space(stalled):
+    writer = stalled("block")
+    submit_all(writer, ["depth", "colour", "depth"])
+    blocked = threading.Thread(target=writer.submit, args=("3_colour", frame()), kwargs={"stream": "colour"})
+    blocked.start()
+    blocked.join(0.2)
+    assert blocked.is_alive()
+    assert writer.queued_bytes() == 300
+    stalled.release.set()
+    blocked.join(5)
+    assert not blocked.is_alive()
+    writer.join()
+    assert stalled.saved == ["in_flight", "0_depth", "1_colour", "2_depth", "3_colour"]
+    assert writer.written == 5 and not writer.dropped
+
+
+def test_oversized_task_is_queued_when_the_queue_is_empty(stalled):
+    writer = stalled("drop-newest", max_bytes=50)
+    assert writer.submit("big", frame(), stream="depth")
+    assert not writer.submit("next", frame(), stream="depth")
+    assert queued(writer) == ["big"]
+
+
+def test_process_writer_copies_arrays_through_shared_memory(tmp_path):
+    depth = np.arange(48 * 64, dtype=np.uint16).reshape(48, 64)
+    writer = Writer(mode="process", workers=2)
+    try:
+        writer.submit(tmp_path / "depth", depth, stream="depth", codec="rsd-zlib")
+        writer.submit(tmp_path / "transposed", depth.T, stream="depth", codec="rsd-zlib")
+        writer.submit(tmp_path / "meta", {"frame_number": 1}, stream="frame_info")
+    finally:
+        writer.close()
+    assert writer.written == 3 and writer.failed == 0
+    assert np.array_equal(load_img(tmp_path / "depth.rsd"), depth)
+    assert np.array_equal(load_img(tmp_path / "transposed.rsd"), depth.T)
+    assert (tmp_path / "meta.json").exists()
+
+
+def files_in(path):
+    return sorted(p.name for p in path.rglob("*") if p.is_file())
+
+
+def submit_capture(writer, path, idx, store=None):
+    time_str = "D2021-04-01T06_00_00_000000"
+    for stream, data in [("depth", np.full((4, 4), idx, dtype=np.uint16)), ("meta", {"frame_number": idx})]:
+        writer.submit(path / format_capture_name(idx, time_str, stream), data, stream=stream, store=store,
+                      capture=idx)
+
+
+def test_sealed_captures_are_published_and_unsealed_ones_discarded(tmp_path):
+    writer = Writer(workers=2)
+    published = []
+    submit_capture(writer, tmp_path, 0)
+    writer.seal(0, published.append)
+    submit_capture(writer, tmp_path, 1)  # Interrupted before it was sealed
+    writer.close()
+    assert files_in(tmp_path) == ["0000000_D2021-04-01T06_00_00_000000_depth.png",
+                                  "0000000_D2021-04-01T06_00_00_000000_meta.json"]
+    assert [sorted(pathlib.Path(t.result).name for t in tasks) for tasks in published] == [files_in(tmp_path)]
+    assert writer.published == 1
+
+
+def test_files_keep_temporary_names_until_sealed(tmp_path):
+    writer = Writer()
+    try:
+        submit_capture(writer, tmp_path, 0)
+        writer.join()
+        names = files_in(tmp_path)
+        assert len(names) == 2 and all(n.startswith(".") and n.endswith(PARTIAL_SUFFIX) for n in names)
+        writer.seal(0)
+        writer.join()
+        assert not any(n.endswith(PARTIAL_SUFFIX) for n in files_in(tmp_path))
+    finally:
+        writer.close()
+
+
+def test_unsealed_chunked_captures_are_not_read_back(tmp_path):
+    store = ChunkedSessionWriter(tmp_path, chunk_size=10)
+    writer = Writer(workers=2)
+    for idx in range(3):
+        submit_capture(writer, tmp_path, idx, store=store)
+        if idx != 1:
+            writer.seal(idx)
+    writer.close()
+    store.close()
+    reader = ChunkedSessionReader(tmp_path)
+    try:
+        assert reader.indices == [0, 2]
+        assert reader.streams(2) == ["depth", "meta"]
+        assert np.array_equal(reader.read(2, "depth"), np.full((4, 4), 2, dtype=np.uint16))
+    finally:
+        reader.close()
+    assert not any(n.endswith(PARTIAL_SUFFIX) for n in files_in(tmp_path))
+
+
+def test_unpublished_rewrites_keep_the_published_record(tmp_path):
+    with ChunkedSessionWriter(tmp_path) as store:
+        store.write(0, "depth", np.zeros((2, 2), dtype=np.uint16))
+        store.write(0, "aligned_depth", np.ones((2, 2), dtype=np.uint16), published=False)
+        store.publish(0, ["aligned_depth"])
+        store.write(0, "aligned_depth", np.full((2, 2), 2, dtype=np.uint16), published=False)  # Never published
+    reader = ChunkedSessionReader(tmp_path)
+    try:
+        assert np.array_equal(reader.read(0, "aligned_depth"), np.ones((2, 2), dtype=np.uint16))
+    finally:
+        reader.close()